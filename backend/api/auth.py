@@ -1,7 +1,9 @@
-from fastapi import APIRouter, HTTPException, Depends, Request, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, Request, BackgroundTasks, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr
 from typing import Optional, Dict, Any
-from backend.core.database import db
+from backend.core.database import async_db
+import json
 import time
 import random
 import string
@@ -131,7 +133,7 @@ async def send_code(payload: SendCodeRequest, request: Request, background_tasks
     ip = get_client_ip(request)
     
     # 1. Rate Limit Check
-    last_min, last_hour, last_day = db.get_ip_code_stats(ip)
+    last_min, last_hour, last_day = await async_db.get_ip_code_stats(ip)
     
     if last_min >= 1:
         raise HTTPException(status_code=429, detail="Too many requests. Please wait 1 minute.")
@@ -144,7 +146,7 @@ async def send_code(payload: SendCodeRequest, request: Request, background_tasks
     code = generate_code()
     expires_at = time.time() + 300 # 5 minutes
     
-    db.save_verification_code(payload.email, code, ip, expires_at)
+    await async_db.save_verification_code(payload.email, code, ip, expires_at)
     
     # 3. Send (Async)
     background_tasks.add_task(send_email_smtp, payload.email, code)
@@ -157,39 +159,39 @@ async def register(payload: RegisterRequest, request: Request):
     
     # 1. Check if Code is Invite Code or Email Code
     # Try invite code first
-    if db.check_invite_code(payload.code):
+    if await async_db.check_invite_code(payload.code):
         is_invite = True
     else:
         is_invite = False
-        valid_code = db.get_valid_code(payload.email, payload.code)
+        valid_code = await async_db.get_valid_code(payload.email, payload.code)
         if not valid_code:
             raise HTTPException(status_code=400, detail="Invalid verification code or invite code.")
     
     # 2. Check IP Limit (1 Account per IP)
     # Admin is exempt or special logic? We stick to strict rule for now.
     # But wait, localhost might be shared. Let's allow localhost to have multiple for dev, but enforce on real IPs.
-    if ip != "127.0.0.1" and db.check_ip_registered(ip):
+    if ip != "127.0.0.1" and await async_db.check_ip_registered(ip):
          raise HTTPException(status_code=403, detail="Registration limit exceeded for this IP address.")
 
     # 3. Create User
-    success = db.create_user(payload.username, payload.password, payload.email, ip)
+    success = await async_db.create_user(payload.username, payload.password, payload.email, ip)
     if not success:
         raise HTTPException(status_code=400, detail="Username or Email already exists.")
     
     # 4. Mark Code Used
     if is_invite:
         # Need user_id, retrieve it
-        user = db.get_user_by_auth(payload.username, payload.password)
+        user = await async_db.get_user_by_auth(payload.username, payload.password)
         if user:
-            db.mark_invite_code_used(payload.code, user['id'])
+            await async_db.mark_invite_code_used(payload.code, user['id'])
     else:
-        db.mark_code_used(payload.email, payload.code)
+        await async_db.mark_code_used(payload.email, payload.code)
     
     return {"message": "User registered successfully."}
 
 @router.post("/auth/login")
 async def login(user: LoginRequest):
-    user_record = db.get_user_by_auth(user.username, user.password)
+    user_record = await async_db.get_user_by_auth(user.username, user.password)
     if not user_record:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
@@ -203,14 +205,85 @@ async def login(user: LoginRequest):
 @router.post("/sync/push")
 async def push_data(payload: UserDataSync):
     # Security note: In a real app, verify token. Here we trust the client provided user_id for simplicity as requested.
-    db.save_user_data(payload.user_id, payload.data_type, payload.content)
+    await async_db.save_user_data(payload.user_id, payload.data_type, payload.content)
     return {"status": "ok"}
 
 @router.get("/sync/pull/{user_id}/{data_type}")
 async def pull_data(user_id: int, data_type: str):
-    data = db.get_user_data(user_id, data_type)
+    data = await async_db.get_user_data(user_id, data_type)
     return {"content": data} # Returns null if not found, client handles merge
 
+def parse_user_listing(fields: Optional[str], data: str) -> Dict[str, Any]:
+    """
+    Query params -> list_users options.
+    fields: comma separated user columns (default: all)
+    data: 'all' (default), 'none', or comma separated data_types e.g. 'settings,characters'
+    """
+    options: Dict[str, Any] = {}
+    if fields:
+        options['fields'] = [f.strip() for f in fields.split(',') if f.strip()]
+    if data == 'none':
+        options['include_data'] = False
+    elif data != 'all':
+        options['data_types'] = [d.strip() for d in data.split(',') if d.strip()]
+    return options
+
 @router.get("/admin/users")
-async def admin_get_users(admin_user: str = "admin", admin_pass: str = "admin123"):
-    return db.get_all_users_full_data()
+async def admin_get_users(
+    response: Response,
+    after_id: int = 0,
+    limit: int = 100,
+    q: Optional[str] = None,
+    fields: Optional[str] = None,
+    data: str = "all",
+    admin_user: str = "admin",
+    admin_pass: str = "admin123"
+):
+    """
+    One page of users (keyset pagination).
+    Pass the X-Next-Cursor response header back as ?after_id= for the next page;
+    the header is absent on the last page.
+    """
+    users, next_after_id = await async_db.list_users(
+        after_id=after_id, limit=limit, search=q, **parse_user_listing(fields, data)
+    )
+    if next_after_id is not None:
+        response.headers["X-Next-Cursor"] = str(next_after_id)
+    return users
+
+@router.get("/admin/users/export")
+async def admin_export_users(
+    q: Optional[str] = None,
+    fields: Optional[str] = None,
+    data: str = "all",
+    admin_user: str = "admin",
+    admin_pass: str = "admin123"
+):
+    """
+    Every user as NDJSON (one JSON object per line), streamed page by page.
+    Stored blobs are spliced in as-is, never parsed, so memory stays constant.
+    """
+    options = parse_user_listing(fields, data)
+
+    async def export_lines():
+        after_id = 0
+        while after_id is not None:
+            users, after_id = await async_db.list_users(
+                after_id=after_id, limit=500, search=q, raw_data=True, **options
+            )
+            lines = []
+            for user in users:
+                blobs = user.pop('data', None)
+                line = json.dumps(user, ensure_ascii=False)
+                if blobs is not None:
+                    data_json = ", ".join(f"{json.dumps(k)}: {v}" for k, v in blobs.items())
+                    line = f'{line[:-1]}, "data": {{{data_json}}}}}'
+                lines.append(line)
+            if lines:
+                yield "\n".join(lines) + "\n"
+
+    return StreamingResponse(
+        export_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=users.ndjson"}
+    )
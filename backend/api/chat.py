@@ -2,29 +2,57 @@ from fastapi import APIRouter, Header, HTTPException, Request, Depends
 from fastapi.responses import StreamingResponse, JSONResponse
 from typing import Optional, Dict, Any
 from pydantic import BaseModel
+import asyncio
+import functools
 import httpx
 import json
 import logging
+import os
 import time
 
 from backend.domain.models import ChatRequest
-from backend.core.context import ContextEngine
-from backend.core.token_manager import TokenManager
-from backend.core.database import db
+from backend.core.token_manager import tokenizer_pool
+from backend.core.tokenizers import tokenizers
+from backend.core.database import async_db
+from backend.core.billing import metered_charge, usage_tokens
+from backend.core.upstream import upstream_clients, chat_completions_url
+from backend.core.routing import (
+    endpoint_router, model_endpoints, is_retryable, parse_retry_after, UpstreamUnavailable
+)
+from backend.core.quota import quota_tracker
+from backend.core.scheduler import admission_scheduler, SchedulerRejected
+from backend.core.sse import SSEScanner, DeltaTokenCounter
+from backend.core.metrics import (
+    abandoned_generations, hedged_requests, request_duration_seconds, ttft_seconds,
+    inter_chunk_seconds, stream_duration_seconds, tokens_per_second, upstream_responses, usage_tokens_total,
+    stream_resumes
+)
+from backend.core.hedging import hedge_policy
+from backend.core.stream_buffer import generations, SpooledGeneration
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# Initialize Engines
-token_manager = TokenManager()
-context_engine = ContextEngine(token_manager)
+# Ask for the final usage chunk of streams (stream_options.include_usage);
+# set to 0 for providers that reject the parameter
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "1") != "0"
 
-# Global Client
-http_client = httpx.AsyncClient(timeout=120.0)
+async def warm_upstream_pools():
+    """Pre-connects to every enabled model's provider (started from main's startup)."""
+    models = await async_db.get_models(include_secrets=True)
+    urls = [chat_completions_url(m['api_url']) for m in models if m['api_url']]
+    for m in models:
+        urls += [chat_completions_url(e['api_url']) for e in await async_db.get_model_endpoints(m['id'])]
+    await upstream_clients.warm_up(urls)
+
+async def preload_tokenizers():
+    """Loads the encoders of the enabled models (started from main's startup)."""
+    models = await async_db.get_models()
+    await tokenizers.preload(m['model_id'] for m in models)
 
 @router.on_event("shutdown")
 async def shutdown_event():
-    await http_client.aclose()
+    await upstream_clients.aclose()
 
 class ImageRequest(BaseModel):
     prompt: str
@@ -63,7 +91,9 @@ async def generate_image(
     
     try:
         logger.info(f"Generating image via {upstream_url}")
-        resp = await http_client.post(upstream_url, headers=headers, json=payload)
+        # Client-supplied URL: no pool kept for it
+        async with upstream_clients.one_off() as client:
+            resp = await client.post(upstream_url, headers=headers, json=payload)
         if resp.status_code != 200:
             logger.error(f"Image Gen Error {resp.status_code}: {resp.text}")
             return JSONResponse(content=json.loads(resp.text), status_code=resp.status_code)
@@ -77,7 +107,7 @@ async def list_models():
     """
     Return list of MANAGED models from DB.
     """
-    models = db.get_models(include_secrets=False)
+    models = await async_db.get_models(include_secrets=False)
     # Transform to OpenAI format
     data = []
     for m in models:
@@ -96,13 +126,15 @@ async def list_models():
 
 @router.post("/v1/chat/completions")
 async def chat_completions(
-    request: ChatRequest, 
+    request: ChatRequest,
+    http_request: Request,
     # Frontend sends user_id in header for now (In real app, use JWT)
     x_user_id: Optional[int] = Header(None)
 ):
     """
     Power-Aware Chat Completion
     """
+    started = time.monotonic()
     if not x_user_id:
          raise HTTPException(status_code=401, detail="Missing User ID")
 
@@ -112,51 +144,69 @@ async def chat_completions(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid Model ID")
 
-    model_config = db.get_model_by_id(model_db_id)
+    model_config = await async_db.get_model_by_id(model_db_id)
     if not model_config:
         raise HTTPException(status_code=404, detail="Model not found")
         
     if not model_config['enabled']:
         raise HTTPException(status_code=403, detail="Model is disabled")
 
-    # 2. Check & Deduct Power (Pre-flight)
+    # 2. Prepare Request
+    # Optimize Context
+    raw_messages = [m.dict() for m in request.messages]
+    context_engine = await tokenizers.for_model_async(model_config['model_id'])
+    optimized_messages, prompt = await context_engine.build_context_estimated_async(
+        messages=raw_messages,
+        max_context_tokens=model_config['context_length'] // 2, # Conservative
+        system_prompt=None
+    )
+
+    # Upstream endpoints in the order to try them (see backend/core/routing.py)
+    endpoint_rows = await async_db.get_model_endpoints(model_db_id)
+    candidates = endpoint_router.plan(
+        model_endpoints(model_config, endpoint_rows), model_config.get('routing') or "weighted"
+    )
+    if not candidates:
+        raise HTTPException(status_code=503, detail="Model has no upstream endpoint configured")
+
+    # 3. Admission: per-model / per-key concurrency, fair queueing across users
+    ticket = admission_scheduler.acquire_nowait(model_config, candidates)
+    if ticket is None:
+        admission = asyncio.create_task(admission_scheduler.acquire(
+            model_config, x_user_id, candidates, prompt.tokens + (request.max_tokens or 0)
+        ))
+        if await cancel_on_disconnect(http_request, admission):
+            return JSONResponse(content={"error": "Client disconnected"}, status_code=499)
+        try:
+            ticket = admission.result()
+        except SchedulerRejected as e:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Model is busy ({e.reason}). Please retry in {e.retry_after}s.",
+                headers={"Retry-After": str(e.retry_after)}
+            )
+
+    # 4. Reserve Power (Pre-flight). power_cost is the most a message can cost;
+    # the final charge is settled from real usage once the reply is done.
     cost = model_config['power_cost']
-    success = db.deduct_power(x_user_id, cost, reason="chat", model_id=model_db_id)
-    
-    if not success:
+    try:
+        reservation_id = await async_db.reserve_power(x_user_id, cost, model_id=model_db_id)
+    except BaseException:
+        ticket.release()
+        raise
+
+    if not reservation_id:
+        ticket.release()
         # Get current balance for error message
-        user = db.get_user_by_id(x_user_id)
+        user = await async_db.get_user_by_id(x_user_id)
         balance = user['power_balance'] if user else 0
         raise HTTPException(
             status_code=402, 
             detail=f"Insufficient Power. Required: {cost}, Balance: {balance}. Please recharge."
         )
 
-    # 3. Prepare Request
-    # Optimize Context
-    raw_messages = [m.dict() for m in request.messages]
-    optimized_messages = context_engine.build_context(
-        messages=raw_messages,
-        max_context_tokens=model_config['context_length'] // 2, # Conservative
-        system_prompt=None
-    )
-    
-    api_url = model_config['api_url']
-    if not api_url.endswith("/chat/completions"):
-        if api_url.endswith("/"):
-            api_url += "chat/completions"
-        else:
-            api_url += "/chat/completions"
-            
-    api_key = model_config['api_key']
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
-        "model": model_config['model_id'], # The real model string (gpt-4)
+        # "model" (the real model string, e.g. gpt-4) is filled in per endpoint
         "messages": optimized_messages,
         "temperature": request.temperature,
         "max_tokens": request.max_tokens,
@@ -164,57 +214,490 @@ async def chat_completions(
         "frequency_penalty": request.frequency_penalty,
         "stream": request.stream
     }
+    if request.stream and STREAM_INCLUDE_USAGE:
+        payload["stream_options"] = {"include_usage": True}
 
-    # 4. Execute & Stream
+    # 5. Execute & Stream (the ticket is released once the upstream call is over)
     if request.stream:
+        generation = generations.create(x_user_id)
+        pump = asyncio.create_task(
+            pump_upstream(generation, ticket, payload, reservation_id, model_config, prompt, started)
+        )
+        _pumps.add(pump)
+        pump.add_done_callback(_pumps.discard)
+        generation.on_abandon = pump.cancel
         return StreamingResponse(
-            stream_with_refund_guard(api_url, headers, payload, x_user_id, cost),
-            media_type="text/event-stream"
+            follow_generation(http_request, generation, 0),
+            media_type="text/event-stream",
+            headers={"X-Generation-Id": generation.id}
         )
     else:
-        # Non-streaming
+        # Non-streaming. Runs as a task so a client that gives up also cancels the upstream call.
+        post = asyncio.create_task(post_with_failover(ticket, payload, prompt.tokens + request.max_tokens))
+        post.add_done_callback(lambda _: ticket.release())
+        if await cancel_on_disconnect(http_request, post):
+            abandoned_generations.inc(model=model_config['model_id'], stream="0")
+            logger.info(f"Client left before the reply (reservation {reservation_id})")
+            await settle_usage(reservation_id, model_config, await prompt.count(), 0, "counted", reason="settle_abandoned")
+            return JSONResponse(content={"error": "Client disconnected"}, status_code=499)
         try:
-            resp = await http_client.post(api_url, headers=headers, json=payload)
-            if resp.status_code != 200:
-                # REFUND
-                logger.error(f"Upstream Error {resp.status_code}: {resp.text}")
-                db.refund_power(x_user_id, cost, reason="refund_error")
-                return JSONResponse(content={"error": resp.text}, status_code=resp.status_code)
-            return JSONResponse(content=resp.json())
+            resp = post.result()
+            data = resp.json()
+        except UpstreamUnavailable as e:
+            # REFUND
+            logger.error(f"Upstream Error {e.status}: {e.detail}")
+            await async_db.settle_reservation(reservation_id, 0, reason="refund_error")
+            return JSONResponse(content={"error": e.detail}, status_code=e.status)
         except Exception as e:
             # REFUND
             logger.error(f"Upstream Exception: {e}")
-            db.refund_power(x_user_id, cost, reason="refund_exception")
+            await async_db.settle_reservation(reservation_id, 0, reason="refund_exception")
             raise HTTPException(status_code=502, detail=str(e))
 
-async def stream_with_refund_guard(url, headers, payload, user_id, cost):
+        # SETTLE (prefer upstream usage, else count the reply ourselves)
+        usage = usage_tokens(data.get('usage'))
+        if usage:
+            usage += ("upstream",)
+        else:
+            reply = "".join(
+                str((c.get('message') or {}).get('content') or "") for c in data.get('choices') or []
+            )
+            usage = (await prompt.count(), await context_engine.tm.count_string_async(reply, cache=False), "counted")
+        await settle_usage(reservation_id, model_config, *usage)
+        request_duration_seconds.observe(time.monotonic() - started, model=model_config['model_id'], stream="0")
+        return JSONResponse(content=data)
+
+# --- Upstream failover ---
+
+class AttemptOrder:
+    """
+    Hands out the endpoints to try, in routing order, each one only once
+    its key has RPM/TPM room for `estimate` tokens (see backend/core/quota.py):
+    a key without room is passed over for one that has it, and when none
+    has, the request waits for the soonest one - or gives up with a 429 if
+    that is more than QUOTA_MAX_DELAY_SECONDS away. Keys with no free
+    scheduler slot are skipped.
+    """
+    def __init__(self, ticket, estimate):
+        self.ticket = ticket
+        self.estimate = estimate
+        self.remaining = list(ticket.candidates)
+
+    async def next(self, hedge=False):
+        """Next endpoint, or None when there are none left. A hedge never waits for quota."""
+        while self.remaining:
+            delays = [(quota_tracker.delay(e.slot, self.estimate), i) for i, e in enumerate(self.remaining)]
+            delay, index = next(((d, i) for d, i in delays if d <= 0), None) or min(delays)
+            if hedge and delay > 0:
+                return None
+            if delay > quota_tracker.max_delay:
+                raise UpstreamUnavailable(429, f"Upstream rate limit reached, retry in {delay:.0f}s")
+            endpoint = self.remaining.pop(index)
+            if not (self.ticket.add(endpoint) if hedge else self.ticket.use(endpoint)):
+                continue
+            # Counted before any wait, so concurrent requests queue up behind it
+            quota_tracker.record(endpoint.slot, self.estimate)
+            if delay > 0:
+                logger.info(f"Holding request {delay:.2f}s for {endpoint.name} quota")
+                await asyncio.sleep(delay)
+            return endpoint
+        return None
+
+async def post_with_failover(ticket, payload, estimate):
+    """
+    Non-streaming call: tries each endpoint in turn (see AttemptOrder)
+    until one answers 200.
+    Raises UpstreamUnavailable with the last error otherwise.
+    """
+    order = AttemptOrder(ticket, estimate)
+    last_error = UpstreamUnavailable(502, "No upstream endpoint available")
+    while (endpoint := await order.next()) is not None:
+        endpoint_router.started(endpoint)
+        try:
+            resp = await upstream_clients.get(endpoint.url).post(
+                endpoint.url, headers=endpoint.headers(), json={**payload, "model": endpoint.model}
+            )
+            quota_tracker.observe(endpoint.slot, resp.headers)
+            upstream_responses.inc(model=endpoint.model, endpoint=endpoint.name, status=str(resp.status_code))
+        except httpx.HTTPError as e:
+            upstream_responses.inc(model=endpoint.model, endpoint=endpoint.name, status="error")
+            endpoint_router.record_failure(endpoint)
+            logger.warning(f"Upstream {endpoint.name} failed: {e!r}, trying next")
+            last_error = UpstreamUnavailable(502, str(e) or type(e).__name__)
+            continue
+        finally:
+            endpoint_router.finished(endpoint)
+
+        if resp.status_code == 200:
+            endpoint_router.record_success(endpoint)
+            return resp
+        endpoint_router.record_failure(endpoint, resp.status_code, parse_retry_after(resp.headers.get("retry-after")))
+        last_error = UpstreamUnavailable(resp.status_code, resp.text)
+        if not is_retryable(resp.status_code):
+            break
+        logger.warning(f"Upstream {endpoint.name} answered {resp.status_code}, trying next")
+    raise last_error
+
+async def open_stream_attempt(endpoint, payload):
+    """
+    One streaming attempt, up to and including its first bytes.
+    Returns (response, first_chunk, chunks, ttft); the response is open and
+    owned by the caller. Raises UpstreamUnavailable (response closed).
+    """
+    client = upstream_clients.get(endpoint.url)
+    # identity: raw bytes must be plain SSE, not gzip, to pass straight through
+    request = client.build_request(
+        "POST", endpoint.url, headers={**endpoint.headers(), "Accept-Encoding": "identity"},
+        json={**payload, "model": endpoint.model}
+    )
+    started = time.monotonic()
+    response = None
+    try:
+        response = await client.send(request, stream=True)
+        quota_tracker.observe(endpoint.slot, response.headers)
+        upstream_responses.inc(model=endpoint.model, endpoint=endpoint.name, status=str(response.status_code))
+        if response.status_code != 200:
+            error_content = (await response.aread()).decode(errors="replace")
+            await response.aclose()
+            endpoint_router.record_failure(
+                endpoint, response.status_code, parse_retry_after(response.headers.get("retry-after"))
+            )
+            raise UpstreamUnavailable(response.status_code, error_content)
+        chunks = response.aiter_raw()
+        first_chunk = await chunks.__anext__()
+    except (httpx.HTTPError, StopAsyncIteration) as e:
+        if response is not None:
+            await response.aclose()
+        else:
+            upstream_responses.inc(model=endpoint.model, endpoint=endpoint.name, status="error")
+        endpoint_router.record_failure(endpoint)
+        detail = (str(e) or type(e).__name__) if isinstance(e, httpx.HTTPError) else "Empty upstream response"
+        raise UpstreamUnavailable(502, detail)
+    except BaseException:
+        # Cancelled (client left, or lost a hedge race) while waiting for the first byte
+        if response is not None:
+            await response.aclose()
+        raise
+
+    ttft = time.monotonic() - started
+    endpoint_router.record_success(endpoint, ttft=ttft)
+    return response, first_chunk, chunks, ttft
+
+async def open_stream_with_failover(ticket, payload, estimate, model_config):
+    """
+    Streaming call: tries each endpoint in turn (see AttemptOrder) until
+    one has produced its first bytes, so failures before that point never
+    reach the client.
+
+    For models with hedging on (see backend/core/hedging.py), an attempt
+    still silent after the hedge delay gets a duplicate on the next
+    endpoint; the first to produce bytes wins and the other is cancelled,
+    so only the winner is ever streamed (and billed).
+
+    Returns (endpoint, response, first_chunk, chunks); the caller owns the
+    response (must aclose it) and must call endpoint_router.finished(endpoint).
+    Raises UpstreamUnavailable with the last error otherwise.
+    """
+    order = AttemptOrder(ticket, estimate)
+    last_error = UpstreamUnavailable(502, "No upstream endpoint available")
+    hedge_after = hedge_policy.hedge_after(model_config)
+    if hedge_after is not None:
+        hedge_policy.earn()
+    model_name = model_config['model_id']
+    attempts: Dict[asyncio.Task, Any] = {}
+    hedge_task = None
+    first_started = 0.0
+    try:
+        while True:
+            if not attempts:
+                endpoint = await order.next()
+                if endpoint is None:
+                    raise last_error
+                attempts[asyncio.create_task(open_stream_attempt(endpoint, payload))] = endpoint
+                first_started = time.monotonic()
+
+            timeout = None
+            if hedge_after is not None and len(attempts) == 1:
+                timeout = max(0.0, hedge_after - (time.monotonic() - first_started))
+            done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Slow first byte: hedge (once per request)
+                hedge_after = None
+                if not hedge_policy.try_spend():
+                    hedged_requests.inc(model=model_name, outcome="no_budget")
+                    continue
+                endpoint = await order.next(hedge=True)
+                if endpoint is None:
+                    hedged_requests.inc(model=model_name, outcome="no_endpoint")
+                    continue
+                logger.info(f"Hedging {model_name} on {endpoint.name} after {time.monotonic() - first_started:.2f}s")
+                hedge_task = asyncio.create_task(open_stream_attempt(endpoint, payload))
+                attempts[hedge_task] = endpoint
+                continue
+
+            winner = fatal = None
+            for task in done:
+                endpoint = attempts.pop(task)
+                try:
+                    result = task.result()
+                except UpstreamUnavailable as e:
+                    ticket.drop(endpoint)
+                    last_error = e
+                    if not is_retryable(e.status):
+                        fatal = e  # Raised once the rest of `done` is cleaned up
+                        continue
+                    logger.warning(f"Upstream {endpoint.name} failed before the first byte ({e.status}), trying next")
+                    continue
+                if winner is None:
+                    winner = (endpoint, result, task)
+                else:
+                    # Both produced bytes at once - close the spare
+                    ticket.drop(endpoint)
+                    await result[0].aclose()
+
+            if fatal is not None:
+                if winner is not None:
+                    ticket.drop(winner[0])
+                    await winner[1][0].aclose()
+                raise fatal
+
+            if winner is None:
+                if hedge_task is not None and not attempts:
+                    hedged_requests.inc(model=model_name, outcome="failed")
+                    hedge_task = None
+                continue
+
+            endpoint, (response, first_chunk, chunks, ttft), task = winner
+            if hedge_task is not None:
+                hedged_requests.inc(model=model_name, outcome="hedge_won" if task is hedge_task else "primary_won")
+            ticket.keep(endpoint)
+            hedge_policy.observe_ttft(model_config['id'], ttft)
+            endpoint_router.started(endpoint)
+            return endpoint, response, first_chunk, chunks
+    finally:
+        # Losers (or everything, if we were cancelled / gave up)
+        await discard_attempts(ticket, attempts)
+
+async def discard_attempts(ticket, attempts: Dict[asyncio.Task, Any]):
+    """
+    Cancels unfinished stream attempts and gives back their slots; one
+    that got its response before the cancel landed has it closed.
+    """
+    for task in attempts:
+        task.cancel()
+    results = await asyncio.gather(*attempts, return_exceptions=True)
+    for endpoint, result in zip(attempts.values(), results):
+        if isinstance(result, tuple):
+            await result[0].aclose()
+        ticket.drop(endpoint)
+
+# --- Client disconnects ---
+
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+# Strong refs: the event loop only keeps weak references to tasks
+_pumps = set()
+
+async def cancel_on_disconnect(http_request: Request, task: asyncio.Task) -> bool:
     """
-    Wraps the stream. If it fails *immediately* or yields error, refund.
+    Waits for `task`, polling the client connection meanwhile.
+    If the client goes away first the task is cancelled and True is returned.
     """
-    has_started = False
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            return False
+        if await http_request.is_disconnected():
+            task.cancel()
+            return True
+
+def settle_shielded(reservation_id, charge=0, reason="settle"):
+    """settle_reservation that still completes if the calling task is cancelled meanwhile."""
+    return asyncio.shield(async_db.settle_reservation(reservation_id, charge, reason=reason))
+
+# --- Usage ---
+
+# Endpoint.key -> whether its last stream ended with a usage chunk. Streams
+# from endpoints that report usage are only counted if the chunk is missing.
+_reports_usage: Dict[str, bool] = {}
+
+async def settle_usage(reservation_id, model_config, prompt_tokens, completion_tokens, source, reason="settle"):
+    """Charges for the tokens used and records them (request_usage table, token metrics)."""
+    charged = await async_db.settle_reservation(
+        reservation_id, metered_charge(model_config, prompt_tokens, completion_tokens),
+        reason=reason, usage=(prompt_tokens, completion_tokens, source)
+    )
+    if charged is not None:
+        usage_tokens_total.inc(prompt_tokens, model=model_config['model_id'], kind="prompt")
+        usage_tokens_total.inc(completion_tokens, model=model_config['model_id'], kind="completion")
+    return charged
+
+async def settle_stream(reservation_id, model_config, prompt, scanner, counter, reason="settle"):
+    """
+    Settles a stream from the upstream's usage chunk if it sent one, else
+    from our own count of the prompt (PromptTokens) and the deltas.
+    Returns completion tokens.
+    """
+    usage = usage_tokens(scanner.usage)
+    if usage:
+        prompt_tokens, completion_tokens = usage
+        source = "upstream"
+    else:
+        prompt_tokens = await prompt.count()
+        completion_tokens = await counter.total(scanner)
+        source = "counted"
+    await settle_usage(reservation_id, model_config, prompt_tokens, completion_tokens, source, reason=reason)
+    return completion_tokens
+
+# --- Resumable streams ---
+
+@router.get("/v1/chat/generations/{generation_id}")
+async def resume_generation(
+    generation_id: str,
+    http_request: Request,
+    x_user_id: Optional[int] = Header(None),
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    Reconnects to a streamed reply (X-Generation-Id of the original
+    response): replays the events after Last-Event-ID, then follows the
+    live tail. Nothing is charged again and no new upstream call is made.
+    """
+    if not x_user_id:
+        raise HTTPException(status_code=401, detail="Missing User ID")
+    generation = await generations.find(generation_id)
+    if generation is None or generation.user_id != x_user_id:
+        stream_resumes.inc(outcome="missing")
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
     try:
-        async with http_client.stream('POST', url, headers=headers, json=payload) as response:
-            if response.status_code != 200:
-                # Immediate Failure
-                error_content = await response.aread()
-                logger.error(f"Stream Start Error: {error_content}")
-                db.refund_power(user_id, cost, reason="refund_stream_start")
-                yield f"data: {json.dumps({'error': error_content.decode()})}\n\n"
-                return
-
-            async for line in response.aiter_lines():
-                if line:
-                    # If we get a chunk, we consider the "Service Rendered" (partially at least)
-                    # To be very strict: we could wait for [DONE].
-                    # But if we get any token, the AI has "worked".
-                    # However, if the first chunk is an error json?
-                    has_started = True
-                    yield f"{line}\n"
-                    
+        after = max(0, int(last_event_id or 0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    stream_resumes.inc(outcome="spooled" if isinstance(generation, SpooledGeneration) else "local")
+    return StreamingResponse(
+        follow_generation(http_request, generation, after),
+        media_type="text/event-stream",
+        headers={"X-Generation-Id": generation_id}
+    )
+
+async def follow_generation(http_request, generation, after):
+    """
+    Streams a generation's events after `after` to one client. The
+    upstream is read by a separate pump task (see pump_upstream) which also
+    does the billing. A client that disconnects - noticed by polling
+    is_disconnected(), or by Starlette closing this generator - only
+    detaches: the reply keeps being buffered for STREAM_RESUME_GRACE_SECONDS
+    so it can reconnect (see resume_generation), after which the upstream
+    request is cancelled and billed for what was generated so far.
+    """
+    generation.attach()
+    try:
+        async for data in generation.follow(after, DISCONNECT_POLL_SECONDS):
+            if data is None:
+                if await http_request.is_disconnected():
+                    return
+                continue
+            yield data
+    finally:
+        generation.detach()
+
+async def pump_upstream(generation, ticket, payload, reservation_id, model_config, prompt, started):
+    """
+    Reads the upstream stream into `generation` (see stream_buffer.py) and
+    settles the reservation. If no endpoint can start the stream, or it crashes
+    mid-way, refund. Otherwise settles from the reported (or counted) usage -
+    including when cancelled because the client left. Upstream events are
+    forwarded unchanged except for their framing: the buffer normalises
+    line endings and prefixes each event with an `id: <seq>` line (for
+    Last-Event-ID), so clients see one event per upstream event, not the
+    upstream's exact bytes. The scanner only watches them for errors,
+    [DONE] and usage, and the counter counts completion tokens in
+    batches on the tokenizer threads (see DeltaTokenCounter) unless the
+    endpoint is known to report usage. `prompt` is the PromptTokens of the
+    context and `started` when the request arrived (for the latency metrics).
+    """
+    scanner = SSEScanner()
+    token_manager = tokenizers.for_model(model_config['model_id']).tm  # Loaded by the handler already
+    counter = DeltaTokenCounter(functools.partial(token_manager.count_string, cache=False), tokenizer_pool())
+    endpoint = response = None
+    model_name = model_config['model_id']
+    gaps = []  # Observed in one batch at the end, to keep the per-chunk cost down
+    try:
+        try:
+            endpoint, response, chunk, chunks = await open_stream_with_failover(
+                ticket, payload, prompt.tokens + (payload.get('max_tokens') or 0), model_config
+            )
+        except UpstreamUnavailable as e:
+            # Immediate Failure (on every endpoint)
+            logger.error(f"Stream Start Error {e.status}: {e.detail}")
+            await settle_shielded(reservation_id, 0, reason="refund_stream_start")
+            generation.append(f"data: {json.dumps({'error': e.detail})}\n\n")
+            generation.finish()
+            return
+
+        first_at = last_at = time.monotonic()
+        ttft_seconds.observe(first_at - started, model=model_name)
+        count_live = not _reports_usage.get(endpoint.key)
+        scanner.feed(chunk)
+        generation.append(chunk)
+        async for chunk in chunks:
+            now = time.monotonic()
+            gaps.append(now - last_at)
+            last_at = now
+            scanner.feed(chunk)
+            if count_live:
+                counter.poll(scanner)
+            generation.append(chunk)
+        scanner.close()
+        _reports_usage[endpoint.key] = scanner.usage is not None
+
+    except asyncio.CancelledError:
+        # Client disconnected (and did not come back in time). Closing the
+        # upstream response stops the generation (and its token bill).
+        if response is not None:
+            await response.aclose()
+        scanner.close()
+        abandoned_generations.inc(model=model_name, stream="1")
+        logger.info(f"Client left mid-stream after {scanner.events} events (reservation {reservation_id})")
+        await asyncio.shield(
+            settle_stream(reservation_id, model_config, prompt, scanner, counter, reason="settle_abandoned")
+        )
+        generation.finish()
+        return
+
     except Exception as e:
         logger.error(f"Stream Exception: {e}")
+        if endpoint is not None:
+            endpoint_router.record_failure(endpoint)
         # If it crashed mid-stream, strict policy says "AI 失败 -> 全额返还"
         # We can try to refund if we think it failed catastrophically.
         # For safety, let's refund.
-        db.refund_power(user_id, cost, reason="refund_stream_crash")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        await settle_shielded(reservation_id, 0, reason="refund_stream_crash")
+        generation.append(f"data: {json.dumps({'error': str(e)})}\n\n")
+        generation.finish()
+        return
+
+    finally:
+        if response is not None:
+            await response.aclose()
+        if endpoint is not None:
+            endpoint_router.finished(endpoint)
+        ticket.release()
+
+    generation.finish()
+    request_duration_seconds.observe(time.monotonic() - started, model=model_name, stream="1")
+    inter_chunk_seconds.observe_many(gaps, model=model_name)
+    stream_duration_seconds.observe(last_at - first_at, model=model_name)
+
+    # SETTLE
+    if scanner.error and not scanner.usage and not await counter.total(scanner):
+        # Upstream reported an error in-band and produced nothing
+        logger.error(f"Stream Error Event: {scanner.error}")
+        await settle_shielded(reservation_id, 0, reason="refund_stream_error")
+        return
+    completion_tokens = await asyncio.shield(
+        settle_stream(reservation_id, model_config, prompt, scanner, counter)
+    )
+    if last_at > first_at and completion_tokens:
+        tokens_per_second.observe(completion_tokens / (last_at - first_at), model=model_name)
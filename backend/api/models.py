@@ -1,9 +1,11 @@
 # Models Router
 from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
-from backend.core.database import db
-import httpx
+from backend.core.database import async_db
+from backend.core.upstream import upstream_clients
+from backend.core.routing import endpoint_router, model_endpoints, ROUTING_STRATEGIES
+from backend.core.quota import quota_tracker
 
 router = APIRouter()
 
@@ -16,6 +18,31 @@ class ModelUpdate(BaseModel):
     power_cost: int
     context_length: int
     enabled: bool
+    # Optional: left out (None), the column keeps its current value
+    power_per_1k_tokens: Optional[int] = None # 0 = flat power_cost per message
+    routing: Optional[str] = None # Endpoint selection: 'weighted' or 'latency'
+    primary_weight: Optional[int] = None # Share of the model's own api_url/api_key (0 = extra endpoints only)
+    max_concurrency: Optional[int] = None # In-flight requests per worker for this model (0 = unlimited)
+    primary_max_concurrency: Optional[int] = None # Same, for the primary api_key
+    hedge_percentile: Optional[float] = None # Hedge streams slower than this TTFT percentile, e.g. 95 (0 = off)
+
+class EndpointCreate(BaseModel):
+    api_url: str
+    api_key: str = ""
+    name: Optional[str] = None
+    upstream_model: Optional[str] = None # Defaults to the model's model_id
+    weight: int = 1
+    enabled: bool = True
+    max_concurrency: int = 0 # Per worker, shared by endpoints with the same URL host + key (0 = unlimited)
+
+class EndpointUpdate(BaseModel):
+    api_url: Optional[str] = None
+    api_key: Optional[str] = None
+    name: Optional[str] = None
+    upstream_model: Optional[str] = None
+    weight: Optional[int] = None
+    enabled: Optional[bool] = None
+    max_concurrency: Optional[int] = None
 
 class TestConnectionRequest(BaseModel):
     api_url: str
@@ -25,13 +52,7 @@ class TestConnectionRequest(BaseModel):
 @router.get("/admin/models")
 async def get_models(admin_user: str = "admin", admin_pass: str = "admin123"):
     # In real app, verify admin token
-    return db.get_models(include_secrets=True)
-
-@router.post("/admin/models/{model_id}")
-async def update_model(model_id: int, updates: ModelUpdate):
-    # In real app, verify admin token
-    db.update_model(model_id, updates.dict())
-    return {"status": "ok"}
+    return await async_db.get_models(include_secrets=True)
 
 @router.post("/admin/models/test")
 async def test_model_connection(payload: TestConnectionRequest):
@@ -66,15 +87,77 @@ async def test_model_connection(payload: TestConnectionRequest):
         # For some providers (like Azure or custom), logic might differ.
         # But for "OpenAI Compatible", this is standard.
         
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(url, json=data, headers=headers)
-            
-            if resp.status_code == 200:
-                return {"success": True, "message": "Connection Successful! (200 OK)"}
-            elif resp.status_code == 401:
-                return {"success": False, "message": "Authentication Failed (401). Check API Key."}
-            else:
-                return {"success": False, "message": f"Error {resp.status_code}: {resp.text[:100]}"}
+        # Shared pool for this host (also warms it for real traffic)
+        resp = await upstream_clients.get(url).post(url, json=data, headers=headers, timeout=10.0)
+        
+        if resp.status_code == 200:
+            return {"success": True, "message": "Connection Successful! (200 OK)"}
+        elif resp.status_code == 401:
+            return {"success": False, "message": "Authentication Failed (401). Check API Key."}
+        else:
+            return {"success": False, "message": f"Error {resp.status_code}: {resp.text[:100]}"}
                 
     except Exception as e:
         return {"success": False, "message": f"Connection Error: {str(e)}"}
+
+@router.post("/admin/models/{model_id}")
+async def update_model(model_id: int, updates: ModelUpdate):
+    # In real app, verify admin token
+    if updates.routing is not None and updates.routing not in ROUTING_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"routing must be one of {', '.join(ROUTING_STRATEGIES)}")
+    if updates.hedge_percentile is not None and not 0 <= updates.hedge_percentile < 100:
+        raise HTTPException(status_code=400, detail="hedge_percentile must be between 0 (off) and 100")
+    changes = {k: v for k, v in updates.dict().items() if v is not None}
+    await async_db.update_model(model_id, changes)
+    return {"status": "ok"}
+
+# --- Endpoint Pool ---
+
+async def _get_model_or_404(model_id: int):
+    model = await async_db.get_model_by_id(model_id)
+    if not model:
+        raise HTTPException(status_code=404, detail="Model not found")
+    return model
+
+@router.get("/admin/models/{model_id}/endpoints")
+async def get_model_endpoints(model_id: int):
+    """Endpoint pool of a model (primary first) with this worker's live health scores."""
+    model = await _get_model_or_404(model_id)
+    rows = await async_db.get_model_endpoints(model_id, include_disabled=True)
+    pool = {e.key: e for e in model_endpoints(model, rows)}
+
+    primary = pool.get(f"model:{model_id}")
+    result = [{
+        "id": None, "name": "primary", "api_url": model['api_url'], "api_key": model['api_key'],
+        "upstream_model": model['model_id'], "weight": model.get('primary_weight', 1), "enabled": primary is not None,
+        "max_concurrency": model.get('primary_max_concurrency') or 0,
+        "health": endpoint_router.snapshot(primary) if primary else None,
+        "quota": quota_tracker.snapshot(primary.slot) if primary else None,
+    }]
+    for row in rows:
+        endpoint = pool.get(f"endpoint:{row['id']}")
+        result.append({
+            **row,
+            "health": endpoint_router.snapshot(endpoint) if endpoint else None,
+            "quota": quota_tracker.snapshot(endpoint.slot) if endpoint else None,
+        })
+    return {"routing": model.get('routing') or "weighted", "endpoints": result}
+
+@router.post("/admin/models/{model_id}/endpoints")
+async def add_model_endpoint(model_id: int, endpoint: EndpointCreate):
+    await _get_model_or_404(model_id)
+    endpoint_id = await async_db.add_model_endpoint(model_id, endpoint.dict())
+    return {"status": "ok", "id": endpoint_id}
+
+@router.post("/admin/models/{model_id}/endpoints/{endpoint_id}")
+async def update_model_endpoint(model_id: int, endpoint_id: int, updates: EndpointUpdate):
+    changes = {k: v for k, v in updates.dict().items() if v is not None}
+    if changes and not await async_db.update_model_endpoint(model_id, endpoint_id, changes):
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    return {"status": "ok"}
+
+@router.delete("/admin/models/{model_id}/endpoints/{endpoint_id}")
+async def delete_model_endpoint(model_id: int, endpoint_id: int):
+    if not await async_db.delete_model_endpoint(model_id, endpoint_id):
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    return {"status": "ok"}
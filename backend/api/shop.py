@@ -4,7 +4,7 @@ from typing import List, Optional
 import uuid
 import random
 import string
-from backend.core.database import db
+from backend.core.database import async_db
 
 router = APIRouter()
 
@@ -43,8 +43,8 @@ import time
 
 @router.get("/shop/config")
 async def get_shop_config():
-    notice = db.get_config("shop_notice")
-    reg_enabled = db.get_config("registration_enabled")
+    notice = await async_db.get_config("shop_notice")
+    reg_enabled = await async_db.get_config("registration_enabled")
     return {
         "notice": notice,
         "registration_enabled": reg_enabled == "true"
@@ -64,7 +64,7 @@ async def redeem_code(payload: RedeemRequest, request: Request):
     if not check_redeem_limit(ip):
         raise HTTPException(status_code=429, detail="Too many attempts. Please try again later.")
 
-    success, msg, amount = db.redeem_code(int(user_id), payload.code.strip())
+    success, msg, amount = await async_db.redeem_code(int(user_id), payload.code.strip())
     
     if not success:
         raise HTTPException(status_code=400, detail=msg)
@@ -86,12 +86,12 @@ async def generate_codes(payload: GenerateRequest):
         code = f"LT-{part1}-{part2}-{part3}"
         codes.append({"code": code, "value": payload.value})
         
-    db.create_recharge_codes(codes)
+    await async_db.create_recharge_codes(codes)
     return {"message": f"Generated {payload.amount} codes", "codes": codes}
 
 @router.get("/admin/shop/codes")
 async def list_codes():
-    return db.get_all_codes()
+    return await async_db.get_all_codes()
 
 class GenerateInviteRequest(BaseModel):
     amount: int
@@ -106,14 +106,14 @@ async def generate_invites(payload: GenerateInviteRequest):
         code = f"INV-{suffix}"
         codes.append({"code": code, "memo": payload.memo})
         
-    db.create_invite_codes(codes)
+    await async_db.create_invite_codes(codes)
     return {"message": f"Generated {payload.amount} invite codes", "codes": codes}
 
 @router.get("/admin/shop/invites")
 async def list_invites():
-    return db.get_all_invite_codes()
+    return await async_db.get_all_invite_codes()
 
 @router.post("/admin/config")
 async def update_config(payload: ConfigRequest):
-    db.set_config(payload.key, payload.value)
+    await async_db.set_config(payload.key, payload.value)
     return {"status": "ok"}
@@ -1,5 +1,7 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 from backend.core.tunnel import tunnel_service
+from backend.core.metrics import metrics_store
 
 router = APIRouter()
 
@@ -10,3 +12,8 @@ async def get_tunnel_status():
         "password": tunnel_service.password,
         "status": "connected" if tunnel_service.url else "connecting" if tunnel_service.running else "stopped"
     }
+
+@router.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape target: every worker's metrics, added up (see MetricsStore)."""
+    return PlainTextResponse(metrics_store.render(), media_type="text/plain; version=0.0.4")
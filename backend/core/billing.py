@@ -0,0 +1,25 @@
+import math
+from typing import Any, Dict, Optional
+
+def metered_charge(model_config: Dict[str, Any], prompt_tokens: int, completion_tokens: int) -> int:
+    """
+    Final charge for a finished request.
+    - power_per_1k_tokens == 0: flat power_cost per message (legacy pricing).
+    - otherwise: tokens * rate / 1000, at least 1, never more than power_cost
+      (power_cost is what was reserved up front).
+    """
+    cap = model_config['power_cost']
+    rate = model_config.get('power_per_1k_tokens') or 0
+    if rate <= 0:
+        return cap
+    tokens = max(prompt_tokens, 0) + max(completion_tokens, 0)
+    return min(cap, max(1, math.ceil(tokens * rate / 1000)))
+
+def usage_tokens(usage: Optional[Dict[str, Any]]):
+    """Extracts (prompt_tokens, completion_tokens) from an OpenAI `usage` object, or None."""
+    if not isinstance(usage, dict):
+        return None
+    try:
+        return int(usage.get('prompt_tokens') or 0), int(usage.get('completion_tokens') or 0)
+    except (TypeError, ValueError):
+        return None
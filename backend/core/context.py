@@ -1,5 +1,29 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from .metrics import context_builds
 from .token_manager import TokenManager
+from .trimming import newest_that_fit, without_system
+
+class PromptTokens:
+    """
+    Prompt size of a context from build_context_estimated_async. `tokens`
+    is exact when `exact`, else a hard upper bound (UTF-8 sizes for the
+    messages not counted) - fine for admission and quota estimates;
+    count() gives the exact number (for billing),
+    encoding the context only the first time it is needed.
+    """
+    __slots__ = ("tm", "context", "tokens", "exact")
+
+    def __init__(self, tm: TokenManager, context: List[Dict[str, Any]], tokens: int, exact: bool):
+        self.tm = tm
+        self.context = context
+        self.tokens = tokens
+        self.exact = exact
+
+    async def count(self) -> int:
+        if not self.exact:
+            self.tokens = sum(await self.tm.message_costs_async(self.context))
+            self.exact = True
+        return self.tokens
 
 class ContextEngine:
     def __init__(self, token_manager: TokenManager):
@@ -15,6 +39,107 @@ class ContextEngine:
         2. Keep the most recent messages that fit in the budget.
         3. Drop old messages if necessary.
         """
+        return self.build_context_counted(messages, max_context_tokens, system_prompt)[0]
+
+    def build_context_counted(self,
+                              messages: List[Dict[str, Any]],
+                              max_context_tokens: int = 4000,
+                              system_prompt: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Same as build_context, but also returns the prompt token count
+        (used for token-metered billing when upstream reports no usage).
+        """
+        # Filter out system messages from input messages to avoid duplication if frontend sent them
+        history, _ = without_system(messages)
+        costs = [self.tm.count_message(m) for m in history]
+        return self.build_context_precounted(history, costs, max_context_tokens, system_prompt)
+
+    async def build_context_counted_async(self,
+                                          messages: List[Dict[str, Any]],
+                                          max_context_tokens: int = 4000,
+                                          system_prompt: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        build_context_counted for the request handlers. Small requests are
+        counted inline as before; from TokenManager.offload_chars of text
+        up, the history is batch-encoded on tokenizer_pool() so a 100k-token
+        prompt doesn't stall every other stream on the event loop.
+        """
+        history, _ = without_system(messages)
+        costs = await self.tm.message_costs_async(history)
+        return self.build_context_precounted(history, costs, max_context_tokens, system_prompt)
+
+    async def build_context_estimated_async(self,
+                                            messages: List[Dict[str, Any]],
+                                            max_context_tokens: int = 4000,
+                                            system_prompt: Optional[str] = None) -> Tuple[List[Dict[str, Any]], PromptTokens]:
+        """
+        build_context_counted_async that skips encoding the history when a
+        hard ceiling on its size already fits the budget - the usual case
+        with 128k-context models. Each message starts at its UTF-8 size
+        (TokenManager.ceiling_message); if the sum is over budget, the
+        messages whose ceiling is probably loosest (CJK, prose - by the
+        estimator's density) are counted exactly first, until it fits.
+        Either way every message is kept, as exact counting would have
+        done, and the PromptTokens is that ceiling. Histories that still
+        don't fit are counted exactly and trimmed.
+        """
+        history, _ = without_system(messages)
+        if self.tm.estimate and history:
+            context = []
+            budget = max_context_tokens
+            if system_prompt:
+                sys_msg = {"role": "system", "content": system_prompt}
+                context.append(sys_msg)
+                budget -= self.tm.count_message(sys_msg)
+            if budget > 0:
+                ceilings = [self.tm.ceiling_message(m) for m in history]
+                total, exact = sum(ceilings), False
+                if total > budget:
+                    total, exact = await self._tighten(history, ceilings, total, budget)
+                if total <= budget:
+                    context.extend(history)
+                    context_builds.inc(mode="estimated")
+                    return context, PromptTokens(self.tm, context, max_context_tokens - budget + total, exact)
+        context, tokens = await self.build_context_counted_async(history, max_context_tokens, system_prompt)
+        context_builds.inc(mode="exact")
+        return context, PromptTokens(self.tm, context, tokens, exact=True)
+
+    async def _tighten(self, history: List[Dict[str, Any]], ceilings: List[int],
+                       total: int, budget: int) -> Tuple[int, bool]:
+        """
+        Swaps ceilings for exact counts, loosest first, until `total` fits
+        `budget` or nothing is left to count. Returns (total, all exact).
+        """
+        estimator = self.tm.estimator
+        slack = []
+        for i, message in enumerate(history):
+            if "content" in message:
+                typical, size = estimator.estimate(str(message["content"]))
+                slack.append((size - typical, i))
+        slack.sort(reverse=True)
+        counted = 0
+        while total > budget and counted < len(slack):
+            # Enough messages to cover the overshoot if the estimates hold, plus half again
+            wanted, batch = (total - budget) * 1.5, []
+            while counted < len(slack) and wanted > 0:
+                wanted -= slack[counted][0]
+                batch.append(slack[counted][1])
+                counted += 1
+            costs = await self.tm.message_costs_async([history[i] for i in batch])
+            for i, cost in zip(batch, costs):
+                total -= ceilings[i] - cost
+                ceilings[i] = cost
+        return total, counted == len(slack)
+
+    def build_context_precounted(self,
+                                 messages: List[Dict[str, Any]],
+                                 costs: Sequence[int],
+                                 max_context_tokens: int = 4000,
+                                 system_prompt: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        build_context_counted for callers that already have each message's
+        count_message() cost (`costs`, aligned with `messages`).
+        """
         final_context = []
         current_tokens = 0
 
@@ -30,28 +155,16 @@ class ContextEngine:
         if remaining_budget <= 0:
             # Emergency: System prompt alone is too big? 
             # In reality, we might truncate system prompt, but let's assume it fits.
-            return final_context
+            return final_context, current_tokens
 
-        # 2. Process History (Reverse Order)
-        # We add messages from newest to oldest until budget is full
-        history_to_keep = []
-        # Filter out system messages from input messages to avoid duplication if frontend sent them
-        user_history = [m for m in messages if m.get("role") != "system"]
-        
-        for msg in reversed(user_history):
-            msg_tokens = self.tm.count_message(msg)
-            if current_tokens + msg_tokens > max_context_tokens:
-                break
-            
-            history_to_keep.append(msg)
-            current_tokens += msg_tokens
-        
-        # 3. Reconstruct Order
-        # history_to_keep is [newest, ..., oldest_that_fits]
-        # We need [oldest_that_fits, ..., newest]
-        final_context.extend(reversed(history_to_keep))
+        # 2. Keep the newest messages that fit (see trimming.py), in chronological order
+        history, costs = without_system(messages, costs)
+        kept, kept_tokens = newest_that_fit(costs, remaining_budget)
+        if kept:
+            final_context.extend(history[len(history) - kept:])
+            current_tokens += kept_tokens
 
-        return final_context
+        return final_context, current_tokens
 
     def optimize(self, request_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """
@@ -1,7 +1,21 @@
 import sqlite3
+import asyncio
+import atexit
+import functools
 import json
 import logging
+import os
+import socket
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .ledger import LedgerWriter, LedgerCompactor, USAGE_INSERT
+from .sqlite_pool import ConnectionPool
+from .storage import create_user_data_store
+from .migrations import run_migrations
+from .metrics import reservation_settlements, db_call_seconds
 from typing import Optional, Dict, List, Any
 
 logger = logging.getLogger(__name__)
@@ -9,151 +23,90 @@ logger = logging.getLogger(__name__)
 class Database:
     def __init__(self, db_path="users.db"):
         self.db_path = db_path
+        # One persistent connection per thread (uvicorn loop + threadpool workers)
+        self._pool = ConnectionPool(db_path)
+        # Read-through cache for ai_models / system_config (rarely written)
+        self._cache: Dict[Any, Any] = {}
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0
+        self._cache_stamp = None
+        self._cache_version_path = f"{db_path}.cache-version"
         self._init_db()
+        # Settings/character blobs live behind a storage interface (optionally sharded)
+        self.user_data = create_user_data_store(self._pool, db_path)
+        # power_ledger inserts are group-committed in the background
+        self.ledger = LedgerWriter(self._connect)
+        atexit.register(self.ledger.close)
+        # ... and so are request_usage rows
+        self.usage = LedgerWriter(self._connect, insert=USAGE_INSERT, name="usage")
+        atexit.register(self.usage.close)
+        root, ext = os.path.splitext(db_path)
+        self.ledger_compactor = LedgerCompactor(
+            db_path, os.getenv("LEDGER_ARCHIVE_PATH", f"{root}-archive{ext or '.db'}")
+        )
+
+    # --- Connection Pool ---
+
+    def _connect(self) -> sqlite3.Connection:
+        """This thread's pooled connection (`with self._connect() as conn:` commits but keeps it open)."""
+        return self._pool.connect()
+
+    # --- Config/Model Cache ---
+
+    def _cache_version(self):
+        """
+        Cross-worker invalidation signal: every invalidation atomically replaces
+        the version file, so its (inode, mtime) changes. One os.stat per read is
+        far cheaper than a SQLite round-trip.
+        """
+        try:
+            st = os.stat(self._cache_version_path)
+            return (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
 
-    def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # --- 1. Users Table Update ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    email TEXT UNIQUE,
-                    is_admin BOOLEAN DEFAULT 0,
-                    power_balance INTEGER DEFAULT 500,
-                    ip_address TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            self._add_column_if_not_exists(cursor, "users", "email", "TEXT UNIQUE")
-            self._add_column_if_not_exists(cursor, "users", "power_balance", "INTEGER DEFAULT 500")
-            self._add_column_if_not_exists(cursor, "users", "ip_address", "TEXT")
-            self._add_column_if_not_exists(cursor, "users", "created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-
-            # --- 2. User Data (Settings/Chars) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_data (
-                    user_id INTEGER,
-                    data_type TEXT NOT NULL,
-                    json_content TEXT NOT NULL,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (user_id, data_type),
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # --- 3. AI Models (Admin Managed) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS ai_models (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    model_id TEXT NOT NULL, 
-                    provider TEXT NOT NULL, 
-                    api_url TEXT,
-                    api_key TEXT,
-                    power_cost INTEGER DEFAULT 15,
-                    context_length INTEGER DEFAULT 4096,
-                    enabled BOOLEAN DEFAULT 1
-                )
-            ''')
-            
-            # --- 4. Power Ledger (Audit Log) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS power_ledger (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    change INTEGER NOT NULL, 
-                    balance_after INTEGER NOT NULL,
-                    reason TEXT NOT NULL, 
-                    model_id INTEGER,
-                    request_id TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )
-            ''')
-            
-            # --- 5. Verification Codes (Temp) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS verification_codes (
-                    email TEXT NOT NULL,
-                    code TEXT NOT NULL,
-                    ip TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    is_used BOOLEAN DEFAULT 0
-                )
-            ''')
-
-            # --- 6. Recharge Codes (CD-Keys) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS recharge_codes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    value INTEGER NOT NULL,
-                    is_used BOOLEAN DEFAULT 0,
-                    used_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    used_at TIMESTAMP
-                )
-            ''')
-
-            # --- 7. System Config (Shop Text, etc) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS system_config (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
-            ''')
-
-            # --- 8. Invite Codes (New Registration Method) ---
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS invite_codes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    memo TEXT,
-                    is_used BOOLEAN DEFAULT 0,
-                    used_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    used_at TIMESTAMP
-                )
-            ''')
-
-            # Ensure Admin exists
-            cursor.execute("SELECT * FROM users WHERE username = 'admin'")
-            if not cursor.fetchone():
-                cursor.execute("INSERT INTO users (username, password, is_admin, power_balance, email) VALUES (?, ?, ?, ?, ?)", 
-                             ('admin', 'admin123', 1, 9999999, 'admin@localhost'))
-            
-            # Ensure Default Models exist
-            cursor.execute("SELECT count(*) FROM ai_models")
-            if cursor.fetchone()[0] == 0:
-                default_models = [
-                    ('GPT-3.5 Turbo', 'gpt-3.5-turbo', 'openai', 'https://api.openai.com/v1', '', 15, 16385),
-                    ('GPT-4o', 'gpt-4o', 'openai', 'https://api.openai.com/v1', '', 150, 128000),
-                    ('DeepSeek Chat', 'deepseek-chat', 'openai', 'https://api.deepseek.com', '', 10, 32000),
-                ]
-                cursor.executemany(
-                    "INSERT INTO ai_models (name, model_id, provider, api_url, api_key, power_cost, context_length) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    default_models
-                )
-
-            # Ensure Default Config
-            cursor.execute("INSERT OR IGNORE INTO system_config (key, value) VALUES (?, ?)", 
-                           ("shop_notice", "请联系管理员购买充值卡。\n支持支付宝/微信。\n(管理员可在后台修改此公告)"))
-            cursor.execute("INSERT OR IGNORE INTO system_config (key, value) VALUES (?, ?)", 
-                           ("registration_enabled", "true"))
-
-            conn.commit()
-
-    def _add_column_if_not_exists(self, cursor, table, column, definition):
+    def _cached(self, key, loader):
+        stamp = self._cache_version()
+        with self._cache_lock:
+            if stamp != self._cache_stamp:
+                # Another worker (or this one) changed config/models
+                self._cache.clear()
+                self._cache_generation += 1
+                self._cache_stamp = stamp
+            if key in self._cache:
+                return self._cache[key]
+            generation = self._cache_generation
+
+        value = loader()
+        with self._cache_lock:
+            # Don't store a value that was loaded across an invalidation
+            if generation == self._cache_generation:
+                self._cache[key] = value
+        return value
+
+    def _invalidate_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_generation += 1
+        tmp_path = f"{self._cache_version_path}.{os.getpid()}.tmp"
         try:
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
-        except sqlite3.OperationalError:
-            pass # Column likely exists
+            with open(tmp_path, "w") as f:
+                f.write(str(time.time_ns()))
+            os.replace(tmp_path, self._cache_version_path)
+        except OSError as e:
+            logger.error(f"Failed to publish cache invalidation: {e}")
+
+    def close(self):
+        """Flushes the ledger/usage queues and closes every pooled connection (call on shutdown)."""
+        self.ledger.close()
+        self.usage.close()
+        self.user_data.close()
+        self._pool.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            version = run_migrations(conn)
+            logger.info(f"Database schema at version {version}")
 
     # --- User Management ---
 
@@ -163,42 +116,37 @@ class Database:
             return False # Locked
 
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
                     "INSERT INTO users (username, password, email, ip_address, power_balance) VALUES (?, ?, ?, ?, ?)", 
                     (username, password, email, ip_address, 500)
                 )
                 user_id = cursor.lastrowid
-                
-                # Initial Ledger Entry
-                cursor.execute(
-                    "INSERT INTO power_ledger (user_id, change, balance_after, reason) VALUES (?, ?, ?, ?)",
-                    (user_id, 500, 500, 'init')
-                )
                 conn.commit()
-                return True
         except sqlite3.IntegrityError:
             return False
 
+        # Initial Ledger Entry
+        self.ledger.append(user_id, 500, 500, 'init')
+        return True
+
     def get_user_by_auth(self, username, password):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
             row = cursor.fetchone()
             return dict(row) if row else None
 
     def get_user_by_id(self, user_id):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
 
     def check_ip_registered(self, ip):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT count(*) FROM users WHERE ip_address = ?", (ip,))
             return cursor.fetchone()[0] > 0
@@ -206,17 +154,16 @@ class Database:
     # --- Verification Codes ---
     
     def save_verification_code(self, email, code, ip, expires_at):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO verification_codes (email, code, ip, expires_at) VALUES (?, ?, ?, ?)",
-                (email, code, ip, expires_at)
+                "INSERT INTO verification_codes (email, code, ip, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (email, code, ip, time.time(), expires_at)
             )
             conn.commit()
 
     def get_valid_code(self, email, code):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM verification_codes WHERE email = ? AND code = ? AND is_used = 0 AND expires_at > ?",
@@ -225,7 +172,7 @@ class Database:
             return cursor.fetchone()
 
     def mark_code_used(self, email, code):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE verification_codes SET is_used = 1 WHERE email = ? AND code = ?",
@@ -235,7 +182,7 @@ class Database:
 
     def get_ip_code_stats(self, ip):
         now = time.time()
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT created_at FROM verification_codes WHERE ip = ? AND created_at > ?", (ip, now - 86400))
             timestamps = [row[0] for row in cursor.fetchall()] 
@@ -248,50 +195,199 @@ class Database:
 
     # --- Power System ---
 
+    def _take_power(self, cursor, user_id, amount):
+        """
+        Single conditional UPDATE, so concurrent requests (even from other
+        gunicorn workers) can never overdraw. Returns the new balance,
+        None for admins (never charged), or False if the balance is too low.
+        """
+        cursor.execute(
+            "UPDATE users SET power_balance = power_balance - ? WHERE id = ? AND is_admin = 0 AND power_balance >= ?",
+            (amount, user_id, amount)
+        )
+        if cursor.rowcount == 1:
+            cursor.execute("SELECT power_balance FROM users WHERE id = ?", (user_id,))
+            return cursor.fetchone()[0]
+
+        cursor.execute("SELECT is_admin FROM users WHERE id = ?", (user_id,))
+        user = cursor.fetchone()
+        if user and user['is_admin']:
+            return None
+        return False
+
     def deduct_power(self, user_id, amount, reason="chat", model_id=None):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
+            new_balance = self._take_power(conn.cursor(), user_id, amount)
+        if new_balance is False:
+            return False
+        if new_balance is not None:
+            self.ledger.append(user_id, -amount, new_balance, reason, model_id=model_id)
+        return True
+
+    def reserve_power(self, user_id, amount, model_id=None):
+        """
+        Holds `amount` power for one request (the most it can cost).
+        Returns a reservation id, or None if the balance is too low.
+        Finish with settle_reservation (charge actual usage, release the rest).
+        """
+        reservation_id = uuid.uuid4().hex
+        with self._connect() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("SELECT power_balance, is_admin FROM users WHERE id = ?", (user_id,))
-            user = cursor.fetchone()
-            if not user: return False
-            
-            if user['is_admin']: return True
-                
-            if user['power_balance'] < amount:
-                return False
-                
-            new_balance = user['power_balance'] - amount
-            
-            cursor.execute("UPDATE users SET power_balance = ? WHERE id = ?", (new_balance, user_id))
-            
+            new_balance = self._take_power(cursor, user_id, amount)
+            if new_balance is False:
+                return None
+            held = 0 if new_balance is None else amount # Admins hold nothing
             cursor.execute(
-                "INSERT INTO power_ledger (user_id, change, balance_after, reason, model_id) VALUES (?, ?, ?, ?, ?)",
-                (user_id, -amount, new_balance, reason, model_id)
+                "INSERT INTO power_reservations (id, user_id, model_id, amount, created_at) VALUES (?, ?, ?, ?, ?)",
+                (reservation_id, user_id, model_id, held, time.time())
             )
-            conn.commit()
-            return True
+
+        if held:
+            self.ledger.append(user_id, -held, new_balance, "chat", model_id=model_id, request_id=reservation_id)
+        return reservation_id
+
+    def settle_reservation(self, reservation_id, charge=0, reason="settle", usage=None):
+        """
+        Finalizes a reservation: keeps min(charge, held) and returns the rest
+        to the user. charge=0 is a full refund. Idempotent - only the first
+        call for a reservation has any effect. Returns the amount charged,
+        or None if the reservation was already settled.
+        usage = (prompt_tokens, completion_tokens, source) also records the
+        request in request_usage.
+        """
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE power_reservations SET status = 'settled', charged = MIN(amount, MAX(?, 0)), settled_at = ? "
+                "WHERE id = ? AND status = 'held'",
+                (int(charge), time.time(), reservation_id)
+            )
+            if cursor.rowcount == 0:
+                return None
+
+            cursor.execute("SELECT user_id, model_id, amount, charged FROM power_reservations WHERE id = ?", (reservation_id,))
+            res = cursor.fetchone()
+            release = res['amount'] - res['charged']
+            if release > 0:
+                cursor.execute("UPDATE users SET power_balance = power_balance + ? WHERE id = ?", (release, res['user_id']))
+                cursor.execute("SELECT power_balance FROM users WHERE id = ?", (res['user_id'],))
+                new_balance = cursor.fetchone()[0]
+
+        if release > 0:
+            self.ledger.append(res['user_id'], release, new_balance, reason,
+                               model_id=res['model_id'], request_id=reservation_id)
+        if usage:
+            prompt_tokens, completion_tokens, source = usage
+            self.usage.put((reservation_id, res['user_id'], res['model_id'], prompt_tokens, completion_tokens,
+                            source, reason, res['charged'], time.time()))
+        reservation_settlements.inc(reason=reason)
+        return res['charged']
 
     def refund_power(self, user_id, amount, reason="refund"):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET power_balance = power_balance + ? WHERE id = ?", (amount, user_id))
             
             cursor.execute("SELECT power_balance FROM users WHERE id = ?", (user_id,))
             new_balance = cursor.fetchone()[0]
-            
-            cursor.execute(
-                "INSERT INTO power_ledger (user_id, change, balance_after, reason) VALUES (?, ?, ?, ?)",
-                (user_id, amount, new_balance, reason)
-            )
             conn.commit()
 
+        self.ledger.append(user_id, amount, new_balance, reason)
+
+    # --- Reservation Maintenance ---
+
+    def reap_reservations(self, stale_seconds=3600, retention_days=7, batch_rows=1000):
+        """
+        Refunds reservations still held after `stale_seconds` (their request
+        died with its worker, so nothing will settle them) and deletes
+        settled ones older than `retention_days` - at most `batch_rows` of
+        each. Returns {'refunded', 'pruned', 'more'}.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            # idx_power_reservations_held: only the held rows are scanned
+            stale = [row[0] for row in conn.execute(
+                "SELECT id FROM power_reservations WHERE status = 'held' AND created_at < ? ORDER BY created_at LIMIT ?",
+                (now - stale_seconds, batch_rows)
+            )]
+        # Through settle_reservation: a request that settles meanwhile wins, and the refund is ledgered
+        refunded = sum(self.settle_reservation(rid, 0, reason="refund_stale") is not None for rid in stale)
+        with self._connect() as conn:
+            pruned = conn.execute(
+                "DELETE FROM power_reservations WHERE id IN (SELECT id FROM power_reservations "
+                "WHERE status = 'settled' AND settled_at < ? LIMIT ?)",
+                (now - retention_days * 86400, batch_rows)
+            ).rowcount
+        return {"refunded": refunded, "pruned": pruned, "more": len(stale) == batch_rows or pruned == batch_rows}
+
+    # --- Ledger Maintenance ---
+
+    def compact_ledger(self, retention_days=30, batch_rows=5000):
+        """Archives one batch of ledger rows older than retention_days (see LedgerCompactor)."""
+        self.ledger.flush()
+        return self.ledger_compactor.compact(retention_days, batch_rows)
+
+    def acquire_lease(self, name, seconds):
+        """
+        Takes (or renews) the lease on a background job for `seconds`, so
+        only one gunicorn worker runs it. False if another process holds
+        an unexpired lease.
+        """
+        now = time.time()
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO job_leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE job_leases.expires_at <= ? OR job_leases.owner = excluded.owner",
+                (name, owner, now + seconds, now)
+            )
+            return cursor.rowcount == 1
+
+    def reconcile_balance(self, user_id):
+        """
+        Recomputes a user's balance from their latest snapshot plus every ledger
+        row after it. Returns {'expected', 'ledger', 'actual', 'ok'}.
+        """
+        self.ledger.flush()
+        with self._connect() as conn:
+            snap = conn.execute(
+                "SELECT balance, ledger_id FROM balance_snapshots b WHERE user_id = ? "
+                "AND EXISTS (SELECT 1 FROM power_ledger x WHERE x.id = b.ledger_id) "
+                "ORDER BY ledger_id DESC LIMIT 1",
+                (user_id,)
+            ).fetchone()
+            if snap:
+                base, after_id = snap['balance'], snap['ledger_id']
+            else:
+                # The balance before the user's first row (0 unless they predate the ledger)
+                first = conn.execute(
+                    "SELECT balance_after - change FROM power_ledger WHERE user_id = ? ORDER BY id LIMIT 1", (user_id,)
+                ).fetchone()
+                base, after_id = (first[0] if first else 0), 0
+            changes = conn.execute(
+                "SELECT COALESCE(SUM(change), 0) FROM power_ledger WHERE user_id = ? AND id > ?",
+                (user_id, after_id)
+            ).fetchone()[0]
+            last = conn.execute(
+                "SELECT balance_after FROM power_ledger WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+            ).fetchone()
+            user = conn.execute("SELECT power_balance FROM users WHERE id = ?", (user_id,)).fetchone()
+
+        expected = base + changes
+        actual = user['power_balance'] if user else None
+        return {
+            "expected": expected,
+            "ledger": last['balance_after'] if last else None,
+            "actual": actual,
+            "ok": expected == actual,
+        }
+
     # --- Recharge System ---
     
     def create_recharge_codes(self, codes: List[Dict]):
         # codes = [{'code': 'ABC', 'value': 100}]
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.executemany(
                 "INSERT INTO recharge_codes (code, value) VALUES (:code, :value)",
@@ -303,8 +399,7 @@ class Database:
         """
         Returns (success, message, value)
         """
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             
             # Check code
@@ -326,19 +421,14 @@ class Database:
             # Get New Balance
             cursor.execute("SELECT power_balance FROM users WHERE id = ?", (user_id,))
             new_balance = cursor.fetchone()[0]
-            
-            # Ledger
-            cursor.execute(
-                "INSERT INTO power_ledger (user_id, change, balance_after, reason, request_id) VALUES (?, ?, ?, ?, ?)",
-                (user_id, amount, new_balance, 'recharge', code)
-            )
-            
             conn.commit()
-            return True, "Success", amount
+
+        # Ledger
+        self.ledger.append(user_id, amount, new_balance, 'recharge', request_id=code)
+        return True, "Success", amount
 
     def get_all_codes(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM recharge_codes ORDER BY created_at DESC")
             return [dict(r) for r in cursor.fetchall()]
@@ -347,7 +437,7 @@ class Database:
     
     def create_invite_codes(self, codes: List[Dict]):
         # codes = [{'code': 'INV-123', 'memo': 'For friend'}]
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.executemany(
                 "INSERT INTO invite_codes (code, memo) VALUES (:code, :memo)",
@@ -357,13 +447,13 @@ class Database:
 
     def check_invite_code(self, code):
         """Returns True if code is valid and unused"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id FROM invite_codes WHERE code = ? AND is_used = 0", (code,))
             return cursor.fetchone() is not None
 
     def mark_invite_code_used(self, code, user_id):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE invite_codes SET is_used = 1, used_by = ?, used_at = ? WHERE code = ?",
@@ -372,43 +462,52 @@ class Database:
             conn.commit()
 
     def get_all_invite_codes(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM invite_codes ORDER BY created_at DESC")
             return [dict(r) for r in cursor.fetchall()]
 
     # --- Config System ---
     def get_config(self, key):
-        with sqlite3.connect(self.db_path) as conn:
+        return self._cached(("config", key), lambda: self._load_config(key))
+
+    def _load_config(self, key):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT value FROM system_config WHERE key = ?", (key,))
             row = cursor.fetchone()
             return row[0] if row else None
 
     def set_config(self, key, value):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO system_config (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
+        self._invalidate_cache()
 
     # --- Model Management ---
 
     def get_models(self, include_secrets=False):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        # Copies, so callers can't mutate the cached rows
+        rows = [dict(r) for r in self._cached(("models",), self._load_models)]
+        if not include_secrets:
+            for r in rows:
+                del r['api_key']
+                del r['api_url']
+        return rows
+
+    def _load_models(self):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM ai_models WHERE enabled = 1")
-            rows = [dict(r) for r in cursor.fetchall()]
-            if not include_secrets:
-                for r in rows:
-                    del r['api_key']
-                    del r['api_url']
-            return rows
+            return [dict(r) for r in cursor.fetchall()]
 
     def get_model_by_id(self, model_id):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        row = self._cached(("model", model_id), lambda: self._load_model(model_id))
+        return dict(row) if row else None
+
+    def _load_model(self, model_id):
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM ai_models WHERE id = ?", (model_id,))
             row = cursor.fetchone()
@@ -421,46 +520,180 @@ class Database:
         
         set_clause = ", ".join([f"{k} = ?" for k in keys])
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f"UPDATE ai_models SET {set_clause} WHERE id = ?", values)
             conn.commit()
+        self._invalidate_cache()
 
-    # --- User Data & Legacy ---
-    def save_user_data(self, user_id, data_type, content):
-        with sqlite3.connect(self.db_path) as conn:
+    # --- Model Endpoints (extra upstream URLs/keys per model) ---
+
+    MODEL_ENDPOINT_FIELDS = ("name", "api_url", "api_key", "upstream_model", "weight", "enabled", "max_concurrency")
+
+    def get_model_endpoints(self, model_id, include_disabled=False):
+        rows = [dict(r) for r in self._cached(("endpoints", model_id), lambda: self._load_model_endpoints(model_id))]
+        if not include_disabled:
+            rows = [r for r in rows if r['enabled']]
+        return rows
+
+    def _load_model_endpoints(self, model_id):
+        with self._connect() as conn:
             cursor = conn.cursor()
-            json_str = json.dumps(content)
-            cursor.execute('''
-                INSERT INTO user_data (user_id, data_type, json_content) 
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id, data_type) 
-                DO UPDATE SET json_content = excluded.json_content, updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, data_type, json_str))
-            conn.commit()
+            cursor.execute("SELECT * FROM model_endpoints WHERE model_id = ? ORDER BY id", (model_id,))
+            return [dict(r) for r in cursor.fetchall()]
 
-    def get_user_data(self, user_id, data_type):
-        with sqlite3.connect(self.db_path) as conn:
+    def add_model_endpoint(self, model_id, endpoint: Dict[str, Any]):
+        keys = [k for k in self.MODEL_ENDPOINT_FIELDS if k in endpoint]
+        with self._connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT json_content FROM user_data WHERE user_id = ? AND data_type = ?", (user_id, data_type))
-            row = cursor.fetchone()
-            if row:
-                return json.loads(row[0])
-            return None
+            cursor.execute(
+                f"INSERT INTO model_endpoints (model_id, {', '.join(keys)}) VALUES (?{', ?' * len(keys)})",
+                [model_id] + [endpoint[k] for k in keys]
+            )
+            endpoint_id = cursor.lastrowid
+        self._invalidate_cache()
+        return endpoint_id
 
-    def get_all_users_full_data(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+    def update_model_endpoint(self, model_id, endpoint_id, updates: Dict[str, Any]):
+        keys = [k for k in self.MODEL_ENDPOINT_FIELDS if k in updates]
+        if not keys:
+            return False
+        set_clause = ", ".join([f"{k} = ?" for k in keys])
+        with self._connect() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("SELECT id, username, password, email, is_admin, power_balance, ip_address FROM users")
-            users = [dict(row) for row in cursor.fetchall()]
-            
+            cursor.execute(
+                f"UPDATE model_endpoints SET {set_clause} WHERE id = ? AND model_id = ?",
+                [updates[k] for k in keys] + [endpoint_id, model_id]
+            )
+            changed = cursor.rowcount > 0
+        self._invalidate_cache()
+        return changed
+
+    def delete_model_endpoint(self, model_id, endpoint_id):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM model_endpoints WHERE id = ? AND model_id = ?", (endpoint_id, model_id))
+            deleted = cursor.rowcount > 0
+        self._invalidate_cache()
+        return deleted
+
+    # --- User Data & Legacy ---
+    def save_user_data(self, user_id, data_type, content):
+        self.user_data.save(user_id, data_type, json.dumps(content))
+
+    def get_user_data(self, user_id, data_type):
+        content = self.user_data.load(user_id, data_type)
+        if content is not None:
+            return json.loads(content)
+        return None
+
+    def get_user_data_many(self, user_ids: List[int], data_types: Optional[List[str]] = None,
+                           raw: bool = False) -> Dict[int, Dict[str, Any]]:
+        """
+        Blobs for many users at once: {user_id: {data_type: content}}.
+        raw=True returns the stored JSON text without parsing it.
+        """
+        result: Dict[int, Dict[str, Any]] = {uid: {} for uid in user_ids}
+        if not user_ids or data_types == []:
+            return result
+
+        for user_id, data_type, json_content in self.user_data.load_many(user_ids, data_types):
+            result[user_id][data_type] = json_content if raw else json.loads(json_content)
+        return result
+
+    # --- Admin User Listing ---
+
+    def list_users(self, after_id: int = 0, limit: int = 100, search: Optional[str] = None,
+                   is_admin: Optional[bool] = None, fields: Optional[List[str]] = None,
+                   include_data: bool = True, data_types: Optional[List[str]] = None,
+                   raw_data: bool = False):
+        """
+        Keyset-paginated user listing (WHERE id > after_id ORDER BY id).
+        Returns (users, next_after_id); next_after_id is None on the last page.
+        - fields: subset of USER_LIST_FIELDS ('id' is always included)
+        - include_data / data_types: attach user_data blobs (all, some or none)
+        """
+        columns = ["id"] + [f for f in (fields or USER_LIST_FIELDS) if f in USER_LIST_FIELDS and f != "id"]
+        limit = max(1, min(int(limit), 1000))
+
+        sql = f"SELECT {', '.join(columns)} FROM users WHERE id > ?"
+        params: List[Any] = [after_id]
+        if search:
+            sql += " AND (username LIKE ? OR email LIKE ?)"
+            params.extend([f"%{search}%", f"%{search}%"])
+        if is_admin is not None:
+            sql += " AND is_admin = ?"
+            params.append(1 if is_admin else 0)
+        sql += " ORDER BY id LIMIT ?"
+        params.append(limit)
+
+        with self._connect() as conn:
+            users = [dict(row) for row in conn.execute(sql, params)]
+
+        if include_data and users:
+            blobs = self.get_user_data_many([u['id'] for u in users], data_types, raw=raw_data)
             for user in users:
-                cursor.execute("SELECT data_type, json_content FROM user_data WHERE user_id = ?", (user['id'],))
-                data_rows = cursor.fetchall()
-                user['data'] = {row[0]: json.loads(row[1]) for row in data_rows}
-                
-            return users
+                user['data'] = blobs[user['id']]
+
+        next_after_id = users[-1]['id'] if len(users) == limit else None
+        return users, next_after_id
+
+# Columns the admin listing may project
+USER_LIST_FIELDS = ("id", "username", "password", "email", "is_admin", "power_balance", "ip_address", "created_at")
+
+class AsyncDatabase:
+    """
+    Awaitable facade over Database with the same method names.
+    Every call runs on a small dedicated thread pool, so SQLite I/O
+    (commits, fsync, busy waits) never blocks the event loop and the
+    SSE streams it is serving.
+    """
+    def __init__(self, database: Database, max_workers: int = 4):
+        self._db = database
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created lazily so each gunicorn worker gets its own threads after fork
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self._max_workers,
+                        thread_name_prefix="db"
+                    )
+        return self._executor
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            # Timed on the DB thread, so it measures the query rather than the queue
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                db_call_seconds.observe(time.perf_counter() - started, method=name)
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._get_executor(), functools.partial(timed, *args, **kwargs)
+            )
+
+        # Cache the wrapper so the lookup only happens once per method
+        setattr(self, name, call)
+        return call
+
+    def shutdown(self):
+        """Waits for queued queries to finish, then stops the pool."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
 db = Database()
+async_db = AsyncDatabase(db, max_workers=int(os.getenv("DB_THREADS", "4")))
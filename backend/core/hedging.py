@@ -0,0 +1,54 @@
+import collections
+import math
+import os
+from typing import Any, Deque, Dict, Optional
+
+class HedgePolicy:
+    """
+    Tail-latency hedging for streamed chat requests (opt-in per model via
+    ai_models.hedge_percentile, e.g. 95). If the first upstream byte hasn't
+    arrived after that percentile of the model's recent TTFTs, a duplicate
+    request goes to another endpoint and whichever streams first wins.
+
+    Hedges are paid for out of a budget: every request on a hedging model
+    earns HEDGE_BUDGET (default 0.05) credits, up to HEDGE_BUDGET_BURST, and
+    each hedge costs one - so at most ~5% extra upstream requests.
+    """
+    def __init__(self):
+        self.budget_ratio = float(os.getenv("HEDGE_BUDGET", "0.05"))
+        self.burst = float(os.getenv("HEDGE_BUDGET_BURST", "5"))
+        self.min_samples = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+        self.min_delay = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "0.05"))
+        self.window = int(os.getenv("HEDGE_TTFT_WINDOW", "200"))
+        self._credits = 0.0
+        self._ttft: Dict[Any, Deque[float]] = {}
+
+    def observe_ttft(self, model_key, seconds: float):
+        samples = self._ttft.get(model_key)
+        if samples is None:
+            samples = self._ttft[model_key] = collections.deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def hedge_after(self, model_config: Dict[str, Any]) -> Optional[float]:
+        """Seconds to wait for the first byte before hedging; None = don't hedge."""
+        percentile = model_config.get('hedge_percentile') or 0
+        if percentile <= 0:
+            return None
+        samples = self._ttft.get(model_config['id'])
+        if not samples or len(samples) < self.min_samples:
+            return None  # Not enough history to know what "slow" is yet
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))
+        return max(self.min_delay, ordered[index])
+
+    def earn(self):
+        """Credits the budget for one request on a hedging model."""
+        self._credits = min(self.burst, self._credits + self.budget_ratio)
+
+    def try_spend(self) -> bool:
+        if self._credits < 1:
+            return False
+        self._credits -= 1
+        return True
+
+hedge_policy = HedgePolicy()
@@ -0,0 +1,330 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LEDGER_INSERT = (
+    "INSERT INTO power_ledger (user_id, change, balance_after, reason, model_id, request_id, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+USAGE_INSERT = (
+    "INSERT INTO request_usage (request_id, user_id, model_id, prompt_tokens, completion_tokens, "
+    "source, reason, charged, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+class LedgerWriter:
+    """
+    Write-behind queue for power_ledger rows (group commit).
+
+    Balance updates stay synchronous in Database; only the audit rows are
+    queued here. A background thread collects rows from many requests and
+    inserts them in one transaction every `flush_interval` seconds or every
+    `batch_size` rows, so N chat messages cost one commit instead of N.
+    With another `insert` statement it serves other append-only tables
+    (request_usage) the same way, via put().
+
+    Ledger rows get their balance_after when they are written, chained from
+    the user's previous row in the same write transaction: rows from
+    concurrent requests (or other workers) are queued in no particular
+    order relative to their balance commits, so the caller's balance is
+    only used for a user's very first row.
+    """
+    def __init__(self, connect: Callable[[], sqlite3.Connection],
+                 batch_size: int = 500, flush_interval: float = 0.005,
+                 insert: str = LEDGER_INSERT, name: str = "ledger"):
+        self._connect = connect # Returns the calling thread's pooled connection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.insert = insert
+        self.name = name
+        self.chain_balances = insert == LEDGER_INSERT
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def append(self, user_id, change, balance_after, reason, model_id=None, request_id=None):
+        # Timestamp now, not at flush time (same format as CURRENT_TIMESTAMP)
+        created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self.put((user_id, change, balance_after, reason, model_id, request_id, created_at))
+
+    def put(self, row: Tuple):
+        """Queues one row for `insert`."""
+        self._ensure_started()
+        self._queue.put(row)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every row queued so far is committed."""
+        if not self._is_running():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Flushes the queue durably and stops the writer thread."""
+        if not self._is_running():
+            return
+        self._queue.put(None) # Stop sentinel (processed after queued rows)
+        self._thread.join()
+        self._thread = None
+        try:
+            # synchronous=NORMAL only syncs on checkpoint - force one now
+            self._connect().execute("PRAGMA wal_checkpoint(FULL)")
+        except sqlite3.Error as e:
+            logger.error(f"{self.name.capitalize()} checkpoint failed: {e}")
+
+    # --- Internals ---
+
+    def _is_running(self) -> bool:
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_started(self):
+        if self._is_running():
+            return
+        with self._lock:
+            if self._is_running():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                # Forked worker: the parent's thread and queue did not survive
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch: List[Tuple] = []
+            waiters: List[threading.Event] = []
+            stop = False
+
+            # Gather everything that arrives within the flush window
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+
+                if stop or waiters or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                # Drain anything enqueued after the sentinel, then exit
+                leftovers = []
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    elif item is not None:
+                        leftovers.append(item)
+                if leftovers:
+                    self._write(leftovers)
+                return
+
+    def _write(self, batch: List[Tuple]):
+        for attempt in range(3):
+            conn = self._connect()
+            try:
+                # IMMEDIATE: the previous balances read below can't change before the insert
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(self.insert, self._chain(conn, batch) if self.chain_balances else batch)
+                conn.commit()
+                return
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"{self.name.capitalize()} batch write failed (attempt {attempt + 1}): {e}")
+                time.sleep(0.05 * (attempt + 1))
+        # Never silently drop audit rows: leave them in the log
+        logger.error(f"Dropped {len(batch)} {self.name} rows: {batch}")
+
+    @staticmethod
+    def _chain(conn: sqlite3.Connection, batch: List[Tuple]) -> List[Tuple]:
+        """Ledger rows with balance_after = the user's previous balance_after + change."""
+        balances = {}
+        rows = []
+        for row in batch:
+            user_id, change, balance_after = row[:3]
+            if user_id not in balances:
+                last = conn.execute(
+                    "SELECT balance_after FROM power_ledger WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+                ).fetchone()
+                balances[user_id] = last[0] if last else None
+            previous = balances[user_id]
+            balance_after = balance_after if previous is None else previous + change
+            balances[user_id] = balance_after
+            rows.append((user_id, change, balance_after) + tuple(row[3:]))
+        return rows
+
+# --- Compaction / Archival ---
+
+SUMMARY_REASON = "daily_summary"
+
+class LedgerCompactor:
+    """
+    Keeps power_ledger small:
+    1. Raw rows older than the retention window are copied to an archive
+       database file (same columns, nothing is lost).
+    2. In the main DB they are replaced by one 'daily_summary' row per user
+       per day. The summary row reuses the id and balance_after of the last
+       raw row of that day, so ids stay ordered and balances stay chained.
+       Work is done in batches of raw rows (oldest first), one transaction
+       each; a day split between batches ends up as one row all the same.
+    3. A balance snapshot (balance + ledger id) is recorded per user, so a
+       balance can be reconciled from the snapshot plus later rows only.
+       Snapshots are derived from the previous one plus SUM(change).
+    """
+    def __init__(self, db_path: str, archive_path: str):
+        self.db_path = db_path
+        self.archive_path = archive_path
+
+    def compact(self, retention_days: int = 30, batch_rows: int = 5000) -> dict:
+        """
+        Compacts the oldest `batch_rows` raw rows past the retention window
+        in one short transaction, so billing writes only ever wait for one
+        batch. Call again while the result says "more"; snapshots are taken
+        by the call that finishes the backlog.
+        """
+        # Whole days only, so a day is never split between raw and summary rows
+        cutoff = time.strftime("%Y-%m-%d 00:00:00", time.gmtime(time.time() - retention_days * 86400))
+        now = time.time()
+
+        # A private connection: ATTACH must not leak into the shared pool
+        conn = sqlite3.connect(self.db_path, timeout=30.0)
+        try:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS archive.power_ledger (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    change INTEGER NOT NULL,
+                    balance_after INTEGER NOT NULL,
+                    reason TEXT NOT NULL,
+                    model_id INTEGER,
+                    request_id TEXT,
+                    created_at TIMESTAMP
+                )
+            ''')
+            conn.commit()
+
+            conn.execute("BEGIN IMMEDIATE")
+            raw_filter = "created_at < ? AND reason != ?"
+            last_id, archived = conn.execute(
+                f"SELECT MAX(id), COUNT(*) FROM (SELECT id FROM main.power_ledger WHERE {raw_filter} ORDER BY id LIMIT ?)",
+                (cutoff, SUMMARY_REASON, batch_rows)
+            ).fetchone()
+            batch_filter = f"{raw_filter} AND id <= ?"
+            batch_args = (cutoff, SUMMARY_REASON, last_id)
+
+            summaries = 0
+            if archived:
+                # OR IGNORE: re-running after a partial failure must not duplicate rows
+                conn.execute(
+                    f"INSERT OR IGNORE INTO archive.power_ledger "
+                    f"SELECT id, user_id, change, balance_after, reason, model_id, request_id, created_at "
+                    f"FROM main.power_ledger WHERE {batch_filter}",
+                    batch_args
+                )
+                conn.execute("DROP TABLE IF EXISTS temp.ledger_summary")
+                conn.execute(f'''
+                    CREATE TEMP TABLE ledger_summary AS
+                    SELECT MAX(id) AS id, user_id, SUM(change) AS change, COUNT(*) AS n,
+                           date(created_at) || ' 23:59:59' AS created_at
+                    FROM main.power_ledger WHERE {batch_filter}
+                    GROUP BY user_id, date(created_at)
+                ''', batch_args)
+                conn.execute(f"DELETE FROM main.power_ledger WHERE {batch_filter}", batch_args)
+                # A day split across batches: fold the earlier batch's summary row into this one
+                earlier = (
+                    "FROM main.power_ledger e WHERE e.reason = ? AND e.user_id = ledger_summary.user_id "
+                    "AND e.created_at = ledger_summary.created_at AND e.id < ledger_summary.id"
+                )
+                conn.execute(f'''
+                    UPDATE temp.ledger_summary SET
+                        change = change + (SELECT e.change {earlier}),
+                        n = n + (SELECT CAST(substr(e.request_id, 6) AS INTEGER) {earlier})
+                    WHERE EXISTS (SELECT 1 {earlier})
+                ''', (SUMMARY_REASON,) * 3)
+                conn.execute('''
+                    DELETE FROM main.power_ledger WHERE reason = ? AND EXISTS (
+                        SELECT 1 FROM temp.ledger_summary s WHERE s.user_id = power_ledger.user_id
+                        AND s.created_at = power_ledger.created_at AND power_ledger.id < s.id
+                    )
+                ''', (SUMMARY_REASON,))
+                summaries = conn.execute('''
+                    INSERT INTO main.power_ledger (id, user_id, change, balance_after, reason, request_id, created_at)
+                    SELECT s.id, s.user_id, s.change, a.balance_after, ?, 'rows=' || s.n, s.created_at
+                    FROM temp.ledger_summary s JOIN archive.power_ledger a ON a.id = s.id
+                ''', (SUMMARY_REASON,)).rowcount
+                conn.execute("DROP TABLE temp.ledger_summary")
+
+            more = archived == batch_rows
+            snapshots = 0 if more else self._snapshot(conn, now)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if archived:
+            logger.info(f"Ledger compaction: archived {archived} rows into {summaries} daily summaries")
+        return {"archived": archived, "summaries": summaries, "snapshots": snapshots, "cutoff": cutoff, "more": more}
+
+    @staticmethod
+    def _snapshot(conn: sqlite3.Connection, now: float) -> int:
+        """
+        Checkpoints every user's balance at their latest ledger row: the
+        previous snapshot plus SUM(change) of the rows after it - no single
+        row's balance_after is trusted. Only snapshots whose row is still
+        in the main ledger count (one inside a day that was summarised since
+        would have part of the summary's change in it twice); without one,
+        the sum starts from the balance before the user's first row.
+        Snapshots that no longer qualify are dropped afterwards.
+        """
+        snapshots = conn.execute('''
+            INSERT INTO main.balance_snapshots (user_id, balance, ledger_id, taken_at)
+            SELECT last.user_id, COALESCE(
+                (SELECT b.balance + (SELECT COALESCE(SUM(l.change), 0) FROM main.power_ledger l
+                                     WHERE l.user_id = last.user_id AND l.id > b.ledger_id AND l.id <= last.id)
+                 FROM main.balance_snapshots b
+                 WHERE b.user_id = last.user_id
+                   AND EXISTS (SELECT 1 FROM main.power_ledger x WHERE x.id = b.ledger_id)
+                 ORDER BY b.ledger_id DESC LIMIT 1),
+                (SELECT f.balance_after - f.change FROM main.power_ledger f
+                 WHERE f.user_id = last.user_id ORDER BY f.id LIMIT 1)
+                + (SELECT SUM(l.change) FROM main.power_ledger l WHERE l.user_id = last.user_id AND l.id <= last.id)
+            ), last.id, ?
+            FROM (SELECT user_id, MAX(id) AS id FROM main.power_ledger GROUP BY user_id) last
+            WHERE NOT EXISTS (
+                SELECT 1 FROM main.balance_snapshots b WHERE b.user_id = last.user_id AND b.ledger_id = last.id
+            )
+        ''', (now,)).rowcount
+        conn.execute(
+            "DELETE FROM main.balance_snapshots WHERE NOT EXISTS "
+            "(SELECT 1 FROM main.power_ledger x WHERE x.id = balance_snapshots.ledger_id)"
+        )
+        return snapshots
@@ -0,0 +1,430 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Counter:
+    """
+    Monotonic in-process counter with optional labels, e.g.
+        abandoned_generations.inc(model="gpt-4o")
+    Values are per worker process; see MetricsStore for the merged view.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def set_total(self, value: float, **labels):
+        """For a total counted elsewhere and published by a collector."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[Tuple[Dict[str, str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(dict(zip(self.labelnames, key)), value) for key, value in items]
+
+    def dump(self) -> Dict:
+        with self._lock:
+            items = [[list(key), value] for key, value in self._values.items()]
+        return {"type": self.kind, "help": self.help_text, "labels": list(self.labelnames), "samples": items}
+
+class Gauge(Counter):
+    """Value that goes up and down (queue depth, in-flight requests)."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def clear(self):
+        """Drops every series (for gauges rebuilt from scratch by a collector)."""
+        with self._lock:
+            self._values.clear()
+
+# Seconds; suits both queue waits and upstream latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    """
+    Prometheus-style histogram with optional labels. Buckets are stored
+    non-cumulative (one bisect per observation) and summed up when rendered.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _series(self, key) -> List[float]:
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * (len(self.buckets) + 2)
+        return series
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series(key)
+            series[index] += 1
+            series[-1] += value
+
+    def observe_many(self, values: Iterable[float], **labels):
+        """observe() for a batch of values under one lock (e.g. every gap of a stream)."""
+        key = self._key(labels)
+        buckets = self.buckets
+        with self._lock:
+            series = self._series(key)
+            for value in values:
+                series[bisect.bisect_left(buckets, value)] += 1
+                series[-1] += value
+
+    def samples(self) -> List[Tuple[Dict[str, str], List[float]]]:
+        """(labels, [cumulative bucket counts..., count, sum]) per series."""
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._values.items()]
+        return [(dict(zip(self.labelnames, key)), _cumulative(series)) for key, series in items]
+
+    def dump(self) -> Dict:
+        with self._lock:
+            items = [[list(key), list(series)] for key, series in self._values.items()]
+        return {"type": self.kind, "help": self.help_text, "labels": list(self.labelnames),
+                "buckets": list(self.buckets), "samples": items}
+
+def _cumulative(series: List[float]) -> List[float]:
+    out, running = [], 0
+    for count in series[:-1]:
+        running += count
+        out.append(running)
+    return out + [series[-1]]
+
+REGISTRY: List = []
+
+# Called before every snapshot, to refresh gauges that are read rather than tracked
+COLLECTORS: List[Callable[[], None]] = []
+
+def collector(func: Callable[[], None]) -> Callable[[], None]:
+    COLLECTORS.append(func)
+    return func
+
+def _collect():
+    for func in COLLECTORS:
+        try:
+            func()
+        except Exception as e:
+            logger.warning(f"Metrics collector {func.__name__} failed: {e}")
+
+# --- Exposition ---
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+    return repr(value)
+
+_INF_BUCKET = 'le="+Inf"'
+
+def render(families: Dict[str, Dict]) -> str:
+    """Prometheus text format (version 0.0.4) for dump()-shaped metric families."""
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        names = family["labels"]
+        for values, sample in sorted(family["samples"], key=lambda s: s[0]):
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, values)} {_number(sample)}")
+                continue
+            cumulative = _cumulative(sample)
+            for bound, count in zip(family["buckets"], cumulative):
+                le = f'le="{_number(float(bound))}"'
+                lines.append(f"{name}_bucket{_labels(names, values, le)} {_number(count)}")
+            lines.append(f"{name}_bucket{_labels(names, values, _INF_BUCKET)} {_number(cumulative[-2])}")
+            lines.append(f"{name}_sum{_labels(names, values)} {_number(float(cumulative[-1]))}")
+            lines.append(f"{name}_count{_labels(names, values)} {_number(cumulative[-2])}")
+    return "\n".join(lines) + "\n"
+
+class MetricsStore:
+    """
+    Merges the metrics of every gunicorn worker. Each worker periodically
+    (METRICS_FLUSH_SECONDS) writes its registry to <directory>/<pid>.json;
+    a scrape, whichever worker serves it, adds up all files. Counters and
+    histograms of workers that have since exited keep counting (so totals
+    never go backwards on a worker restart) until their file is older than
+    METRICS_STALE_SECONDS; gauges only count for live workers.
+    """
+    def __init__(self):
+        self.directory: Optional[str] = None  # None = this worker only
+        self.flush_interval = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+        self.stale_after = float(os.getenv("METRICS_STALE_SECONDS", "86400"))
+
+    def configure(self, directory: Optional[str]):
+        self.directory = directory or None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def snapshot(self) -> Dict[str, Dict]:
+        _collect()
+        return {metric.name: metric.dump() for metric in REGISTRY}
+
+    def flush(self) -> Dict[str, Dict]:
+        """Writes this worker's snapshot (atomically) and returns it."""
+        families = self.snapshot()
+        if self.directory:
+            path = self._path(os.getpid())
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "time": time.time(), "metrics": families}, f)
+            os.replace(tmp, path)
+        return families
+
+    def _others(self) -> List[Tuple[bool, Dict[str, Dict]]]:
+        """(alive, families) of every other worker's latest snapshot; prunes stale files."""
+        found = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                pid = int(entry.name[:-5])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            alive = _pid_alive(pid)
+            try:
+                if not alive and now - entry.stat().st_mtime > self.stale_after:
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, encoding="utf-8") as f:
+                    found.append((alive, json.load(f)["metrics"]))
+            except (OSError, ValueError, KeyError) as e:
+                logger.debug(f"Skipping metrics file {entry.name}: {e}")
+        return found
+
+    def collect(self) -> Dict[str, Dict]:
+        """Every worker's metrics added up (this worker's are fresh, others' up to flush_interval old)."""
+        merged = self.flush()
+        if not self.directory:
+            return merged
+        for alive, families in self._others():
+            for name, family in families.items():
+                mine = merged.get(name)
+                if mine is None or mine["type"] != family["type"] or mine["labels"] != family["labels"]:
+                    continue  # Metric renamed/removed since that worker started
+                if family["type"] == "gauge" and not alive:
+                    continue
+                if family["type"] == "histogram" and mine["buckets"] != family["buckets"]:
+                    continue
+                _add_samples(mine, family["samples"])
+        return merged
+
+    def render(self) -> str:
+        return render(self.collect())
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _add_samples(family: Dict, samples: List):
+    index = {tuple(values): sample for values, sample in family["samples"]}
+    for values, sample in samples:
+        key = tuple(values)
+        mine = index.get(key)
+        if mine is None:
+            index[key] = list(sample) if isinstance(sample, list) else sample
+        elif isinstance(mine, list):
+            index[key] = [a + b for a, b in zip(mine, sample)]
+        else:
+            index[key] = mine + sample
+    family["samples"] = [[list(key), sample] for key, sample in index.items()]
+
+metrics_store = MetricsStore()
+
+# --- Chat ---
+
+request_duration_seconds = Histogram(
+    "litetavern_request_duration_seconds",
+    "Chat request time from arrival to the last byte of the reply",
+    ("model", "stream"),
+)
+ttft_seconds = Histogram(
+    "litetavern_ttft_seconds",
+    "Time from a streamed chat request's arrival to its first upstream bytes",
+    ("model",),
+)
+inter_chunk_seconds = Histogram(
+    "litetavern_inter_chunk_seconds",
+    "Gap between consecutive upstream chunks of a stream (about one per token)",
+    ("model",),
+    buckets=(0.001, 0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+stream_duration_seconds = Histogram(
+    "litetavern_stream_duration_seconds",
+    "Time from a stream's first to its last upstream chunk",
+    ("model",),
+)
+tokens_per_second = Histogram(
+    "litetavern_tokens_per_second",
+    "Completion tokens per second of a stream, after its first chunk",
+    ("model",),
+    buckets=(1, 5, 10, 20, 30, 40, 50, 75, 100, 150, 200, 300, 500),
+)
+stream_resumes = Counter(
+    "litetavern_stream_resumes_total",
+    "Reconnects to a buffered generation, by where it was found (local / spooled / missing)",
+    ("outcome",),
+)
+stream_buffer_bytes = Gauge(
+    "litetavern_stream_buffer_bytes",
+    "Memory held by buffered generations (for resumable streams)",
+)
+usage_tokens_total = Counter(
+    "litetavern_usage_tokens_total",
+    "Tokens of settled chat requests, by kind (prompt / completion)",
+    ("model", "kind"),
+)
+upstream_responses = Counter(
+    "litetavern_upstream_responses_total",
+    "Upstream chat attempts by HTTP status (\"error\" = no response)",
+    ("model", "endpoint", "status"),
+)
+
+abandoned_generations = Counter(
+    "litetavern_abandoned_generations_total",
+    "Chat generations cut short because the client disconnected",
+    ("model", "stream"),
+)
+
+hedged_requests = Counter(
+    "litetavern_hedged_requests_total",
+    "Slow streams that were considered for a hedge request, by outcome",
+    ("model", "outcome"),  # hedge_won / primary_won / failed / no_budget / no_endpoint
+)
+
+# --- Admission scheduler ---
+
+scheduler_queue_depth = Gauge(
+    "litetavern_scheduler_queue_depth",
+    "Chat requests waiting for a model/upstream slot",
+    ("model",),
+)
+scheduler_inflight = Gauge(
+    "litetavern_scheduler_inflight",
+    "Chat requests holding a model slot",
+    ("model",),
+)
+scheduler_wait_seconds = Histogram(
+    "litetavern_scheduler_wait_seconds",
+    "Time a chat request waited for admission",
+    ("model",),
+)
+scheduler_rejections = Counter(
+    "litetavern_scheduler_rejections_total",
+    "Chat requests turned away with 429 by the scheduler",
+    ("model", "reason"),
+)
+
+# --- Billing / database ---
+
+reservation_settlements = Counter(
+    "litetavern_reservation_settlements_total",
+    "Power reservations settled, by ledger reason (settle, settle_abandoned, refund_*)",
+    ("reason",),
+)
+db_call_seconds = Histogram(
+    "litetavern_db_call_seconds",
+    "Time spent in a Database method on the DB thread pool",
+    ("method",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+# --- Upstream connection pools ---
+
+upstream_pool_connections = Gauge(
+    "litetavern_upstream_pool_connections",
+    "Pooled upstream connections per origin, by state (active / idle)",
+    ("origin", "state"),
+)
+upstream_pool_waiting = Gauge(
+    "litetavern_upstream_pool_waiting",
+    "Upstream requests waiting for a pooled connection, per origin",
+    ("origin",),
+)
+upstream_pool_max_connections = Gauge(
+    "litetavern_upstream_pool_max_connections",
+    "Configured connection limit of each per-origin pool",
+    ("origin",),
+)
+
+# --- Tokenizer ---
+
+token_cache_lookups = Counter(
+    "litetavern_token_cache_lookups_total",
+    "Token-count cache lookups, by result (hit / miss)",
+    ("result",),
+)
+token_cache_entries = Gauge(
+    "litetavern_token_cache_entries",
+    "Texts whose token count is cached",
+)
+context_builds = Counter(
+    "litetavern_context_builds_total",
+    "Chat contexts built, by how the history was sized (estimated = UTF-8 ceiling fit, exact = encoded)",
+    ("mode",),
+)
@@ -0,0 +1,345 @@
+import logging
+import sqlite3
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- Helpers ---
+
+def column_exists(cursor, table, column) -> bool:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+def add_column(cursor, table, column, definition) -> bool:
+    """Adds a column unless it already exists. Real errors are raised, not swallowed."""
+    if column_exists(cursor, table, column):
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+# --- Migrations ---
+# Each step runs once, in order, inside the same transaction as its version bump.
+# Never edit a released step - append a new one.
+
+def _v1_baseline(cursor):
+    """Original schema + seed data. Idempotent, so it also adopts pre-migration databases."""
+    # --- 1. Users ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT UNIQUE,
+            is_admin BOOLEAN DEFAULT 0,
+            power_balance INTEGER DEFAULT 500,
+            ip_address TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Very old databases predate these columns.
+    # (SQLite can't ALTER-in a UNIQUE column or a CURRENT_TIMESTAMP default.)
+    if add_column(cursor, "users", "email", "TEXT"):
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email)")
+    add_column(cursor, "users", "power_balance", "INTEGER DEFAULT 500")
+    add_column(cursor, "users", "ip_address", "TEXT")
+    add_column(cursor, "users", "created_at", "TIMESTAMP")
+
+    # --- 2. User Data (Settings/Chars) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER,
+            data_type TEXT NOT NULL,
+            json_content TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, data_type),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # --- 3. AI Models (Admin Managed) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            model_id TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            api_url TEXT,
+            api_key TEXT,
+            power_cost INTEGER DEFAULT 15,
+            context_length INTEGER DEFAULT 4096,
+            enabled BOOLEAN DEFAULT 1
+        )
+    ''')
+
+    # --- 4. Power Ledger (Audit Log) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS power_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            change INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            model_id INTEGER,
+            request_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # --- 5. Verification Codes (Temp) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS verification_codes (
+            email TEXT NOT NULL,
+            code TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            is_used BOOLEAN DEFAULT 0
+        )
+    ''')
+
+    # --- 6. Recharge Codes (CD-Keys) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recharge_codes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            value INTEGER NOT NULL,
+            is_used BOOLEAN DEFAULT 0,
+            used_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_at TIMESTAMP
+        )
+    ''')
+
+    # --- 7. System Config (Shop Text, etc) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS system_config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+    # --- 8. Invite Codes (New Registration Method) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invite_codes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            memo TEXT,
+            is_used BOOLEAN DEFAULT 0,
+            used_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_at TIMESTAMP
+        )
+    ''')
+
+    # Ensure Admin exists
+    cursor.execute("SELECT * FROM users WHERE username = 'admin'")
+    if not cursor.fetchone():
+        cursor.execute("INSERT INTO users (username, password, is_admin, power_balance, email) VALUES (?, ?, ?, ?, ?)",
+                       ('admin', 'admin123', 1, 9999999, 'admin@localhost'))
+
+    # Ensure Default Models exist
+    cursor.execute("SELECT count(*) FROM ai_models")
+    if cursor.fetchone()[0] == 0:
+        default_models = [
+            ('GPT-3.5 Turbo', 'gpt-3.5-turbo', 'openai', 'https://api.openai.com/v1', '', 15, 16385),
+            ('GPT-4o', 'gpt-4o', 'openai', 'https://api.openai.com/v1', '', 150, 128000),
+            ('DeepSeek Chat', 'deepseek-chat', 'openai', 'https://api.deepseek.com', '', 10, 32000),
+        ]
+        cursor.executemany(
+            "INSERT INTO ai_models (name, model_id, provider, api_url, api_key, power_cost, context_length) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            default_models
+        )
+
+    # Ensure Default Config
+    cursor.execute("INSERT OR IGNORE INTO system_config (key, value) VALUES (?, ?)",
+                   ("shop_notice", "请联系管理员购买充值卡。\n支持支付宝/微信。\n(管理员可在后台修改此公告)"))
+    cursor.execute("INSERT OR IGNORE INTO system_config (key, value) VALUES (?, ?)",
+                   ("registration_enabled", "true"))
+
+def _v2_power_reservations(cursor):
+    """Reserve -> settle billing."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS power_reservations (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            model_id INTEGER,
+            amount INTEGER NOT NULL,
+            charged INTEGER,
+            status TEXT NOT NULL DEFAULT 'held',
+            created_at REAL NOT NULL,
+            settled_at REAL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    # 0 = flat power_cost per message, >0 = metered (capped at power_cost)
+    add_column(cursor, "ai_models", "power_per_1k_tokens", "INTEGER DEFAULT 0")
+
+def _v3_hot_path_indexes(cursor):
+    """Indexes for the per-request lookups (previously full table scans)."""
+    # verification_codes.created_at used to default to a text timestamp while
+    # get_ip_code_stats compares epoch seconds - convert old rows to epoch.
+    cursor.execute(
+        "UPDATE verification_codes SET created_at = CAST(strftime('%s', created_at) AS REAL) "
+        "WHERE typeof(created_at) = 'text'"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_verification_codes_ip_created ON verification_codes(ip, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_verification_codes_email_code ON verification_codes(email, code)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_ip_address ON users(ip_address)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_power_ledger_user ON power_ledger(user_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_power_reservations_held ON power_reservations(created_at) WHERE status = 'held'")
+
+def _v4_ledger_compaction(cursor):
+    """Balance checkpoints for ledger compaction (see LedgerCompactor)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL,
+            taken_at REAL NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_balance_snapshots_user ON balance_snapshots(user_id, ledger_id)")
+    # The compaction job selects by age
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_power_ledger_created ON power_ledger(created_at)")
+
+def _v5_model_endpoints(cursor):
+    """Extra upstream endpoints/keys per model (see backend/core/routing.py)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS model_endpoints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model_id INTEGER NOT NULL,
+            name TEXT,
+            api_url TEXT NOT NULL,
+            api_key TEXT,
+            upstream_model TEXT,
+            weight INTEGER DEFAULT 1,
+            enabled BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(model_id) REFERENCES ai_models(id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_model_endpoints_model ON model_endpoints(model_id)")
+    # 'weighted' = health-weighted round-robin, 'latency' = lowest TTFT first
+    add_column(cursor, "ai_models", "routing", "TEXT DEFAULT 'weighted'")
+    add_column(cursor, "ai_models", "primary_weight", "INTEGER DEFAULT 1")
+
+def _v6_concurrency_limits(cursor):
+    """In-flight caps for the admission scheduler (0 = unlimited)."""
+    add_column(cursor, "ai_models", "max_concurrency", "INTEGER DEFAULT 0")
+    add_column(cursor, "ai_models", "primary_max_concurrency", "INTEGER DEFAULT 0")
+    add_column(cursor, "model_endpoints", "max_concurrency", "INTEGER DEFAULT 0")
+
+def _v7_hedging(cursor):
+    """Opt-in hedged requests (see backend/core/hedging.py)."""
+    # TTFT percentile after which a duplicate request is sent; 0 = off
+    add_column(cursor, "ai_models", "hedge_percentile", "REAL DEFAULT 0")
+
+def _v8_request_usage(cursor):
+    """Token usage per chat request (written behind by Database.settle_reservation)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS request_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT,
+            user_id INTEGER NOT NULL,
+            model_id INTEGER,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            reason TEXT,
+            charged INTEGER,
+            created_at REAL NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    # source: 'upstream' (the provider's usage) or 'counted' (our tokenizer)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_usage_model_created ON request_usage(model_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_usage_user_created ON request_usage(user_id, created_at)")
+
+def _v9_job_leases(cursor):
+    """Leases for background jobs that only one worker should run (see Database.acquire_lease)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _v10_settled_reservations(cursor):
+    """Lets the reservation reaper find old settled rows without a scan (see Database.reap_reservations)."""
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_power_reservations_settled ON power_reservations(settled_at) WHERE status = 'settled'"
+    )
+
+def _v11_code_listing_indexes(cursor):
+    """
+    Replaces v3's partial code indexes - redemption lookups by code already
+    use the UNIQUE index - with ones for the admin listings' sort.
+    """
+    cursor.execute("DROP INDEX IF EXISTS idx_recharge_codes_unused")
+    cursor.execute("DROP INDEX IF EXISTS idx_invite_codes_unused")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_recharge_codes_created ON recharge_codes(created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_invite_codes_created ON invite_codes(created_at)")
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "baseline schema", _v1_baseline),
+    (2, "power reservations", _v2_power_reservations),
+    (3, "hot-path indexes", _v3_hot_path_indexes),
+    (4, "ledger compaction", _v4_ledger_compaction),
+    (5, "model endpoints", _v5_model_endpoints),
+    (6, "concurrency limits", _v6_concurrency_limits),
+    (7, "hedging", _v7_hedging),
+    (8, "request usage", _v8_request_usage),
+    (9, "job leases", _v9_job_leases),
+    (10, "settled reservation index", _v10_settled_reservations),
+    (11, "code listing indexes", _v11_code_listing_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# --- Runner ---
+
+def _current_version(cursor) -> int:
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    row = cursor.fetchone()
+    return row[0] or 0
+
+def run_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Brings the schema up to LATEST_VERSION and returns the resulting version.
+    When the schema is already current this is a single SELECT - no DDL.
+    Safe to call from several gunicorn workers at once.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    if _current_version(cursor) >= LATEST_VERSION:
+        return LATEST_VERSION
+
+    # Take the write lock first, then re-check: another worker may have just migrated
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        version = _current_version(cursor)
+        for step_version, name, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            logger.info(f"Applying schema migration {step_version}: {name}")
+            step(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (step_version, name))
+            version = step_version
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version
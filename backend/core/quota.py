@@ -0,0 +1,197 @@
+import collections
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Deque, Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """
+    x-ratelimit-reset-* value -> seconds from now. Accepts plain seconds
+    ("20", "0.5"), Go-style durations as sent by OpenAI ("6m0s", "1h2m3.5s",
+    "120ms") and ISO 8601 timestamps.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+        return sum(float(n) * scale[u] for n, u in parts)
+    try:
+        return max(0.0, datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time())
+    except ValueError:
+        return None
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(float(headers[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class KeyQuota:
+    """What we know about one upstream key's per-minute budget."""
+    __slots__ = ("sent", "sent_tokens", "limit_requests", "limit_tokens",
+                 "remaining_requests", "remaining_tokens", "reset_requests_at", "reset_tokens_at",
+                 "sent_since_observed", "tokens_since_observed")
+
+    def __init__(self):
+        self.sent: Deque[Tuple[float, int]] = collections.deque()  # (time, estimated tokens), last minute
+        self.sent_tokens = 0
+        # Learned from x-ratelimit-* headers (None until a response carried them)
+        self.limit_requests: Optional[int] = None
+        self.limit_tokens: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.reset_requests_at = 0.0
+        self.reset_tokens_at = 0.0
+        # Our own sends after that response - the headers don't include them yet
+        self.sent_since_observed = 0
+        self.tokens_since_observed = 0
+
+    def expire(self, now: float):
+        cutoff = now - WINDOW_SECONDS
+        while self.sent and self.sent[0][0] <= cutoff:
+            self.sent_tokens -= self.sent.popleft()[1]
+
+class QuotaTracker:
+    """
+    Per-upstream-key RPM/TPM accounting, so a request that would exceed the
+    provider's budget is held back (or routed to another key) instead of
+    being sent into a 429.
+
+    Two sources are used:
+    - while fresh (before their reset time), the provider's own
+      x-ratelimit-* headers (limit, remaining, reset), which also reflect
+      traffic from other workers and other clients of the key, minus what
+      this worker sent since they were observed;
+    - otherwise a one-minute sliding window of this worker's sends, checked
+      against the learned limits.
+    Limits are scaled by QUOTA_HEADROOM to leave room for estimation error.
+    Keys that never send the headers are not throttled.
+    """
+    def __init__(self):
+        self.headroom = float(os.getenv("QUOTA_HEADROOM", "0.95"))
+        self.max_delay = float(os.getenv("QUOTA_MAX_DELAY_SECONDS", "20"))
+        self._keys: Dict[str, KeyQuota] = {}
+
+    def _quota(self, slot: str) -> KeyQuota:
+        quota = self._keys.get(slot)
+        if quota is None:
+            quota = self._keys[slot] = KeyQuota()
+        return quota
+
+    def delay(self, slot: str, tokens: int) -> float:
+        """Seconds until `tokens` more (and one more request) fit this key's budget; 0 = send now."""
+        quota = self._keys.get(slot)
+        if quota is None:
+            return 0.0
+        now = time.monotonic()
+        quota.expire(now)
+        wait = 0.0
+
+        # Requests: the provider's numbers while fresh, else our own window
+        if quota.remaining_requests is not None and now < quota.reset_requests_at:
+            short = quota.sent_since_observed + 1 - quota.remaining_requests
+            if short > 0:
+                wait = max(wait, self._refill_time(short, quota.limit_requests, quota.reset_requests_at - now))
+        elif quota.limit_requests:
+            allowed = max(1, int(quota.limit_requests * self.headroom))
+            excess = len(quota.sent) + 1 - allowed
+            if excess > 0:
+                # Wait for the oldest `excess` sends to leave the window
+                wait = max(wait, quota.sent[min(excess, len(quota.sent)) - 1][0] + WINDOW_SECONDS - now)
+
+        # Tokens: same, against the request's estimate
+        if quota.remaining_tokens is not None and now < quota.reset_tokens_at:
+            short = quota.tokens_since_observed + tokens - quota.remaining_tokens
+            if short > 0:
+                wait = max(wait, self._refill_time(short, quota.limit_tokens, quota.reset_tokens_at - now))
+        elif quota.limit_tokens:
+            allowed = quota.limit_tokens * self.headroom
+            excess = quota.sent_tokens + tokens - allowed
+            if excess > 0 and tokens <= allowed:
+                freed = 0
+                for sent_at, sent_tokens in quota.sent:
+                    freed += sent_tokens
+                    if freed >= excess:
+                        wait = max(wait, sent_at + WINDOW_SECONDS - now)
+                        break
+        return max(0.0, wait)
+
+    def _refill_time(self, short: float, limit: Optional[int], until_reset: float) -> float:
+        """
+        Providers refill the budget continuously (reset = time until full),
+        so `short` units come back after about short / (limit per second) -
+        never later than the reset itself.
+        """
+        if not limit:
+            return until_reset
+        return min(until_reset, short / (limit * self.headroom / WINDOW_SECONDS))
+
+    def record(self, slot: str, tokens: int):
+        """Counts a request as sent (call right before sending it)."""
+        quota = self._quota(slot)
+        now = time.monotonic()
+        quota.expire(now)
+        quota.sent.append((now, tokens))
+        quota.sent_tokens += tokens
+        quota.sent_since_observed += 1
+        quota.tokens_since_observed += tokens
+
+    def observe(self, slot: str, headers: Mapping[str, str]):
+        """Updates a key's budget from an upstream response's x-ratelimit-* headers."""
+        limit_requests = _int_header(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _int_header(headers, "x-ratelimit-limit-tokens")
+        remaining_requests = _int_header(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _int_header(headers, "x-ratelimit-remaining-tokens")
+        if all(v is None for v in (limit_requests, limit_tokens, remaining_requests, remaining_tokens)):
+            return
+
+        quota = self._quota(slot)
+        now = time.monotonic()
+        if limit_requests:
+            quota.limit_requests = limit_requests
+        if limit_tokens:
+            quota.limit_tokens = limit_tokens
+        if remaining_requests is not None:
+            quota.remaining_requests = remaining_requests
+            reset = parse_reset(headers.get("x-ratelimit-reset-requests"))
+            quota.reset_requests_at = now + (reset if reset is not None else WINDOW_SECONDS)
+        if remaining_tokens is not None:
+            quota.remaining_tokens = remaining_tokens
+            reset = parse_reset(headers.get("x-ratelimit-reset-tokens"))
+            quota.reset_tokens_at = now + (reset if reset is not None else WINDOW_SECONDS)
+        # Requests sent before this response are (roughly) already counted in it
+        quota.sent_since_observed = 0
+        quota.tokens_since_observed = 0
+
+    def snapshot(self, slot: str) -> Optional[Dict[str, Optional[float]]]:
+        quota = self._keys.get(slot)
+        if quota is None:
+            return None
+        now = time.monotonic()
+        quota.expire(now)
+        return {
+            "window_requests": len(quota.sent),
+            "window_tokens": quota.sent_tokens,
+            "limit_requests": quota.limit_requests,
+            "limit_tokens": quota.limit_tokens,
+            "remaining_requests": quota.remaining_requests,
+            "remaining_tokens": quota.remaining_tokens,
+            "reset_requests_seconds": round(max(0.0, quota.reset_requests_at - now), 1),
+            "reset_tokens_seconds": round(max(0.0, quota.reset_tokens_at - now), 1),
+        }
+
+quota_tracker = QuotaTracker()
@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+from .upstream import chat_completions_url, origin_of
+
+logger = logging.getLogger(__name__)
+
+ROUTING_STRATEGIES = ("weighted", "latency")
+
+# Statuses worth retrying on another endpoint/key. Anything else (e.g. 400 for
+# a malformed request) would fail the same way everywhere.
+FAILOVER_STATUSES = {401, 402, 403, 404, 408, 409, 429}
+
+def is_retryable(status: int) -> bool:
+    return status in FAILOVER_STATUSES or status >= 500
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header (delta-seconds or HTTP date) -> seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class UpstreamUnavailable(Exception):
+    """Every candidate endpoint failed before producing a response."""
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+class Endpoint:
+    """One upstream URL + key a model can be served from."""
+    __slots__ = ("key", "name", "url", "api_key", "model", "weight", "limit")
+
+    def __init__(self, key, name, url, api_key, model, weight, limit=0):
+        self.key = key          # Stable id for health tracking, e.g. "endpoint:3"
+        self.name = name
+        self.url = url          # Full .../chat/completions URL
+        self.api_key = api_key
+        self.model = model      # Model string sent upstream
+        self.weight = weight
+        self.limit = limit or 0 # Max in-flight requests on this key (0 = unlimited)
+
+    @property
+    def slot(self) -> str:
+        """Concurrency bucket: endpoints sharing a provider key share its slots."""
+        return f"{origin_of(self.url)}|{self.api_key}"
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+def model_endpoints(model_config: Dict[str, Any], rows: List[Dict[str, Any]]) -> List[Endpoint]:
+    """
+    The pool for a model: its own api_url/api_key ("primary", weighted by
+    primary_weight) plus every enabled model_endpoints row. Weight 0 takes
+    an endpoint out of rotation.
+    """
+    endpoints = []
+    primary_weight = model_config.get('primary_weight')
+    primary_weight = 1 if primary_weight is None else primary_weight
+    if model_config.get('api_url') and primary_weight > 0:
+        endpoints.append(Endpoint(
+            f"model:{model_config['id']}", "primary", chat_completions_url(model_config['api_url']),
+            model_config.get('api_key') or "", model_config['model_id'], primary_weight,
+            model_config.get('primary_max_concurrency') or 0
+        ))
+    for row in rows:
+        if not row.get('enabled') or not row.get('api_url') or (row.get('weight') or 0) <= 0:
+            continue
+        endpoints.append(Endpoint(
+            f"endpoint:{row['id']}", row.get('name') or f"endpoint {row['id']}",
+            chat_completions_url(row['api_url']), row.get('api_key') or "",
+            row.get('upstream_model') or model_config['model_id'], row['weight'],
+            row.get('max_concurrency') or 0
+        ))
+    return endpoints
+
+class EndpointHealth:
+    __slots__ = ("ttft", "error_rate", "failures", "cooldown_until", "inflight", "current",
+                 "requests", "errors", "rate_limited")
+
+    def __init__(self):
+        self.ttft: Optional[float] = None  # EWMA seconds to first byte
+        self.error_rate = 0.0              # EWMA of failed attempts (0..1)
+        self.failures = 0                  # Consecutive failures
+        self.cooldown_until = 0.0
+        self.inflight = 0
+        self.current = 0.0                 # Smooth weighted round-robin state
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+class EndpointRouter:
+    """
+    Picks the upstream endpoint for each request from live, per-worker
+    health: TTFT and error-rate EWMAs, plus a cooldown after a 429 (for
+    Retry-After) or after repeated consecutive failures.
+
+    plan() returns every endpoint in the order they should be tried, so the
+    caller can fail over to the next one until the first byte is streamed.
+    Endpoints in cooldown are only tried after all healthy ones.
+    """
+    def __init__(self):
+        self.ewma_alpha = float(os.getenv("ROUTING_EWMA_ALPHA", "0.3"))
+        self.cooldown = float(os.getenv("ROUTING_COOLDOWN_SECONDS", "10"))
+        self.max_cooldown = float(os.getenv("ROUTING_MAX_COOLDOWN_SECONDS", "300"))
+        self.max_failures = int(os.getenv("ROUTING_MAX_FAILURES", "3"))
+        self._health: Dict[str, EndpointHealth] = {}
+
+    def health(self, endpoint: Endpoint) -> EndpointHealth:
+        health = self._health.get(endpoint.key)
+        if health is None:
+            health = self._health[endpoint.key] = EndpointHealth()
+        return health
+
+    def effective_weight(self, endpoint: Endpoint) -> float:
+        # A flaky endpoint keeps a sliver of traffic so it can prove itself again
+        health = self.health(endpoint)
+        return endpoint.weight * max(0.05, (1.0 - health.error_rate) ** 2)
+
+    def expected_latency(self, endpoint: Endpoint) -> float:
+        health = self.health(endpoint)
+        # Unmeasured endpoints look fast, so each gets sampled
+        ttft = health.ttft if health.ttft is not None else 0.001
+        return (ttft + 10.0 * health.error_rate) * (1 + health.inflight) / endpoint.weight
+
+    def plan(self, endpoints: List[Endpoint], strategy: str = "weighted") -> List[Endpoint]:
+        now = time.monotonic()
+        ready = [e for e in endpoints if self.health(e).cooldown_until <= now]
+        cooling = sorted((e for e in endpoints if self.health(e).cooldown_until > now),
+                         key=lambda e: self.health(e).cooldown_until)
+        if not ready:
+            return cooling
+
+        if strategy == "latency":
+            ordered = sorted(ready, key=self.expected_latency)
+        else:
+            # Smooth weighted round-robin (as in nginx) for the first pick,
+            # then the rest by weight as failover order
+            weights = {e.key: self.effective_weight(e) for e in ready}
+            total = sum(weights.values())
+            for e in ready:
+                self.health(e).current += weights[e.key]
+            first = max(ready, key=lambda e: self.health(e).current)
+            self.health(first).current -= total
+            ordered = [first] + sorted((e for e in ready if e is not first),
+                                       key=lambda e: weights[e.key], reverse=True)
+        return ordered + cooling
+
+    # --- Feedback ---
+
+    def started(self, endpoint: Endpoint):
+        self.health(endpoint).inflight += 1
+
+    def finished(self, endpoint: Endpoint):
+        health = self.health(endpoint)
+        health.inflight = max(0, health.inflight - 1)
+
+    def record_success(self, endpoint: Endpoint, ttft: Optional[float] = None):
+        health = self.health(endpoint)
+        a = self.ewma_alpha
+        health.requests += 1
+        health.failures = 0
+        health.error_rate *= (1 - a)
+        if ttft is not None:
+            health.ttft = ttft if health.ttft is None else health.ttft * (1 - a) + ttft * a
+
+    def record_failure(self, endpoint: Endpoint, status: Optional[int] = None, retry_after: Optional[float] = None):
+        health = self.health(endpoint)
+        a = self.ewma_alpha
+        health.requests += 1
+        health.errors += 1
+        health.failures += 1
+        health.error_rate = health.error_rate * (1 - a) + a
+
+        cooldown = 0.0
+        if status == 429:
+            health.rate_limited += 1
+            cooldown = retry_after if retry_after is not None else self.cooldown
+        elif health.failures >= self.max_failures:
+            # Back off exponentially while it keeps failing
+            cooldown = self.cooldown * 2 ** min(health.failures - self.max_failures, 5)
+        if cooldown > 0:
+            cooldown = min(cooldown, self.max_cooldown)
+            health.cooldown_until = max(health.cooldown_until, time.monotonic() + cooldown)
+            logger.warning(f"Upstream {endpoint.name} ({endpoint.key}) cooling down for {cooldown:.0f}s "
+                           f"(status={status}, failures={health.failures})")
+
+    def snapshot(self, endpoint: Endpoint) -> Dict[str, Any]:
+        """Health as shown in the admin API."""
+        health = self.health(endpoint)
+        return {
+            "ttft_ms": round(health.ttft * 1000, 1) if health.ttft is not None else None,
+            "error_rate": round(health.error_rate, 3),
+            "consecutive_failures": health.failures,
+            "cooldown_seconds": round(max(0.0, health.cooldown_until - time.monotonic()), 1),
+            "inflight": health.inflight,
+            "requests": health.requests,
+            "errors": health.errors,
+            "rate_limited": health.rate_limited,
+        }
+
+endpoint_router = EndpointRouter()
@@ -0,0 +1,287 @@
+import asyncio
+import collections
+import logging
+import math
+import os
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+from .metrics import scheduler_queue_depth, scheduler_inflight, scheduler_wait_seconds, scheduler_rejections
+from .routing import Endpoint
+
+logger = logging.getLogger(__name__)
+
+class SchedulerRejected(Exception):
+    """The request can't be admitted (queue full / waited too long) -> HTTP 429."""
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ("user_id", "cost", "candidates", "future", "enqueued")
+
+    def __init__(self, user_id, cost, candidates):
+        self.user_id = user_id
+        self.cost = cost
+        self.candidates = candidates
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+class _ModelQueue:
+    """
+    Waiting requests for one model, one FIFO per user, served by deficit
+    round-robin: users take turns, one request per turn, and a user whose
+    deficit doesn't cover the next request's estimated token cost is topped
+    up by `quantum` and skipped for that turn. Heavy users therefore get the
+    same share (in requests and tokens) as light ones, however many
+    requests they queue.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.limit = 0  # Max in-flight (0 = unlimited)
+        self.inflight = 0
+        self.waiting = 0
+        self.users: Dict[Any, Deque[_Waiter]] = {}
+        self.deficit: Dict[Any, float] = {}
+        self.order: Deque[Any] = collections.deque()  # Users with queued requests
+        self.hold_ewma = 1.0  # Seconds a slot is typically held (for Retry-After)
+
+    def has_slot(self) -> bool:
+        return self.limit <= 0 or self.inflight < self.limit
+
+    def push(self, waiter: _Waiter):
+        queue = self.users.get(waiter.user_id)
+        if queue is None:
+            queue = self.users[waiter.user_id] = collections.deque()
+            self.deficit[waiter.user_id] = 0.0
+            self.order.append(waiter.user_id)
+        queue.append(waiter)
+        self.waiting += 1
+
+    def remove(self, waiter: _Waiter):
+        queue = self.users.get(waiter.user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.waiting -= 1
+        if not queue:
+            self._drop_user(waiter.user_id)
+
+    def _drop_user(self, user_id):
+        del self.users[user_id]
+        del self.deficit[user_id]
+        self.order.remove(user_id)
+
+    def pop_next(self, quantum: float, can_start) -> Optional[_Waiter]:
+        """Next waiter in DRR order, if `can_start(waiter)` lets it run now."""
+        while self.order:
+            user_id = self.order[0]
+            queue = self.users[user_id]
+            head = queue[0]
+            if self.deficit[user_id] < head.cost:
+                self.deficit[user_id] += quantum
+                self.order.rotate(-1)
+                continue
+            if not can_start(head):
+                return None
+            queue.popleft()
+            self.waiting -= 1
+            self.deficit[user_id] -= head.cost
+            if not queue:
+                self._drop_user(user_id)  # An idle user keeps no credit
+            else:
+                self.order.rotate(-1)  # One request per visit, so users alternate
+            return head
+        return None
+
+class Ticket:
+    """
+    An admitted request: holds one model slot and one upstream-key slot.
+    `candidates` is the routing order with the granted endpoint first;
+    use() moves the key slot during failover, add()/keep()/drop() manage
+    the extra key slot of a hedge request. release() exactly once when
+    the upstream call is over (extra calls are ignored).
+    """
+    __slots__ = ("scheduler", "queue", "endpoint", "extra", "candidates", "started", "released")
+
+    def __init__(self, scheduler, queue, endpoint, candidates):
+        self.scheduler = scheduler
+        self.queue = queue
+        self.endpoint = endpoint
+        self.extra: List[Endpoint] = []  # Hedge attempts racing self.endpoint
+        self.candidates = [endpoint] + [e for e in candidates if e is not endpoint]
+        self.started = time.monotonic()
+        self.released = False
+
+    def use(self, endpoint: Endpoint) -> bool:
+        """Switches the key slot to `endpoint` if it has room. False = skip it."""
+        if endpoint is self.endpoint:
+            return True
+        scheduler = self.scheduler
+        if endpoint.slot != self.endpoint.slot and not scheduler._key_free(endpoint):
+            return False
+        scheduler._take_key(endpoint)
+        scheduler._give_key(self.endpoint)
+        self.endpoint = endpoint
+        return True
+
+    def add(self, endpoint: Endpoint) -> bool:
+        """Takes an extra key slot for a hedge on `endpoint`, if it has room."""
+        if not self.scheduler._key_free(endpoint):
+            return False
+        self.scheduler._take_key(endpoint)
+        self.extra.append(endpoint)
+        return True
+
+    def drop(self, endpoint: Endpoint):
+        """Gives back the slot of an attempt that failed or lost the race."""
+        if endpoint in self.extra:
+            self.extra.remove(endpoint)
+            self.scheduler._give_key(endpoint)
+        elif endpoint is self.endpoint and self.extra:
+            self.scheduler._give_key(endpoint)
+            self.endpoint = self.extra.pop(0)
+
+    def keep(self, endpoint: Endpoint):
+        """`endpoint` won: it keeps its slot, every other attempt's is given back."""
+        for other in [self.endpoint] + self.extra:
+            if other is not endpoint:
+                self.scheduler._give_key(other)
+        self.endpoint = endpoint
+        self.extra = []
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+class AdmissionScheduler:
+    """
+    Admission control in front of the upstreams, per worker process:
+    - at most ai_models.max_concurrency requests in flight per model, and
+    - at most max_concurrency in flight per upstream key (endpoints with the
+      same host + key share its slots),
+    0 meaning unlimited. Requests beyond that wait in a bounded per-model
+    queue, served fairly across users (see _ModelQueue), and are turned away
+    with SchedulerRejected when the queue is full or they waited too long.
+    Limits are per worker - with N gunicorn workers the real cap is N times.
+    """
+    def __init__(self):
+        self.max_queue = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+        self.max_wait = float(os.getenv("SCHEDULER_MAX_WAIT_SECONDS", "30"))
+        self.quantum = float(os.getenv("SCHEDULER_QUANTUM_TOKENS", "4096"))
+        self._models: Dict[Any, _ModelQueue] = {}
+        self._keys: Dict[str, int] = {}  # Endpoint.slot -> in-flight
+
+    # --- Slots ---
+
+    def _key_free(self, endpoint: Endpoint) -> bool:
+        return endpoint.limit <= 0 or self._keys.get(endpoint.slot, 0) < endpoint.limit
+
+    def _take_key(self, endpoint: Endpoint):
+        self._keys[endpoint.slot] = self._keys.get(endpoint.slot, 0) + 1
+
+    def _give_key(self, endpoint: Endpoint):
+        left = self._keys.get(endpoint.slot, 0) - 1
+        if left > 0:
+            self._keys[endpoint.slot] = left
+        else:
+            self._keys.pop(endpoint.slot, None)
+
+    def _free_endpoint(self, candidates: List[Endpoint]) -> Optional[Endpoint]:
+        return next((e for e in candidates if self._key_free(e)), None)
+
+    def _grant(self, queue: _ModelQueue, endpoint: Endpoint, candidates: List[Endpoint]) -> Ticket:
+        queue.inflight += 1
+        self._take_key(endpoint)
+        scheduler_inflight.set(queue.inflight, model=queue.name)
+        return Ticket(self, queue, endpoint, candidates)
+
+    def _release(self, ticket: Ticket):
+        queue = ticket.queue
+        queue.inflight -= 1
+        for endpoint in [ticket.endpoint] + ticket.extra:
+            self._give_key(endpoint)
+        queue.hold_ewma = queue.hold_ewma * 0.8 + (time.monotonic() - ticket.started) * 0.2
+        scheduler_inflight.set(queue.inflight, model=queue.name)
+        # A freed key slot may unblock another model sharing that key
+        for other in self._models.values():
+            if other.waiting:
+                self._dispatch(other)
+
+    def _dispatch(self, queue: _ModelQueue):
+        while queue.waiting and queue.has_slot():
+            waiter = queue.pop_next(self.quantum, lambda w: self._free_endpoint(w.candidates) is not None)
+            if waiter is None:
+                break
+            if waiter.future.done():
+                continue  # Timed out / cancelled, being cleaned up by its acquire()
+            endpoint = self._free_endpoint(waiter.candidates)
+            waiter.future.set_result(self._grant(queue, endpoint, waiter.candidates))
+        scheduler_queue_depth.set(queue.waiting, model=queue.name)
+
+    def retry_after(self, queue: _ModelQueue) -> int:
+        """Rough seconds until a slot frees up for a new arrival."""
+        per_slot = queue.hold_ewma / max(queue.limit, 1)
+        return max(1, min(60, math.ceil(per_slot * (queue.waiting + 1))))
+
+    # --- API ---
+
+    def _queue(self, model_config: Dict[str, Any]) -> _ModelQueue:
+        queue = self._models.get(model_config['id'])
+        if queue is None:
+            queue = self._models[model_config['id']] = _ModelQueue(model_config['model_id'])
+        queue.name = model_config['model_id']
+        queue.limit = model_config.get('max_concurrency') or 0
+        return queue
+
+    def acquire_nowait(self, model_config: Dict[str, Any], candidates: List[Endpoint]) -> Optional[Ticket]:
+        """Admits right away if nobody is queued ahead and there is room, else None."""
+        queue = self._queue(model_config)
+        if queue.waiting or not queue.has_slot():
+            return None
+        endpoint = self._free_endpoint(candidates)
+        if endpoint is None:
+            return None
+        scheduler_wait_seconds.observe(0.0, model=queue.name)
+        return self._grant(queue, endpoint, candidates)
+
+    async def acquire(self, model_config: Dict[str, Any], user_id, candidates: List[Endpoint], cost: float) -> Ticket:
+        """
+        Waits for a model slot and an upstream-key slot. `cost` is the
+        request's estimated tokens (prompt + max_tokens), used for fairness.
+        """
+        ticket = self.acquire_nowait(model_config, candidates)
+        if ticket is not None:
+            return ticket
+
+        queue = self._queue(model_config)
+        name = queue.name
+        if queue.waiting >= self.max_queue:
+            scheduler_rejections.inc(model=name, reason="queue_full")
+            raise SchedulerRejected("queue_full", self.retry_after(queue))
+
+        waiter = _Waiter(user_id, max(1.0, cost), candidates)
+        queue.push(waiter)
+        scheduler_queue_depth.set(queue.waiting, model=name)
+        try:
+            ticket = await asyncio.wait_for(waiter.future, self.max_wait)
+        except asyncio.TimeoutError:
+            queue.remove(waiter)
+            scheduler_queue_depth.set(queue.waiting, model=name)
+            scheduler_rejections.inc(model=name, reason="timeout")
+            logger.warning(f"Request for {name} (user {user_id}) waited {self.max_wait:.0f}s without a slot")
+            raise SchedulerRejected("timeout", self.retry_after(queue))
+        except asyncio.CancelledError:
+            # Client gave up while queued; hand back a slot granted meanwhile
+            queue.remove(waiter)
+            scheduler_queue_depth.set(queue.waiting, model=name)
+            if waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().release()
+            raise
+        scheduler_wait_seconds.observe(time.monotonic() - waiter.enqueued, model=name)
+        return ticket
+
+admission_scheduler = AdmissionScheduler()
@@ -0,0 +1,166 @@
+import asyncio
+import json
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class SSEScanner:
+    """
+    Incremental scanner for an upstream OpenAI-style SSE byte stream.
+
+    The proxy forwards upstream chunks untouched; the scanner only watches
+    them go by. It splits complete lines, and only JSON-decodes a `data:`
+    line whose "usage" or "error" key has a non-null value (OpenAI sends
+    "usage":null on every delta with include_usage). Delta payloads are kept as
+    raw bytes and parsed once at the end, and only if the upstream never
+    reported usage (see reply_text).
+    """
+    __slots__ = ("_tail", "_payloads", "events", "done", "usage", "error")
+
+    def __init__(self):
+        self._tail = b""
+        self._payloads: List[bytes] = []
+        self.events = 0       # data: lines seen
+        self.done = False     # [DONE] received
+        self.usage: Optional[Dict[str, Any]] = None
+        self.error: Optional[Any] = None
+
+    def feed(self, chunk: bytes):
+        data = self._tail + chunk if self._tail else chunk
+        end = data.rfind(b"\n")
+        if end == -1:
+            self._tail = data
+            return
+        self._tail = data[end + 1:]
+        for line in data[:end].split(b"\n"):
+            if line.startswith(b"data:"):
+                self._scan_data(line[5:].strip())
+
+    def close(self):
+        """Scans a final line that had no trailing newline."""
+        if self._tail:
+            tail, self._tail = self._tail, b""
+            if tail.startswith(b"data:"):
+                self._scan_data(tail[5:].strip())
+
+    def _scan_data(self, payload: bytes):
+        if not payload:
+            return
+        self.events += 1
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        if _has_value(payload, b'"usage"') or _has_value(payload, b'"error"'):
+            try:
+                obj = json.loads(payload)
+            except ValueError:
+                obj = None
+            if isinstance(obj, dict):
+                if obj.get("usage"):
+                    self.usage = obj["usage"]
+                if obj.get("error"):
+                    self.error = obj["error"]
+        self._payloads.append(payload)
+
+    def reply_text(self) -> str:
+        """Concatenated delta content (parses the kept payloads - call once, at the end)."""
+        return delta_text(self._payloads)
+
+def _has_value(payload: bytes, key: bytes) -> bool:
+    """Whether a JSON payload has `key` (quoted) with a value other than null, without parsing it."""
+    start = payload.find(key)
+    while start != -1:
+        value = payload[start + len(key):start + len(key) + 32].lstrip(b" \t")
+        if value.startswith(b":") and not value[1:].lstrip(b" \t").startswith(b"null"):
+            return True
+        start = payload.find(key, start + len(key))
+    return False
+
+def delta_text(payloads: List[bytes]) -> str:
+    """Concatenated choices[].delta.content of raw `data:` payloads."""
+    parts = []
+    for payload in payloads:
+        try:
+            obj = json.loads(payload)
+        except ValueError:
+            continue
+        if not isinstance(obj, dict):
+            continue
+        for choice in obj.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                parts.append(content)
+    return "".join(parts)
+
+# Text held back between batches when there is no space to cut at (e.g. CJK)
+MAX_CARRY_CHARS = 4096
+
+def _cut_point(text: str) -> int:
+    """Index of the last space that starts a word - BPE pre-tokenization splits there anyway."""
+    cut = text.rfind(" ")
+    while cut > 0 and text[cut - 1].isspace():
+        cut = text.rfind(" ", 0, cut - 1)
+    return max(cut, 0)
+
+class DeltaTokenCounter:
+    """
+    Counts a streamed reply's completion tokens while it streams, next to
+    an SSEScanner. Per chunk, poll() only compares two ints; every `batch`
+    new data payloads, their delta text is extracted and encoded on
+    `executor` (one batch at a time, in order). Batches are cut where a
+    word starts, so the sum matches encoding the whole reply.
+    """
+    __slots__ = ("_count", "_executor", "batch", "tokens", "_next", "_carry", "_job", "_final")
+
+    def __init__(self, count: Callable[[str], int], executor: Executor, batch: int = 32):
+        self._count = count
+        self._executor = executor
+        self.batch = batch
+        self.tokens = 0
+        self._next = 0   # Index of the first payload not yet handed to a batch
+        self._carry = "" # Text after the last cut, prepended to the next batch
+        self._job: Optional[asyncio.Future] = None
+        self._final = False
+
+    def poll(self, scanner: SSEScanner):
+        """Starts counting the next batch if one is due and none is running."""
+        if self._job is not None:
+            if not self._job.done():
+                return
+            self._collect()
+        if len(scanner._payloads) - self._next >= self.batch:
+            self._submit(scanner, final=False)
+
+    async def total(self, scanner: SSEScanner) -> int:
+        """Completion tokens of everything scanned so far (counts the rest; call at the end)."""
+        if not self._final:
+            if self._job is not None:
+                await self._job
+                self._collect()
+            self._final = True
+            self._submit(scanner, final=True)
+            await self._job
+            self._collect()
+        return self.tokens
+
+    def _submit(self, scanner: SSEScanner, final: bool):
+        payloads = scanner._payloads[self._next:]
+        self._next += len(payloads)
+        self._job = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._count_batch, payloads, self._carry, final
+        )
+
+    def _count_batch(self, payloads: List[bytes], carry: str, final: bool) -> Tuple[int, str]:
+        text = carry + delta_text(payloads)
+        if final:
+            return self._count(text), ""
+        cut = _cut_point(text)
+        if cut == 0:
+            if len(text) < MAX_CARRY_CHARS:
+                return 0, text
+            cut = len(text)
+        return self._count(text[:cut]), text[cut:]
+
+    def _collect(self):
+        tokens, self._carry = self._job.result()
+        self.tokens += tokens
+        self._job = None
@@ -0,0 +1,201 @@
+import abc
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .sqlite_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+USER_DATA_DDL = '''
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER,
+        data_type TEXT NOT NULL,
+        json_content TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, data_type)
+    )
+'''
+
+UPSERT_USER_DATA = '''
+    INSERT INTO user_data (user_id, data_type, json_content)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id, data_type)
+    DO UPDATE SET json_content = excluded.json_content, updated_at = CURRENT_TIMESTAMP
+'''
+
+# Like UPSERT_USER_DATA, but a row that is already there wins
+INSERT_MISSING_USER_DATA = '''
+    INSERT INTO user_data (user_id, data_type, json_content)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id, data_type) DO NOTHING
+'''
+
+# (user_id, data_type, json_content)
+BlobRow = Tuple[int, str, str]
+
+class UserDataStore(abc.ABC):
+    """
+    Storage for per-user JSON blobs (settings, characters, chats).
+    Blobs are passed around as JSON text; Database does the (de)serializing.
+    """
+    @abc.abstractmethod
+    def save(self, user_id: int, data_type: str, json_content: str):
+        ...
+
+    @abc.abstractmethod
+    def load(self, user_id: int, data_type: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def load_many(self, user_ids: List[int], data_types: Optional[List[str]] = None) -> Iterable[BlobRow]:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, user_id: int, data_type: str):
+        ...
+
+    def close(self):
+        pass
+
+def _select_many(conn, user_ids, data_types) -> List[BlobRow]:
+    sql = f"SELECT user_id, data_type, json_content FROM user_data WHERE user_id IN ({','.join('?' * len(user_ids))})"
+    params = list(user_ids)
+    if data_types:
+        sql += f" AND data_type IN ({','.join('?' * len(data_types))})"
+        params.extend(data_types)
+    return [tuple(row) for row in conn.execute(sql, params)]
+
+class SQLiteUserDataStore(UserDataStore):
+    """user_data table inside one SQLite file (the main users.db by default)."""
+    def __init__(self, pool: ConnectionPool, owns_pool: bool = False):
+        self.pool = pool
+        self.owns_pool = owns_pool
+
+    def ensure_schema(self):
+        with self.pool.connect() as conn:
+            conn.execute(USER_DATA_DDL)
+
+    def save(self, user_id, data_type, json_content):
+        with self.pool.connect() as conn:
+            conn.execute(UPSERT_USER_DATA, (user_id, data_type, json_content))
+
+    def insert_missing(self, user_id, data_type, json_content) -> bool:
+        """Stores the blob only if there is none yet. True if it was stored."""
+        with self.pool.connect() as conn:
+            return conn.execute(INSERT_MISSING_USER_DATA, (user_id, data_type, json_content)).rowcount == 1
+
+    def load(self, user_id, data_type):
+        with self.pool.connect() as conn:
+            row = conn.execute(
+                "SELECT json_content FROM user_data WHERE user_id = ? AND data_type = ?", (user_id, data_type)
+            ).fetchone()
+            return row[0] if row else None
+
+    def load_many(self, user_ids, data_types=None):
+        if not user_ids:
+            return []
+        with self.pool.connect() as conn:
+            return _select_many(conn, user_ids, data_types)
+
+    def delete(self, user_id, data_type):
+        with self.pool.connect() as conn:
+            conn.execute("DELETE FROM user_data WHERE user_id = ? AND data_type = ?", (user_id, data_type))
+
+    def close(self):
+        if self.owns_pool:
+            self.pool.close()
+
+class ShardedUserDataStore(UserDataStore):
+    """
+    user_data spread over N SQLite files (shard = user_id % N), so blob sync
+    writes never take the main DB's write lock that billing needs, and
+    writes to different shards proceed in parallel.
+
+    Rows still in the main DB's legacy user_data table are moved into their
+    shard the first time they are read. The shard count is part of the data
+    layout: changing it requires moving the existing shard files' rows.
+    """
+    def __init__(self, directory: str, shard_count: int, legacy: Optional[UserDataStore] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.shard_count = shard_count
+        self.legacy = legacy
+        self.shards: List[SQLiteUserDataStore] = []
+        for i in range(shard_count):
+            shard = SQLiteUserDataStore(ConnectionPool(os.path.join(directory, f"user_data_{i:02d}.db")), owns_pool=True)
+            shard.ensure_schema()
+            self.shards.append(shard)
+
+    def shard_for(self, user_id: int) -> SQLiteUserDataStore:
+        return self.shards[int(user_id) % self.shard_count]
+
+    def save(self, user_id, data_type, json_content):
+        self.shard_for(user_id).save(user_id, data_type, json_content)
+
+    def load(self, user_id, data_type):
+        content = self.shard_for(user_id).load(user_id, data_type)
+        if content is None and self.legacy:
+            content = self.legacy.load(user_id, data_type)
+            if content is not None:
+                content = self._move_from_legacy(user_id, data_type, content)
+        return content
+
+    def load_many(self, user_ids, data_types=None):
+        by_shard: Dict[int, List[int]] = {}
+        for uid in user_ids:
+            by_shard.setdefault(int(uid) % self.shard_count, []).append(uid)
+
+        rows: Dict[Tuple[int, str], str] = {}
+        for index, ids in by_shard.items():
+            for user_id, data_type, content in self.shards[index].load_many(ids, data_types):
+                rows[(user_id, data_type)] = content
+
+        if self.legacy:
+            # Shard copy wins over a not-yet-migrated legacy row
+            for user_id, data_type, content in self.legacy.load_many(list(user_ids), data_types):
+                if (user_id, data_type) not in rows:
+                    content = self._move_from_legacy(user_id, data_type, content)
+                    if content is not None:
+                        rows[(user_id, data_type)] = content
+
+        return [(uid, dtype, content) for (uid, dtype), content in rows.items()]
+
+    def delete(self, user_id, data_type):
+        self.shard_for(user_id).delete(user_id, data_type)
+        if self.legacy:
+            self.legacy.delete(user_id, data_type)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def _move_from_legacy(self, user_id, data_type, content) -> Optional[str]:
+        """
+        Copies a legacy blob into its shard and returns the shard's content.
+        Never overwrites: a save() that reached the shard in the meantime
+        is newer than the legacy row, so it wins and is what's returned.
+        """
+        # Shard first, then delete: a crash in between leaves a harmless duplicate
+        try:
+            shard = self.shard_for(user_id)
+            if not shard.insert_missing(user_id, data_type, content):
+                content = shard.load(user_id, data_type)
+            self.legacy.delete(user_id, data_type)
+        except Exception as e:
+            logger.error(f"Failed to move user_data ({user_id}, {data_type}) into its shard: {e}")
+        return content
+
+def create_user_data_store(main_pool: ConnectionPool, db_path: str) -> UserDataStore:
+    """
+    USER_DATA_SHARDS=0 (default) keeps blobs in the main DB's user_data table.
+    USER_DATA_SHARDS=N stores them in N shard files under USER_DATA_DIR
+    (default: <db dir>/user_data).
+    """
+    main_store = SQLiteUserDataStore(main_pool)
+    shard_count = int(os.getenv("USER_DATA_SHARDS", "0"))
+    if shard_count <= 0:
+        return main_store
+
+    directory = os.getenv("USER_DATA_DIR") or os.path.join(os.path.dirname(os.path.abspath(db_path)), "user_data")
+    logger.info(f"user_data sharded over {shard_count} files in {directory}")
+    return ShardedUserDataStore(directory, shard_count, legacy=main_store)
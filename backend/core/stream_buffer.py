@@ -0,0 +1,447 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from .metrics import collector, stream_buffer_bytes
+
+logger = logging.getLogger(__name__)
+
+# How often a follower on another worker checks the spool file for new events
+SPOOL_POLL_SECONDS = 0.2
+
+def _event_seq(event: bytes) -> int:
+    """Sequence number of a framed event ("id: N\n..."), 0 if it has none."""
+    if not event.startswith(b"id: "):
+        return 0
+    end = event.find(b"\n")
+    try:
+        return int(event[4:end])
+    except ValueError:
+        return 0
+
+class Generation:
+    """
+    One streamed reply, buffered so a client that lost its connection can
+    pick it up again. Upstream bytes are split into SSE events and each
+    is framed with `id: <seq>`, so Last-Event-ID says exactly where to
+    resume. The newest events stay in memory (up to `memory_limit` bytes);
+    older ones are spilled to <directory>/<id>.sse. Once no client is
+    attached, every event is written through to that file too, so a
+    client that reconnects to another gunicorn worker can follow it there
+    (see SpooledGeneration). File I/O runs on the default executor: writes
+    by one flush task at a time, in event order, and events leave memory
+    only once they are in the file.
+    """
+    def __init__(self, registry: "GenerationRegistry", generation_id: str, user_id):
+        self.registry = registry
+        self.id = generation_id
+        self.user_id = user_id
+        self.seq = 0                 # Last event appended
+        self.done = False
+        self.finished_at = 0.0
+        self.readers = 0
+        self.on_abandon: Optional[Callable[[], None]] = None  # Called when the grace period runs out
+        self._tail = b""             # Incomplete event at the end of the last chunk
+        self._memory: Deque[Tuple[int, bytes]] = collections.deque()
+        self.memory_bytes = 0
+        self._offsets: List[int] = []  # Spool file offset of event seq i + 1
+        self._file_size = 0
+        self._file = None            # Opened by the first flush
+        self._spooled = False        # A flush was started (the file exists or is about to)
+        self._flusher: Optional[asyncio.Task] = None
+        self._keep_bytes = registry.memory_limit  # What the running flush trims memory down to
+        self._meta_dirty = False
+        self._released = False
+        self._write_through = False
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Event()
+
+    # --- Writing (the pump) ---
+
+    def append(self, chunk):
+        """Adds upstream bytes; complete events become visible to followers."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n")
+        data = self._tail + chunk if self._tail else chunk
+        end = data.rfind(b"\n\n")
+        if end == -1:
+            self._tail = data
+            return
+        self._tail = data[end + 2:]
+        for event in data[:end].split(b"\n\n"):
+            if event.strip(b"\n"):
+                self._add_event(event.lstrip(b"\n"))
+        self._wake()
+
+    def finish(self):
+        """No more events (flushes an unterminated last event)."""
+        if self.done:
+            return
+        if self._tail.strip():
+            self._add_event(self._tail.strip(b"\n"))
+        self._tail = b""
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._cancel_grace()
+        if self._spooled:
+            self._meta_dirty = True
+            self._start_flush()
+        self._wake()
+
+    def _add_event(self, event: bytes):
+        self.seq += 1
+        framed = b"id: %d\n%s\n\n" % (self.seq, event)
+        self._memory.append((self.seq, framed))
+        self.memory_bytes += len(framed)
+        self.registry.memory_bytes += len(framed)
+        limit = self.registry.memory_limit
+        if self.memory_bytes > limit:
+            self._spill(keep_bytes=limit // 2)
+        elif self._write_through:
+            self._spill(keep_bytes=limit)
+        if self.registry.memory_bytes > self.registry.total_limit:
+            self.registry.shrink()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    # --- Spool file ---
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.registry.directory, f"{self.id}.sse")
+
+    def _write_meta(self, done: bool):
+        meta_path = os.path.join(self.registry.directory, f"{self.id}.json")
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"user_id": self.user_id, "done": done}, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def _write(self, data: bytes, meta: Optional[bool]):
+        """Appends to the spool file, then rewrites the meta file if `meta` is not None (done flag). Runs on the executor."""
+        if self._file is None:
+            os.makedirs(self.registry.directory, exist_ok=True)
+            self._file = open(self.path, "ab", buffering=0)
+        if data:
+            self._file.write(data)
+        if meta is not None:
+            self._write_meta(meta)
+
+    def _spill(self, keep_bytes: int):
+        """Has the events not yet in the spool file written to it, then only the newest `keep_bytes` kept in memory."""
+        self._keep_bytes = min(self._keep_bytes, keep_bytes)
+        if not self._spooled:
+            self._spooled = self._meta_dirty = True
+        self._start_flush()
+
+    def _start_flush(self):
+        if self._flusher is None and not self._released:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while not self._released:
+                written = len(self._offsets)
+                pending = [framed for seq, framed in self._memory if seq > written]
+                if not pending and not self._meta_dirty:
+                    return
+                meta = self.done if self._meta_dirty else None
+                self._meta_dirty = False
+                try:
+                    await loop.run_in_executor(None, self._write, b"".join(pending), meta)
+                except OSError as e:
+                    logger.error(f"Stream buffer spill failed for {self.id}: {e}")
+                    return  # Everything stays in memory; the next spill retries
+                for framed in pending:
+                    self._offsets.append(self._file_size)
+                    self._file_size += len(framed)
+                while self._memory and self.memory_bytes > self._keep_bytes and self._memory[0][0] <= len(self._offsets):
+                    _, framed = self._memory.popleft()
+                    self.memory_bytes -= len(framed)
+                    self.registry.memory_bytes -= len(framed)
+                self._keep_bytes = self.registry.memory_limit
+        finally:
+            self._flusher = None
+
+    def spill_all(self):
+        self._spill(keep_bytes=0)
+
+    def release(self):
+        """Drops the buffer; its files are removed on the executor once a running flush is over (eviction)."""
+        self._cancel_grace()
+        self._released = True
+        self.registry.memory_bytes -= self.memory_bytes
+        self.memory_bytes = 0
+        self._memory.clear()
+        if self._spooled:
+            self.registry.run_later(self._remove_files())
+
+    async def _remove_files(self):
+        if self._flusher is not None:
+            await asyncio.wait({self._flusher})
+        await asyncio.get_running_loop().run_in_executor(None, self._close_and_remove)
+
+    def _close_and_remove(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for suffix in (".sse", ".json"):
+            try:
+                os.remove(os.path.join(self.registry.directory, f"{self.id}{suffix}"))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove stream buffer file {self.id}{suffix}: {e}")
+
+    # --- Reading (the clients) ---
+
+    def _read_spool(self, start: int, end: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    async def read_after(self, after: int) -> Tuple[int, bytes]:
+        """
+        (last seq returned, framed events after `after`); b"" when there is
+        nothing new. Events that only live in the spool file are returned on
+        their own (read on the executor), the ones in memory by the next call.
+        """
+        if after >= self.seq:
+            return after, b""
+        first_in_memory = self._memory[0][0] if self._memory else self.seq + 1
+        if after + 1 < first_in_memory:
+            # Every event that left memory is in the file, up to _file_size
+            upto = first_in_memory - 1
+            start = self._offsets[after]
+            end = self._offsets[upto] if upto < len(self._offsets) else self._file_size
+            data = await asyncio.get_running_loop().run_in_executor(None, self._read_spool, start, end)
+            return upto, data
+        skip = after + 1 - first_in_memory
+        return self.seq, b"".join(framed for _, framed in itertools.islice(self._memory, skip, None))
+
+    async def follow(self, after: int, idle: float) -> AsyncIterator[Optional[bytes]]:
+        """
+        Replays the events after `after`, then the live tail until the end.
+        Yields None after `idle` seconds without events (so the caller can
+        check its client is still there).
+        """
+        while True:
+            changed = self._changed
+            after, data = await self.read_after(after)
+            if data:
+                yield data
+                continue
+            if self.done:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), idle)
+            except asyncio.TimeoutError:
+                yield None
+
+    def attach(self):
+        self.readers += 1
+        self._cancel_grace()
+
+    def detach(self):
+        """
+        A client went away. With nobody left and the reply still coming,
+        events are written through to disk and the generation gets
+        `grace` seconds for a client to come back before on_abandon.
+        """
+        self.readers -= 1
+        if self.readers > 0 or self.done:
+            return
+        grace = self.registry.grace
+        if grace <= 0:
+            self._abandon()
+            return
+        self._write_through = True
+        self.spill_all()
+        self._grace_timer = asyncio.get_running_loop().call_later(grace, self._abandon)
+
+    def _cancel_grace(self):
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+
+    def _abandon(self):
+        self._grace_timer = None
+        if self.readers == 0 and not self.done and self.on_abandon is not None:
+            self.on_abandon()
+
+class SpooledGeneration:
+    """
+    A generation owned by another worker, followed through its spool file
+    (written through once its client went away - see Generation.detach).
+    """
+    def __init__(self, registry: "GenerationRegistry", generation_id: str, user_id):
+        self.registry = registry
+        self.id = generation_id
+        self.user_id = user_id
+
+    def attach(self):
+        pass
+
+    def detach(self):
+        pass
+
+    def _done(self) -> bool:
+        try:
+            with open(os.path.join(self.registry.directory, f"{self.id}.json"), encoding="utf-8") as f:
+                return bool(json.load(f).get("done"))
+        except (OSError, ValueError):
+            return True  # Evicted meanwhile
+
+    def _poll(self, position: int) -> Tuple[bool, bytes]:
+        """(done, spool file bytes from `position`), done read first so no event is missed. Runs on the executor."""
+        done = self._done()
+        with open(os.path.join(self.registry.directory, f"{self.id}.sse"), "rb") as f:
+            f.seek(position)
+            return done, f.read()
+
+    async def follow(self, after: int, idle: float) -> AsyncIterator[Optional[bytes]]:
+        loop = asyncio.get_running_loop()
+        position = 0
+        pending = b""
+        last_growth = time.monotonic()
+        # The owner abandons the generation after the grace period; give up a bit later if it died
+        stale = self.registry.grace + 30
+        while True:
+            try:
+                done, data = await loop.run_in_executor(None, self._poll, position)
+            except OSError:
+                return
+            if data:
+                position += len(data)
+                last_growth = time.monotonic()
+                events = (pending + data).split(b"\n\n")
+                pending = events.pop()
+                fresh = [e for e in events if _event_seq(e) > after]
+                if fresh:
+                    after = _event_seq(fresh[-1])
+                    yield b"\n\n".join(fresh) + b"\n\n"
+                continue
+            if done or time.monotonic() - last_growth > stale:
+                return
+            await asyncio.sleep(SPOOL_POLL_SECONDS)
+            yield None
+
+class GenerationRegistry:
+    """
+    Buffered generations of this worker, by id (see Generation). Finished
+    ones are kept STREAM_BUFFER_TTL_SECONDS for late reconnects. When the
+    buffers together hold more than STREAM_BUFFER_TOTAL_BYTES, finished
+    ones are evicted oldest first, then live ones are moved to disk.
+    """
+    def __init__(self):
+        # Shared by the workers; main points it next to the database
+        self.directory = os.path.join(tempfile.gettempdir(), "litetavern-streams")
+        self.memory_limit = int(os.getenv("STREAM_BUFFER_MEMORY_BYTES", str(256 * 1024)))
+        self.total_limit = int(os.getenv("STREAM_BUFFER_TOTAL_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = float(os.getenv("STREAM_BUFFER_TTL_SECONDS", "600"))
+        # Short: until it runs out a client that left (and won't resume) still holds the upstream call
+        self.grace = float(os.getenv("STREAM_RESUME_GRACE_SECONDS", "5"))
+        self.memory_bytes = 0
+        self._generations: Dict[str, Generation] = {}
+        self._last_sweep = 0.0
+        self._tasks: Set[asyncio.Task] = set()  # File cleanups in flight
+
+    def configure(self, directory: str):
+        self.directory = directory
+
+    def create(self, user_id) -> Generation:
+        self.sweep()
+        generation = Generation(self, uuid.uuid4().hex, user_id)
+        self._generations[generation.id] = generation
+        return generation
+
+    def _read_meta(self, generation_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.directory, f"{generation_id}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    async def find(self, generation_id: str):
+        """This worker's Generation, another worker's SpooledGeneration, or None."""
+        self.sweep()
+        generation = self._generations.get(generation_id)
+        if generation is not None:
+            return generation
+        if not generation_id.isalnum():
+            return None
+        meta = await asyncio.get_running_loop().run_in_executor(None, self._read_meta, generation_id)
+        if meta is None:
+            return None
+        return SpooledGeneration(self, generation_id, meta.get("user_id"))
+
+    def run_later(self, coro):
+        """Runs a background coroutine, keeping a reference until it is done."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _evict(self, generation: Generation):
+        self._generations.pop(generation.id, None)
+        generation.release()
+
+    def _idle_finished(self) -> List[Generation]:
+        return sorted((g for g in self._generations.values() if g.done and g.readers == 0),
+                      key=lambda g: g.finished_at)
+
+    def sweep(self):
+        """Evicts expired generations; at most every few seconds."""
+        now = time.monotonic()
+        if now - self._last_sweep < 5:
+            return
+        self._last_sweep = now
+        for generation in self._idle_finished():
+            if now - generation.finished_at < self.ttl:
+                break
+            self._evict(generation)
+        asyncio.get_running_loop().run_in_executor(None, self._sweep_orphans)
+
+    def _sweep_orphans(self):
+        """Removes spool files left behind by workers that died. Runs on the executor."""
+        cutoff = time.time() - 2 * (self.ttl + self.grace)
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            name = entry.name.split(".", 1)[0]
+            if name in self._generations:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def shrink(self):
+        """Gets under the total memory cap: evict finished generations, then spill live ones."""
+        for generation in self._idle_finished():
+            if self.memory_bytes <= self.total_limit:
+                return
+            self._evict(generation)
+        for generation in sorted(self._generations.values(), key=lambda g: g.memory_bytes, reverse=True):
+            if self.memory_bytes <= self.total_limit // 2:
+                return
+            generation.spill_all()
+
+generations = GenerationRegistry()
+
+@collector
+def _collect_buffer_stats():
+    stream_buffer_bytes.set(generations.memory_bytes)
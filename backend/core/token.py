@@ -2,6 +2,7 @@ import tiktoken
 import logging
 from typing import List
 from backend.domain.models import Message, ContextFrame
+from backend.core.token_cache import token_counts
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +15,13 @@ class TokenManager:
             logger.warning(f"Model {model_name} not found in tiktoken, using cl100k_base")
             self.encoder = tiktoken.get_encoding("cl100k_base")
 
-    def count_string(self, text: str) -> int:
+    def count_string(self, text: str, cache: bool = True) -> int:
+        """Tokens in `text`; cache=False for one-off texts not worth keeping (see TokenCountCache)."""
         if not text:
             return 0
-        return len(self.encoder.encode(text))
+        if not cache:
+            return len(self.encoder.encode(text))
+        return token_counts.count(self.encoder, text)
 
     def count_message(self, message: Message) -> int:
         # Approximate format: <|start|>{role}\n{content}<|end|>\n
@@ -0,0 +1,122 @@
+import collections
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+from .metrics import collector, token_cache_entries, token_cache_lookups
+
+class TokenCountCache:
+    """
+    LRU of token counts, shared by every TokenManager in the process.
+
+    Each chat turn re-sends the whole history, so without it turn N
+    re-encodes all N messages. Keys are (encoding name, len, hash) of the
+    text - Python's str hash is fast and cached on the string object, and
+    the length makes a collision between two live entries practically
+    impossible - so entries cost ~100 bytes however long the text is.
+    TOKEN_CACHE_ENTRIES bounds the size (0 disables the cache).
+    """
+    def __init__(self):
+        self.max_entries = int(os.getenv("TOKEN_CACHE_ENTRIES", "100000"))
+        self._counts: "collections.OrderedDict[Tuple[str, int, int], int]" = collections.OrderedDict()
+        self._lock = threading.Lock()  # Also used from the tokenizer threads
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, encoder, text: str, observe=None) -> int:
+        """
+        len(encoder.encode_ordinary(text)), from the cache when this text was
+        counted before - the same count as count_many, so both fill one cache
+        (special-token text like "<|endoftext|>" counts as plain text, never
+        raises). `observe(text, tokens)` is told about fresh encodes only.
+        """
+        if self.max_entries <= 0:
+            tokens = len(encoder.encode_ordinary(text))
+            if observe is not None:
+                observe(text, tokens)
+            return tokens
+        key = (encoder.name, len(text), hash(text))
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        # Encode outside the lock (tiktoken releases the GIL meanwhile)
+        tokens = len(encoder.encode_ordinary(text))
+        with self._lock:
+            self._counts[key] = tokens
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        if observe is not None:
+            observe(text, tokens)
+        return tokens
+
+    def count_many(self, encoder, texts: Sequence[str], num_threads: int = 1, observe=None) -> List[int]:
+        """
+        count() for a whole list at once: one pass over the cache under the
+        lock, then the distinct misses go through encode_ordinary_batch
+        (tiktoken's own threads, GIL released) - for large requests, from a
+        tokenizer_pool() thread.
+        """
+        if self.max_entries <= 0:
+            counts = [len(tokens) for tokens in encoder.encode_ordinary_batch(list(texts), num_threads=num_threads)]
+            if observe is not None:
+                for text, tokens in zip(texts, counts):
+                    observe(text, tokens)
+            return counts
+        keys = [(encoder.name, len(text), hash(text)) for text in texts]
+        counts: List[int] = [0] * len(texts)
+        missing: Dict[Tuple[str, int, int], str] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                tokens = self._counts.get(key)
+                if tokens is None:
+                    missing[key] = texts[i]
+                    continue
+                self._counts.move_to_end(key)
+                counts[i] = tokens
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if not missing:
+            return counts
+        if len(missing) == 1:
+            encoded = [encoder.encode_ordinary(next(iter(missing.values())))]
+        else:
+            encoded = encoder.encode_ordinary_batch(list(missing.values()), num_threads=num_threads)
+        fresh = {key: len(tokens) for key, tokens in zip(missing, encoded)}
+        with self._lock:
+            for key, tokens in fresh.items():
+                self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        if observe is not None:
+            for key, tokens in fresh.items():
+                observe(missing[key], tokens)
+        for i, key in enumerate(keys):
+            if key in fresh:
+                counts[i] = fresh[key]
+        return counts
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+token_counts = TokenCountCache()
+
+@collector
+def _collect_cache_stats():
+    token_cache_entries.set(len(token_counts._counts))
+    # Counters kept as plain ints on the hot path; published as totals here
+    token_cache_lookups.set_total(token_counts.hits, result="hit")
+    token_cache_lookups.set_total(token_counts.misses, result="miss")
@@ -0,0 +1,74 @@
+import collections
+import os
+import threading
+from typing import Deque, Dict, Tuple
+
+# Per-char token rates before any calibration: a token is at least one
+# UTF-8 byte, so these can't be exceeded (ASCII 1 byte/char, then 2 and 3)
+SCRIPTS = ("ascii", "two_byte", "cjk")
+CEILINGS = {"ascii": 1.0, "two_byte": 2.0, "cjk": 3.0}
+
+def utf8_size(text: str) -> int:
+    """UTF-8 length of `text` - a hard ceiling on its token count (every token is at least one byte)."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-8", "surrogatepass"))
+
+def script_chars(text: str) -> Tuple[int, int, int, int]:
+    """
+    (ascii, two_byte, cjk, utf8 bytes) char counts, from lengths alone (C
+    speed, no per-char loop). 2-byte chars are Latin-1/Greek/Cyrillic/
+    Arabic..., 3-byte ones CJK/kana/Hangul (4-byte emoji count as cjk).
+    """
+    if text.isascii():
+        return len(text), 0, 0, len(text)
+    size = len(text.encode("utf-8", "surrogatepass"))
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    wide = len(text) - ascii_chars
+    cjk = min(wide, max(0, size - ascii_chars - 2 * wide))
+    return ascii_chars, wide - cjk, cjk, size
+
+class TokenEstimator:
+    """
+    Calibrated token density per script: the mean tokens-per-char of the
+    last TOKEN_ESTIMATE_WINDOW exact counts of texts written mostly in it
+    (the byte ceiling until TOKEN_ESTIMATE_MIN_SAMPLES are in). One per
+    encoding: rates depend on the vocabulary (o200k packs CJK far tighter
+    than cl100k).
+
+    estimate() is a typical count, not a bound - code, base64 or hex run
+    far denser than prose. It only ranks texts by how loose their byte
+    ceiling probably is (see ContextEngine.build_context_estimated_async);
+    budgets are only ever checked against ceilings or exact counts.
+    """
+    def __init__(self):
+        self.min_samples = int(os.getenv("TOKEN_ESTIMATE_MIN_SAMPLES", "20"))
+        self.min_chars = int(os.getenv("TOKEN_ESTIMATE_MIN_CHARS", "64"))
+        window = int(os.getenv("TOKEN_ESTIMATE_WINDOW", "500"))
+        self._samples: Dict[str, Deque[float]] = {s: collections.deque(maxlen=window) for s in SCRIPTS}
+        self.rates: Dict[str, float] = dict(CEILINGS)  # Tokens per char
+        self._lock = threading.Lock()  # Observed from the tokenizer threads too
+
+    def observe(self, text: str, tokens: int):
+        """Learns from an exact count; only texts mostly (90%+) in one script are used."""
+        if len(text) < self.min_chars:
+            return
+        counts = script_chars(text)
+        main = max(range(len(SCRIPTS)), key=counts.__getitem__)
+        if counts[main] < 0.9 * len(text):
+            return
+        script = SCRIPTS[main]
+        with self._lock:
+            samples = self._samples[script]
+            samples.append(tokens / len(text))
+            if len(samples) >= self.min_samples:
+                self.rates[script] = min(CEILINGS[script], sum(samples) / len(samples))
+
+    def estimate(self, text: str) -> Tuple[float, int]:
+        """(typical token count, UTF-8 size) of `text`."""
+        ascii_chars, two_byte, cjk, size = script_chars(text)
+        rates = self.rates
+        return ascii_chars * rates["ascii"] + two_byte * rates["two_byte"] + cjk * rates["cjk"], size
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {s: {"rate": round(self.rates[s], 4), "samples": len(self._samples[s])} for s in SCRIPTS}
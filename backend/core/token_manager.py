@@ -1,18 +1,66 @@
+import asyncio
+import os
+import threading
 import tiktoken
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+from .token_cache import token_counts
+from .token_estimate import TokenEstimator, utf8_size
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def tokenizer_pool() -> ThreadPoolExecutor:
+    """
+    Threads for token counting off the event loop (tiktoken releases the
+    GIL while encoding). Created on first use, so each gunicorn worker
+    gets its own; TOKENIZER_THREADS sets the size.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(
+                    max_workers=int(os.getenv("TOKENIZER_THREADS", "2")),
+                    thread_name_prefix="tokenizer"
+                )
+    return _pool
 
 class TokenManager:
-    def __init__(self, model: str = "gpt-3.5-turbo"):
+    def __init__(self, model: str = "gpt-3.5-turbo", encoder: Optional[tiktoken.Encoding] = None):
         self.model = model
-        try:
-            self.encoder = tiktoken.encoding_for_model(model)
-        except KeyError:
-            self.encoder = tiktoken.get_encoding("cl100k_base")
+        # Texts/requests at least this long are counted on tokenizer_pool()
+        # instead of the event loop (0 = always inline)
+        self.offload_chars = int(os.getenv("TOKENIZER_OFFLOAD_CHARS", "32768"))
+        self.batch_threads = int(os.getenv("TOKENIZER_BATCH_THREADS", "4"))
+        # Byte ceilings instead of exact counts where those are enough (TOKEN_ESTIMATE=0 disables)
+        self.estimate = os.getenv("TOKEN_ESTIMATE", "1") != "0"
+        self.estimator = TokenEstimator()
+        if encoder is not None:
+            self.encoder = encoder  # Shared, see TokenizerRegistry
+        else:
+            try:
+                self.encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoder = tiktoken.get_encoding("cl100k_base")
 
-    def count_string(self, text: str) -> int:
+    def count_string(self, text: str, cache: bool = True) -> int:
+        """Tokens in `text`; cache=False for one-off texts not worth keeping (see TokenCountCache)."""
         if not text:
             return 0
-        return len(self.encoder.encode(text))
+        if not cache:
+            tokens = len(self.encoder.encode_ordinary(text))
+            self.estimator.observe(text, tokens)
+            return tokens
+        return token_counts.count(self.encoder, text, self.estimator.observe)
+
+    async def count_string_async(self, text: str, cache: bool = True) -> int:
+        """count_string, on tokenizer_pool() when `text` is long enough to stall the event loop."""
+        if self.offload_chars <= 0 or len(text) < self.offload_chars:
+            return self.count_string(text, cache)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(tokenizer_pool(), self.count_string, text, cache)
 
     def count_message(self, message: Dict[str, Any]) -> int:
         """
@@ -30,6 +78,52 @@ class TokenManager:
                 num_tokens += -1  # role is always required and does not count
         return num_tokens
 
+    def ceiling_message(self, message: Dict[str, Any]) -> int:
+        """
+        count_message, or more: the content is priced at its UTF-8 size (a
+        hard ceiling) instead of being encoded; role/name are short and cached.
+        """
+        num_tokens = 4
+        for key, value in message.items():
+            if key == "content":
+                num_tokens += utf8_size(str(value))
+            elif key == "role":
+                num_tokens += self.count_string(str(value))
+            elif key == "name":
+                num_tokens += self.count_string(str(value)) - 1
+        return num_tokens
+
+    def message_costs(self, messages: List[Dict[str, Any]]) -> List[int]:
+        """
+        [count_message(m) for m in messages], with every string counted in
+        one batch (TokenCountCache.count_many). Blocks for a while on long
+        histories - call it from tokenizer_pool(), see ContextEngine.
+        """
+        texts = []
+        for message in messages:
+            for key, value in message.items():
+                if key in ("content", "role", "name"):
+                    texts.append(str(value))
+        counts = iter(token_counts.count_many(self.encoder, texts, self.batch_threads, self.estimator.observe))
+        costs = []
+        for message in messages:
+            num_tokens = 4
+            for key in message:
+                if key in ("content", "role", "name"):
+                    num_tokens += next(counts)
+                    if key == "name":
+                        num_tokens += -1
+            costs.append(num_tokens)
+        return costs
+
+    async def message_costs_async(self, messages: List[Dict[str, Any]]) -> List[int]:
+        """message_costs: inline for small requests, on tokenizer_pool() from offload_chars of content up."""
+        size = sum(len(str(m.get("content") or "")) for m in messages)
+        if self.offload_chars <= 0 or size < self.offload_chars:
+            return [self.count_message(m) for m in messages]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(tokenizer_pool(), self.message_costs, messages)
+
     def count_messages(self, messages: List[Dict[str, Any]]) -> int:
         num_tokens = 0
         for msg in messages:
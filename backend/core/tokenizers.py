@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import tiktoken
+from typing import Dict, Iterable, Optional
+
+from .context import ContextEngine
+from .token_manager import TokenManager, tokenizer_pool
+
+logger = logging.getLogger(__name__)
+
+# Where tiktoken downloads each encoding from (the names of its cache files are sha1 of these)
+BPE_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+BUNDLED_ENCODINGS = ("cl100k_base", "o200k_base")
+DEFAULT_BUNDLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "assets", "tiktoken"
+)
+
+def tiktoken_cache_dir() -> str:
+    """The directory tiktoken reads cached BPE files from ("" = caching disabled), as tiktoken.load resolves it."""
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        return os.environ["TIKTOKEN_CACHE_DIR"]
+    if "DATA_GYM_CACHE_DIR" in os.environ:
+        return os.environ["DATA_GYM_CACHE_DIR"]
+    return os.path.join(tempfile.gettempdir(), "data-gym-cache")
+
+class TokenizerRegistry:
+    """
+    One TokenManager/ContextEngine per tiktoken encoding, shared by every
+    model that uses it, so each model's budget is counted with its own
+    vocabulary (o200k for gpt-4o, cl100k for gpt-3.5/4).
+
+    - model_id -> encoding: TOKENIZER_ENCODINGS overrides ("prefix=encoding,
+      ..."), then tiktoken's own table; models tiktoken doesn't know
+      (deepseek-chat, ...) get TOKENIZER_DEFAULT_ENCODING (cl100k_base),
+      a close enough count for budgets.
+    - Encoders are loaded on first use (~0.5s of parsing each).
+    - Before the first load, <name>.tiktoken files in TIKTOKEN_BUNDLE_DIR
+      (assets/tiktoken, filled by `python -m backend.core.tokenizers`)
+      are copied into tiktoken's cache, so an offline box never needs
+      to download them.
+    """
+    def __init__(self):
+        self.bundle_dir = os.getenv("TIKTOKEN_BUNDLE_DIR", DEFAULT_BUNDLE_DIR)
+        self.default_encoding = os.getenv("TOKENIZER_DEFAULT_ENCODING", "cl100k_base")
+        self.overrides = self._parse_overrides(os.getenv("TOKENIZER_ENCODINGS", ""))
+        self._engines: Dict[str, ContextEngine] = {}  # By encoding name
+        self._by_model: Dict[str, ContextEngine] = {}
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    @staticmethod
+    def _parse_overrides(spec: str) -> Dict[str, str]:
+        overrides = {}
+        for item in spec.split(","):
+            prefix, _, encoding = item.partition("=")
+            if prefix.strip() and encoding.strip():
+                overrides[prefix.strip().lower()] = encoding.strip()
+        return overrides
+
+    def encoding_name(self, model_id: str) -> str:
+        name = (model_id or "").strip().lower().rsplit("/", 1)[-1]  # "openai/gpt-4o" style ids
+        for prefix in sorted(self.overrides, key=len, reverse=True):
+            if name.startswith(prefix):
+                return self.overrides[prefix]
+        try:
+            return tiktoken.encoding_name_for_model(name)
+        except KeyError:
+            return self.default_encoding
+
+    # --- Loading ---
+
+    def seed_cache(self) -> int:
+        """Copies bundled BPE files into tiktoken's cache (missing ones only). Returns how many."""
+        cache_dir = tiktoken_cache_dir()
+        if not cache_dir or not os.path.isdir(self.bundle_dir):
+            return 0
+        seeded = 0
+        for filename in os.listdir(self.bundle_dir):
+            name, ext = os.path.splitext(filename)
+            if ext != ".tiktoken":
+                continue
+            key = hashlib.sha1(BPE_URL.format(name=name).encode()).hexdigest()
+            target = os.path.join(cache_dir, key)
+            if os.path.exists(target):
+                continue
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = f"{target}.{os.getpid()}.tmp"
+                shutil.copyfile(os.path.join(self.bundle_dir, filename), tmp)
+                os.replace(tmp, target)  # Atomic: other workers may be seeding too
+                seeded += 1
+            except OSError as e:
+                logger.warning(f"Could not seed tiktoken cache with {filename}: {e}")
+        if seeded:
+            logger.info(f"Seeded tiktoken cache {cache_dir} with {seeded} bundled encoding(s)")
+        return seeded
+
+    def _load(self, encoding: str) -> ContextEngine:
+        """Engine for `encoding`; call with self._lock held."""
+        engine = self._engines.get(encoding)
+        if engine is not None:
+            return engine
+        if not self._seeded:
+            self._seeded = True
+            self.seed_cache()
+        try:
+            encoder = tiktoken.get_encoding(encoding)
+        except Exception as e:
+            if encoding == self.default_encoding:
+                raise
+            # Offline without that file bundled: approximate with the default rather than fail every request
+            logger.error(f"Could not load tiktoken encoding {encoding} ({e}), counting with {self.default_encoding}")
+            engine = self._load(self.default_encoding)
+        else:
+            engine = ContextEngine(TokenManager(encoding, encoder=encoder))
+        self._engines[encoding] = engine
+        return engine
+
+    def for_model(self, model_id: str) -> ContextEngine:
+        """The ContextEngine (and, as .tm, TokenManager) for an ai_models.model_id. May block while loading."""
+        engine = self._by_model.get(model_id)
+        if engine is None:
+            with self._lock:
+                engine = self._by_model[model_id] = self._load(self.encoding_name(model_id))
+        return engine
+
+    async def for_model_async(self, model_id: str) -> ContextEngine:
+        """for_model, loading a not yet used encoding on tokenizer_pool() instead of the event loop."""
+        engine = self._by_model.get(model_id)
+        if engine is not None:
+            return engine
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(tokenizer_pool(), self.for_model, model_id)
+
+    async def preload(self, model_ids: Iterable[str]):
+        """Loads the encoders of these models ahead of their first request (started from main's startup)."""
+        for model_id in model_ids:
+            try:
+                await self.for_model_async(model_id)
+            except Exception as e:
+                logger.error(f"Could not load a tokenizer for {model_id}: {e}")
+
+tokenizers = TokenizerRegistry()
+
+def bundle(names: Iterable[str] = BUNDLED_ENCODINGS, bundle_dir: Optional[str] = None):
+    """Downloads BPE files into the bundle dir, for images/installers that must start offline."""
+    from tiktoken.load import read_file
+
+    bundle_dir = bundle_dir or tokenizers.bundle_dir
+    os.makedirs(bundle_dir, exist_ok=True)
+    for name in names:
+        path = os.path.join(bundle_dir, f"{name}.tiktoken")
+        with open(path, "wb") as f:
+            f.write(read_file(BPE_URL.format(name=name)))
+        print(f"Saved {name} to {path}")
+
+if __name__ == "__main__":
+    bundle(sys.argv[1:] or BUNDLED_ENCODINGS)
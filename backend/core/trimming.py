@@ -0,0 +1,31 @@
+import bisect
+import itertools
+from typing import List, Optional, Sequence, Tuple
+
+def newest_that_fit(costs: Sequence[int], budget: int) -> Tuple[int, int]:
+    """
+    How many of the last items fit in `budget` when taken newest first,
+    stopping at the first that doesn't (costs must be positive), and
+    their total cost. One cumulative sum and a binary search instead of
+    a walk with a comparison per item.
+    """
+    if budget <= 0 or not costs:
+        return 0, 0
+    total = sum(costs)
+    if total <= budget:
+        return len(costs), total  # The usual case with long-context models
+    suffix = list(itertools.accumulate(reversed(costs)))
+    kept = bisect.bisect_right(suffix, budget)
+    return kept, suffix[kept - 1] if kept else 0
+
+def without_system(messages: List[dict], costs: Optional[Sequence[int]] = None):
+    """
+    Drops system messages (and their costs, if given) -> (messages, costs).
+    Returns the inputs as they are when there are none.
+    """
+    if not any(m.get("role") == "system" for m in messages):
+        return messages, costs
+    if costs is None:
+        return [m for m in messages if m.get("role") != "system"], None
+    pairs = [(m, c) for m, c in zip(messages, costs) if m.get("role") != "system"]
+    return [m for m, _ in pairs], [c for _, c in pairs]
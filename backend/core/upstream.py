@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import logging
+import os
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from .metrics import collector, upstream_pool_connections, upstream_pool_waiting, upstream_pool_max_connections
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401 - httpx only speaks HTTP/2 when h2 is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+def chat_completions_url(api_url: str) -> str:
+    """Model api_url (base URL or full endpoint) -> .../chat/completions"""
+    if api_url.endswith("/chat/completions"):
+        return api_url
+    if api_url.endswith("/"):
+        return api_url + "chat/completions"
+    return api_url + "/chat/completions"
+
+def origin_of(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+class UpstreamClients:
+    """
+    One pooled httpx.AsyncClient per upstream origin (scheme://host:port).
+    Each provider gets its own connection limit, so a burst to one host can't
+    starve the others, and connections are kept alive between requests so
+    TLS handshakes stay off the request path. HTTP/2 is negotiated via ALPN
+    when h2 is installed; providers without it fall back to HTTP/1.1.
+
+    Pools are for the configured model origins. At most UPSTREAM_MAX_ORIGINS
+    are kept (least recently used evicted and closed once idle); URLs
+    supplied by clients go through one_off() instead.
+    """
+    def __init__(self):
+        self.http2 = HTTP2_AVAILABLE and os.getenv("UPSTREAM_HTTP2", "1") != "0"
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "90")),
+        )
+        self.timeout = httpx.Timeout(
+            connect=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")),
+            read=float(os.getenv("UPSTREAM_READ_TIMEOUT", "120")), # Max silence between chunks
+            write=30.0,
+            pool=10.0, # Max wait for a free connection from the pool
+        )
+        self.max_origins = int(os.getenv("UPSTREAM_MAX_ORIGINS", "64"))
+        self._clients: "collections.OrderedDict[str, httpx.AsyncClient]" = collections.OrderedDict()
+        self._retiring: Dict[asyncio.Task, httpx.AsyncClient] = {}  # Evicted, closed once idle
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        origin = origin_of(url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(http2=self.http2, limits=self.limits, timeout=self.timeout)
+            self._clients[origin] = client
+            while len(self._clients) > self.max_origins:
+                _, evicted = self._clients.popitem(last=False)
+                self._retire(evicted)
+        self._clients.move_to_end(origin)
+        return client
+
+    def one_off(self) -> httpx.AsyncClient:
+        """An unpooled client for a URL that isn't a configured model's; use as `async with`, which closes it."""
+        return httpx.AsyncClient(http2=self.http2, timeout=self.timeout)
+
+    def _retire(self, client: httpx.AsyncClient):
+        task = asyncio.get_running_loop().create_task(self._close_when_idle(client))
+        self._retiring[task] = client
+        task.add_done_callback(lambda t: self._retiring.pop(t, None))
+
+    async def _close_when_idle(self, client: httpx.AsyncClient):
+        """Closes an evicted client once its in-flight requests (streams included) are done."""
+        while True:
+            state = self._pool_state(client)
+            if state is None or (state[0] == 0 and state[2] == 0):
+                break
+            await asyncio.sleep(1.0)
+        await client.aclose()
+
+    @staticmethod
+    def _pool_state(client: httpx.AsyncClient) -> Optional[Tuple[int, int, int]]:
+        """(active, idle, waiting) of a client's httpcore pool; None if closed or not inspectable."""
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        if pool is None or client.is_closed:
+            return None
+        connections = [c for c in getattr(pool, "connections", []) if not c.is_closed()]
+        idle = sum(1 for c in connections if c.is_idle())
+        waiting = sum(1 for r in getattr(pool, "_requests", []) if getattr(r, "connection", None) is None)
+        return len(connections) - idle, idle, waiting
+
+    async def warm_up(self, urls: Iterable[str]):
+        """Opens a kept-alive connection (DNS + TCP + TLS) to each origin ahead of traffic."""
+        origins = {origin_of(u) for u in urls if u}
+
+        async def touch(origin):
+            try:
+                # Any response (even 404) leaves a warm connection in the pool
+                await self.get(origin).head(origin + "/", timeout=self.timeout.connect)
+            except httpx.HTTPError as e:
+                logger.warning(f"Upstream warm-up failed for {origin}: {e}")
+
+        await asyncio.gather(*(touch(o) for o in origins))
+        if origins:
+            logger.info(f"Warmed upstream pools: {', '.join(sorted(origins))} (http2={self.http2})")
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        """origin -> active / idle connections and requests waiting for one (read from httpcore's pool)."""
+        stats = {}
+        for origin, client in list(self._clients.items()):
+            state = self._pool_state(client)
+            if state is not None:
+                stats[origin] = {"active": state[0], "idle": state[1], "waiting": state[2]}
+        return stats
+
+    async def aclose(self):
+        clients, self._clients = list(self._clients.values()), collections.OrderedDict()
+        for task, client in list(self._retiring.items()):
+            task.cancel()
+            clients.append(client)
+        await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+upstream_clients = UpstreamClients()
+
+@collector
+def _collect_pool_stats():
+    upstream_pool_connections.clear()
+    upstream_pool_waiting.clear()
+    upstream_pool_max_connections.clear()
+    for origin, stats in upstream_clients.pool_stats().items():
+        upstream_pool_connections.set(stats["active"], origin=origin, state="active")
+        upstream_pool_connections.set(stats["idle"], origin=origin, state="idle")
+        upstream_pool_waiting.set(stats["waiting"], origin=origin)
+        upstream_pool_max_connections.set(upstream_clients.limits.max_connections, origin=origin)
@@ -2,14 +2,20 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+import asyncio
+import logging
 import os
 import sys
 
 # Import routers
 from backend.api import chat, sync, system, auth, models, shop
 from backend.core.tunnel import tunnel_service
+from backend.core.database import db, async_db
+from backend.core.metrics import metrics_store
+from backend.core.stream_buffer import generations
 
 app = FastAPI(title="LiteTavern Backend", version="0.1.0")
+logger = logging.getLogger(__name__)
 
 # Gzip Compression (Speed Boost)
 app.add_middleware(GZipMiddleware, minimum_size=1000)
@@ -21,18 +27,93 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Generation-Id"], # Needed to resume a stream (GET /api/v1/chat/generations/{id})
 )
 
 # Include Routers
 app.include_router(chat.router, prefix="/api") # /api/v1/chat/completions
 app.include_router(sync.router, prefix="/api") # /api/data, /api/status
-app.include_router(system.router, prefix="/api") # /api/system/tunnel
+app.include_router(system.router, prefix="/api") # /api/system/tunnel, /api/metrics
 app.include_router(auth.router, prefix="/api") # /api/auth/login
 app.include_router(models.router, prefix="/api") # /api/admin/models
 app.include_router(shop.router, prefix="/api") # /api/shop/redeem
 
+async def ledger_compaction_loop():
+    """
+    Rolls old power_ledger rows into the archive DB (LEDGER_COMPACT_INTERVAL_HOURS=0 disables).
+    One worker per interval does it (job lease), in batches of LEDGER_COMPACT_BATCH_ROWS
+    with a pause in between so billing writes get the lock.
+    """
+    interval_hours = float(os.getenv("LEDGER_COMPACT_INTERVAL_HOURS", "24"))
+    retention_days = int(os.getenv("LEDGER_RETENTION_DAYS", "30"))
+    batch_rows = int(os.getenv("LEDGER_COMPACT_BATCH_ROWS", "5000"))
+    start_delay = float(os.getenv("LEDGER_COMPACT_START_DELAY_SECONDS", "600"))
+    if interval_hours <= 0:
+        return
+    await asyncio.sleep(start_delay) # Not during startup / deploys
+    while True:
+        try:
+            # Expires a bit before the next round, so whichever worker comes first takes it
+            if await async_db.acquire_lease("ledger_compaction", interval_hours * 3600 * 0.9):
+                while (await async_db.compact_ledger(retention_days, batch_rows))["more"]:
+                    await asyncio.sleep(0.5)
+        except Exception as e:
+            logger.error(f"Ledger compaction failed: {e}")
+        await asyncio.sleep(interval_hours * 3600)
+
+async def reservation_reaper_loop():
+    """
+    Refunds power reservations left held by requests that never settled
+    (a worker killed mid-request) once they are RESERVATION_STALE_SECONDS
+    old, and prunes settled ones after RESERVATION_RETENTION_DAYS.
+    RESERVATION_REAP_INTERVAL_SECONDS=0 disables; one worker per round.
+    """
+    interval = float(os.getenv("RESERVATION_REAP_INTERVAL_SECONDS", "600"))
+    # Longer than any request can run, or live streams would be refunded
+    stale_seconds = float(os.getenv("RESERVATION_STALE_SECONDS", "3600"))
+    retention_days = float(os.getenv("RESERVATION_RETENTION_DAYS", "7"))
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await async_db.acquire_lease("reservation_reaper", interval * 0.9):
+                while True:
+                    result = await async_db.reap_reservations(stale_seconds, retention_days)
+                    if result["refunded"]:
+                        logger.warning(f"Refunded {result['refunded']} stale power reservation(s)")
+                    if not result["more"]:
+                        break
+                    await asyncio.sleep(0.5)
+        except Exception as e:
+            logger.error(f"Reservation reaping failed: {e}")
+
+async def metrics_flush_loop():
+    """Publishes this worker's metrics for /api/metrics scrapes served by the other workers."""
+    if not metrics_store.directory:
+        return
+    while True:
+        await asyncio.sleep(metrics_store.flush_interval)
+        try:
+            metrics_store.flush()
+        except Exception as e:
+            logger.error(f"Metrics flush failed: {e}")
+
 @app.on_event("startup")
 async def startup_event():
+    # Shared by all workers; METRICS_DIR="" keeps /api/metrics to the worker that serves it
+    metrics_store.configure(os.getenv("METRICS_DIR", f"{db.db_path}.metrics"))
+    # Spool files of resumable streams, readable by every worker
+    generations.configure(os.getenv("STREAM_BUFFER_DIR", f"{db.db_path}.streams"))
+    app.state.background_tasks = [
+        asyncio.create_task(ledger_compaction_loop()),
+        asyncio.create_task(reservation_reaper_loop()),
+        asyncio.create_task(metrics_flush_loop()),
+        # In the background: an unreachable provider must not delay startup
+        asyncio.create_task(chat.warm_upstream_pools()),
+        asyncio.create_task(chat.preload_tokenizers()),
+    ]
+
     # Only start tunnel if NOT in production (Render/Vercel)
     # Render sets RENDER=true
     if not os.getenv("RENDER") and not os.getenv("NO_TUNNEL"):
@@ -42,7 +123,13 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    for task in app.state.background_tasks:
+        task.cancel()
+    if metrics_store.directory:
+        metrics_store.flush() # Keep this worker's counters in the totals after it exits
     tunnel_service.stop()
+    async_db.shutdown()
+    db.close()
 
 # Static Files (Frontend)
 static_dir = os.path.dirname(os.path.abspath(__file__)) # backend/
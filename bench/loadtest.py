@@ -0,0 +1,211 @@
+"""
+Load generator for /api/v1/chat/completions.
+
+    # 1. Start the mock upstream and the backend
+    python bench/mock_upstream.py --port 9000
+    NO_TUNNEL=1 gunicorn backend.main:app --workers 2 --worker-class uvicorn.workers.UvicornWorker
+
+    # 2. Point model 1 at the mock, seed 50 funded users, run 60s at 100 concurrent streams
+    python bench/loadtest.py --setup --seed-users 50 --db users.db --concurrency 100 --duration 60
+
+Reports RPS, status counts, latency / TTFT / stream duration percentiles and,
+with --db, ledger and reservation write rates.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import time
+from collections import Counter
+from typing import List, Optional
+
+import httpx
+
+PROMPTS = [
+    "Describe the tavern as I walk in.",
+    "The bard looks up from his lute. What does he say?",
+    "I order a drink and sit by the fire.",
+    "Tell me a rumour about the old mill.",
+]
+
+class Sample:
+    __slots__ = ("status", "latency", "ttft", "duration", "chunks", "error")
+
+    def __init__(self):
+        self.status = 0
+        self.latency = 0.0
+        self.ttft: Optional[float] = None
+        self.duration = 0.0
+        self.chunks = 0
+        self.error: Optional[str] = None
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+def summarize(name: str, values: List[float]) -> str:
+    if not values:
+        return f"{name:<16} n/a"
+    ms = [v * 1000 for v in values]
+    return (f"{name:<16} p50 {percentile(ms, 50):8.1f}ms  p90 {percentile(ms, 90):8.1f}ms  "
+            f"p99 {percentile(ms, 99):8.1f}ms  max {max(ms):8.1f}ms")
+
+# --- Setup ---
+
+async def point_model_at_mock(client: httpx.AsyncClient, model_id: int, mock_url: str):
+    models = (await client.get("/api/admin/models")).json()
+    model = next((m for m in models if m["id"] == model_id), None)
+    if not model:
+        raise SystemExit(f"Model {model_id} not found (or disabled)")
+    model.update(api_url=mock_url, api_key="mock-key", enabled=True)
+    model.pop("id", None)
+    resp = await client.post(f"/api/admin/models/{model_id}", json=model)
+    resp.raise_for_status()
+    print(f"Model {model_id} ({model['name']}) now points at {mock_url}")
+
+def seed_users(db_path: str, count: int) -> List[int]:
+    """Creates (or tops up) loadtest users directly in the DB."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        for i in range(count):
+            conn.execute(
+                "INSERT OR IGNORE INTO users (username, password, email, power_balance) VALUES (?, ?, ?, ?)",
+                (f"loadtest_{i}", "loadtest", f"loadtest_{i}@localhost", 10**9)
+            )
+        conn.execute("UPDATE users SET power_balance = ? WHERE username LIKE 'loadtest_%'", (10**9,))
+        conn.commit()
+        return [row[0] for row in conn.execute("SELECT id FROM users WHERE username LIKE 'loadtest_%' ORDER BY id")]
+    finally:
+        conn.close()
+
+def db_counters(db_path: Optional[str]):
+    if not db_path:
+        return None
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        counts = {}
+        for table in ("power_ledger", "power_reservations"):
+            try:
+                counts[table] = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                counts[table] = 0
+        return counts
+    finally:
+        conn.close()
+
+# --- Load ---
+
+async def one_request(client: httpx.AsyncClient, args, user_id: int) -> Sample:
+    sample = Sample()
+    body = {
+        "model": str(args.model_id),
+        "messages": [{"role": "user", "content": random.choice(PROMPTS)}] * args.history,
+        "max_tokens": args.max_tokens,
+        "stream": args.stream,
+    }
+    started = time.perf_counter()
+    try:
+        if not args.stream:
+            resp = await client.post("/api/v1/chat/completions", json=body, headers={"X-User-Id": str(user_id)})
+            sample.status = resp.status_code
+            sample.latency = sample.duration = time.perf_counter() - started
+            return sample
+
+        async with client.stream("POST", "/api/v1/chat/completions", json=body,
+                                 headers={"X-User-Id": str(user_id)}) as resp:
+            sample.status = resp.status_code
+            sample.latency = time.perf_counter() - started
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if sample.ttft is None:
+                    sample.ttft = time.perf_counter() - started
+                if '"error"' in line:
+                    sample.error = "stream error"
+                sample.chunks += 1
+        sample.duration = time.perf_counter() - started
+    except Exception as e:
+        sample.error = type(e).__name__
+        sample.duration = time.perf_counter() - started
+    return sample
+
+async def worker(client, args, user_ids, deadline, remaining, samples):
+    while time.perf_counter() < deadline:
+        if remaining is not None:
+            if remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+        samples.append(await one_request(client, args, random.choice(user_ids)))
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(connect=10.0, read=300.0, write=30.0, pool=300.0)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=timeout) as client:
+        if args.setup:
+            await point_model_at_mock(client, args.model_id, args.mock_url)
+
+        user_ids = [int(u) for u in args.user_ids.split(",")]
+        if args.seed_users:
+            if not args.db:
+                raise SystemExit("--seed-users needs --db")
+            user_ids = seed_users(args.db, args.seed_users)
+
+        print(f"Running: {args.concurrency} concurrent, "
+              f"{'stream' if args.stream else 'non-stream'}, "
+              f"{f'{args.requests} requests' if args.requests else f'{args.duration}s'}, {len(user_ids)} users")
+
+        before = db_counters(args.db)
+        samples: List[Sample] = []
+        remaining = [args.requests] if args.requests else None
+        started = time.perf_counter()
+        deadline = started + (args.duration if not args.requests else 10**9)
+        await asyncio.gather(*[
+            worker(client, args, user_ids, deadline, remaining, samples) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+        after = db_counters(args.db)
+
+    ok = [s for s in samples if s.status == 200 and not s.error]
+    statuses = Counter(s.status for s in samples)
+    errors = Counter(s.error for s in samples if s.error)
+
+    print()
+    print(f"Requests         {len(samples)} in {elapsed:.1f}s  ->  {len(samples) / elapsed:.1f} req/s "
+          f"({len(ok) / elapsed:.1f} ok/s)")
+    print(f"Status codes     {dict(statuses)}")
+    if errors:
+        print(f"Errors           {dict(errors)}")
+    print(summarize("Latency (hdrs)", [s.latency for s in ok]))
+    if args.stream:
+        print(summarize("TTFT", [s.ttft for s in ok if s.ttft is not None]))
+        print(summarize("Stream duration", [s.duration for s in ok]))
+        chunks = sum(s.chunks for s in ok)
+        print(f"Chunks           {chunks} ({chunks / elapsed:.0f}/s)")
+    if before and after:
+        for table in before:
+            delta = after[table] - before[table]
+            print(f"DB {table:<13} +{delta} rows ({delta / elapsed:.1f}/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000", help="LiteTavern backend")
+    parser.add_argument("--mock-url", default="http://127.0.0.1:9000/v1", help="Mock upstream (for --setup)")
+    parser.add_argument("--setup", action="store_true", help="Point --model-id at --mock-url first")
+    parser.add_argument("--model-id", type=int, default=1, help="ai_models.id to call")
+    parser.add_argument("--user-ids", default="1", help="Comma separated X-User-Id values")
+    parser.add_argument("--seed-users", type=int, default=0, help="Create N funded loadtest users (needs --db)")
+    parser.add_argument("--db", help="Path to users.db, for seeding and DB write rates")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after N requests instead of --duration")
+    parser.add_argument("--history", type=int, default=10, help="Messages per request")
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Mock OpenAI-compatible upstream for load testing the chat proxy.
+
+    python bench/mock_upstream.py --port 9000 --ttft-ms 400 --tokens-per-sec 40
+
+Then point a model at it (bench/loadtest.py --setup does this for you):
+    api_url = http://127.0.0.1:9000/v1
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="LiteTavern Mock Upstream")
+
+# Filled from the command line (see main)
+config = argparse.Namespace(
+    ttft_ms=300.0, ttft_jitter_ms=100.0, tokens_per_sec=50.0, completion_tokens=120,
+    error_rate=0.0, rate_limit_rate=0.0, disconnect_rate=0.0,
+    rpm_limit=10000, tpm_limit=2000000,
+)
+
+WORDS = ("the tavern door creaks open and a cold wind carries the smell of rain "
+         "across the wooden floor while the bard tunes an old lute").split()
+
+# Rolling one-minute counters, only used to fill the x-ratelimit-* headers
+window = {"start": time.time(), "requests": 0, "tokens": 0}
+
+def ratelimit_headers(tokens: int):
+    now = time.time()
+    if now - window["start"] >= 60:
+        window.update(start=now, requests=0, tokens=0)
+    window["requests"] += 1
+    window["tokens"] += tokens
+    reset = max(0.0, 60 - (now - window["start"]))
+    return {
+        "x-ratelimit-limit-requests": str(config.rpm_limit),
+        "x-ratelimit-remaining-requests": str(max(0, config.rpm_limit - window["requests"])),
+        "x-ratelimit-reset-requests": f"{reset:.0f}s",
+        "x-ratelimit-limit-tokens": str(config.tpm_limit),
+        "x-ratelimit-remaining-tokens": str(max(0, config.tpm_limit - window["tokens"])),
+        "x-ratelimit-reset-tokens": f"{reset:.0f}s",
+    }
+
+def prompt_tokens(messages) -> int:
+    # Cheap approximation; the proxy does the real counting
+    return sum(4 + len(str(m.get("content", ""))) // 4 for m in messages)
+
+async def first_token_delay():
+    delay = max(0.0, random.gauss(config.ttft_ms, config.ttft_jitter_ms)) / 1000
+    await asyncio.sleep(delay)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock")
+    n_prompt = prompt_tokens(body.get("messages", []))
+    n_completion = min(int(body.get("max_tokens") or config.completion_tokens), config.completion_tokens)
+    headers = ratelimit_headers(n_prompt + n_completion)
+
+    roll = random.random()
+    if roll < config.rate_limit_rate:
+        return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                            status_code=429, headers={**headers, "retry-after": "1"})
+    if roll < config.rate_limit_rate + config.error_rate:
+        return JSONResponse({"error": {"message": "Mock upstream failure", "type": "server_error"}},
+                            status_code=500, headers=headers)
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    usage = {"prompt_tokens": n_prompt, "completion_tokens": n_completion, "total_tokens": n_prompt + n_completion}
+
+    if not body.get("stream"):
+        await first_token_delay()
+        await asyncio.sleep(n_completion / config.tokens_per_sec)
+        text = " ".join(random.choice(WORDS) for _ in range(n_completion))
+        return JSONResponse({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, headers=headers)
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    disconnect_at = random.randint(1, n_completion) if random.random() < config.disconnect_rate else None
+
+    async def events():
+        await first_token_delay()
+        gap = 1.0 / config.tokens_per_sec
+        for i in range(n_completion):
+            if disconnect_at is not None and i == disconnect_at:
+                # Abort the connection without [DONE], like a dropped upstream
+                raise ConnectionResetError("mock mid-stream disconnect")
+            chunk = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {"content": random.choice(WORDS) + " "}, "finish_reason": None}],
+            }
+            if include_usage:
+                chunk["usage"] = None  # Like OpenAI: every chunk carries the key, only the last one a value
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(gap)
+        final = {
+            "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        if include_usage:
+            final["usage"] = None
+        yield f"data: {json.dumps(final)}\n\n"
+        if include_usage:
+            yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms, help="Mean time to first token")
+    parser.add_argument("--ttft-jitter-ms", type=float, default=config.ttft_jitter_ms, help="Std-dev of TTFT")
+    parser.add_argument("--tokens-per-sec", type=float, default=config.tokens_per_sec)
+    parser.add_argument("--completion-tokens", type=int, default=config.completion_tokens)
+    parser.add_argument("--error-rate", type=float, default=config.error_rate, help="Fraction answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=config.rate_limit_rate, help="Fraction answered with 429")
+    parser.add_argument("--disconnect-rate", type=float, default=config.disconnect_rate, help="Fraction of streams cut mid-reply")
+    parser.add_argument("--rpm-limit", type=int, default=config.rpm_limit, help="Advertised in x-ratelimit headers")
+    parser.add_argument("--tpm-limit", type=int, default=config.tpm_limit, help="Advertised in x-ratelimit headers")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        setattr(config, key, value)
+
+    print(f"Mock upstream on http://{args.host}:{args.port}/v1 "
+          f"(TTFT {args.ttft_ms:.0f}ms, {args.tokens_per_sec:.0f} tok/s, errors {args.error_rate:.0%}, "
+          f"429s {args.rate_limit_rate:.0%}, disconnects {args.disconnect_rate:.0%})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -42,9 +42,15 @@ export const AdminDashboard: React.FC<{ onClose: () => void }> = ({ onClose }) =
   const fetchUsers = async () => {
     setLoading(true);
     try {
-      const res = await fetch('/api/admin/users');
-      const data = await res.json();
-      setUsers(data);
+      // Keyset pagination: follow X-Next-Cursor until the last page
+      const all: UserData[] = [];
+      let cursor: string | null = '0';
+      while (cursor !== null) {
+        const res = await fetch(`/api/admin/users?after_id=${cursor}&limit=200`);
+        all.push(...(await res.json()));
+        cursor = res.headers.get('X-Next-Cursor');
+      }
+      setUsers(all);
     } catch (e) { console.error(e); } finally { setLoading(false); }
   };
 
@@ -151,7 +151,8 @@ export const useRuntimeStore = create<RuntimeState>()(
                       throw new Error(json.error);
                   }
 
-                  const content = json.choices[0].delta.content || "";
+                  // The final usage chunk has no choices
+                  const content = json.choices?.[0]?.delta?.content || "";
                   fullText += content;
                   
                   set((state: RuntimeState) => {
@@ -1863,7 +1863,9 @@ async function sendMessage() {
                     if (jsonStr === '[DONE]') continue;
                     try {
                         const json = JSON.parse(jsonStr);
-                        const content = json.choices[0].delta.content || "";
+                        // The final usage chunk has no choices
+                        const choice = (json.choices || [])[0];
+                        const content = (choice && choice.delta && choice.delta.content) || "";
                         if (content) {
                             fullText += content;
                             bubble.innerText = fullText;